@@ -0,0 +1,80 @@
+"""
+Check the content hashes `rrc ingest` gives multi-frame images.
+
+Writes multi-frame files to a temporary directory and probes them as ingest does:
+an animated PNG, a multi-page TIFF saved under a `.jpg` name, and a TIFF holding the
+same pages in another order. Every frame of a file must get its own hash, and a page
+must get the same hash in every TIFF it was saved into.
+
+    uv run python benchmarks/content_hashes.py
+"""
+
+import tempfile
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+from rich.console import Console
+
+import rrc.utils.click as click
+from rrc.ingest.ingest_directory import _probe_image
+
+console = Console()
+
+
+def _get_pages(n_pages: int) -> list[Image.Image]:
+    pages = []
+    for i in range(n_pages):
+        page = Image.new("L", (400, 300), 255)
+        ImageDraw.Draw(page).text((20, 20 + 40 * i), f"Page {i}", fill=0)
+        pages.append(page)
+    return pages
+
+
+def _probe(path: Path) -> list[str]:
+    result = _probe_image(path)
+    if result.error is not None:
+        raise click.ClickException(f"Can't probe {path.name}: {result.error}")
+    return result.content_hashes
+
+
+@click.command()
+@click.option("--n-pages", type=int, default=3, help="Frames per file")
+def main(n_pages: int) -> None:
+    """Check each frame of a multi-frame file gets its own content hash."""
+    pages = _get_pages(n_pages)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {
+            "animated PNG": Path(tmp_dir) / "pages.png",
+            "TIFF named .jpg": Path(tmp_dir) / "pages.jpg",
+            "TIFF": Path(tmp_dir) / "reversed.tif",
+        }
+        pages[0].save(paths["animated PNG"], save_all=True, append_images=pages[1:])
+        pages[0].save(
+            paths["TIFF named .jpg"],
+            format="TIFF",
+            save_all=True,
+            append_images=pages[1:],
+        )
+        pages[-1].save(paths["TIFF"], save_all=True, append_images=pages[-2::-1])
+        hashes = {name: _probe(path) for name, path in paths.items()}
+
+    ok = True
+    for name, file_hashes in hashes.items():
+        distinct = len(set(file_hashes)) == n_pages == len(file_hashes)
+        ok &= distinct
+        console.print(
+            f"{'[green]✓[/green]' if distinct else '[red]✗[/red]'} {name}: "
+            f"{len(set(file_hashes))} distinct hashes for {n_pages} frames"
+        )
+    same = hashes["TIFF named .jpg"] == hashes["TIFF"][::-1]
+    ok &= same
+    console.print(
+        f"{'[green]✓[/green]' if same else '[red]✗[/red]'} The same pages get the "
+        f"same hashes in both TIFFs"
+    )
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
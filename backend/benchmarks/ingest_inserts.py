@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of Page inserts during ingest.
+
+Compares the previous ORM path (`session.add_all` + commit per batch) against the bulk
+executemany path used by `rrc ingest`, on a throwaway SQLite database. Image validation
+and hashing are excluded so only the database cost is measured.
+
+    uv run python benchmarks/ingest_inserts.py --n-pages 200000
+"""
+
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import sqlalchemy as sa
+from rich.console import Console
+from sqlalchemy.orm import Session
+
+import rrc.utils.click as click
+from rrc.db.models import Base, Page
+
+console = Console()
+
+
+def _get_rows(n_pages: int, frames_per_file: int) -> list[dict]:
+    return [
+        {
+            "image_path": f"/data/images/book_{i // frames_per_file:07d}.tif",
+            "image_frame_idx": i % frames_per_file,
+            "content_hash": f"{i:032x}",
+        }
+        for i in range(n_pages)
+    ]
+
+
+def _insert_orm(session: Session, rows: list[dict]) -> None:
+    session.add_all(Page(**row) for row in rows)
+    session.commit()
+
+
+def _insert_bulk(session: Session, rows: list[dict]) -> None:
+    session.execute(sa.insert(Page), rows)
+    session.commit()
+
+
+_MODES: dict[str, Callable[[Session, list[dict]], None]] = {
+    "orm": _insert_orm,
+    "bulk": _insert_bulk,
+}
+
+
+def _run(
+    insert_batch: Callable[[Session, list[dict]], None],
+    rows: list[dict],
+    batch_size: int,
+) -> float:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = sa.create_engine(f"sqlite:///{Path(tmp_dir) / 'bench.db'}")
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            start = time.perf_counter()
+            for i in range(0, len(rows), batch_size):
+                insert_batch(session, rows[i : i + batch_size])
+            elapsed = time.perf_counter() - start
+        engine.dispose()
+    return elapsed
+
+
+@click.command()
+@click.option("--n-pages", type=int, default=100_000, help="Number of pages to insert")
+@click.option("--batch-size", type=int, default=1000, help="Pages per commit")
+@click.option("--frames-per-file", type=int, default=10, help="Frames per image file")
+def main(n_pages: int, batch_size: int, frames_per_file: int) -> None:
+    """Benchmark ORM vs bulk Page inserts."""
+    rows = _get_rows(n_pages, frames_per_file)
+    for name, insert_batch in _MODES.items():
+        elapsed = _run(insert_batch, rows, batch_size)
+        console.print(
+            f"[cyan]{name:>5}[/cyan]: {n_pages:,} pages in {elapsed:.2f}s "
+            f"([bold]{n_pages / elapsed:,.0f}[/bold] pages/s, "
+            f"{elapsed / n_pages * 1e6:.1f} µs/page)"
+        )
+
+
+if __name__ == "__main__":
+    main()
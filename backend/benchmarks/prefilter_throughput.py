@@ -0,0 +1,146 @@
+"""
+Benchmark the keyword prefilter's scoring throughput.
+
+Scores synthetic deed pages, some with OCR-garbled covenant terms, in batches as
+`rrc detect --prefilter-threshold` does, and reports pages per second. The terms found
+on each page are checked against a plain per-page, per-word implementation which
+compares every word with every term word, so the batched matching must find exactly
+the same terms.
+
+    uv run python benchmarks/prefilter_throughput.py --n-pages 20000 --batch-size 250
+"""
+
+import random
+import time
+
+import numpy as np
+from rich.console import Console
+
+import rrc.utils.click as click
+from rrc.inference.prefilter import (
+    _WORD_REGEX,
+    DEFAULT_TERMS,
+    KeywordPrefilter,
+    _fold,
+    _get_edit_distance,
+    _get_max_edits,
+)
+
+console = Console()
+
+_WORDS = (
+    "the grantor does hereby grant convey and warrant unto grantee all that certain "
+    "real property situated in county of santa clara state california described as "
+    "follows lot block tract map recorded book page official records together with "
+    "appurtenances thereto subject to conditions restrictions easements covenants "
+    "reservations rights of way record no part said premises shall ever be sold "
+    "leased rented or used by any person this deed dated day 1947 $10.00 rate "
+    "trace negotiate wright"
+).split()
+_COVENANT = (
+    "said premises shall not be used or occupied by any person of african japanese "
+    "chinese or mongolian descent or any negro or person not of the caucasian race"
+).split()
+
+
+def _garble(word: str, rng: random.Random) -> str:
+    """Misread one or two letters of a word, as OCR might."""
+    letters = list(word)
+    for _ in range(rng.randint(1, 2)):
+        i = rng.randrange(len(letters))
+        letters[i] = rng.choice("ce3il1o0s5gqxrn")
+    return "".join(letters)
+
+
+def _get_texts(n_pages: int, words_per_page: int, covenant_share: float) -> list[str]:
+    rng = random.Random(0)
+    texts = []
+    for _ in range(n_pages):
+        words = rng.choices(_WORDS, k=words_per_page)
+        if rng.random() < covenant_share:
+            start = rng.randrange(len(words))
+            words[start:start] = [
+                _garble(word, rng) if rng.random() < 0.3 else word for word in _COVENANT
+            ]
+        texts.append(" ".join(words).capitalize() + ".")
+    return texts
+
+
+def _get_reference_hits(prefilter: KeywordPrefilter, texts: list[str]) -> np.ndarray:
+    """Find the terms on each page one page and one word at a time."""
+    hits = np.zeros((len(texts), len(prefilter.terms)), dtype=bool)
+    for i, text in enumerate(texts):
+        page_words = [
+            {
+                term_word
+                for term_word in {w for term in prefilter.terms for w in term.split()}
+                if _get_edit_distance(_fold(word), _fold(term_word))
+                <= _get_max_edits(term_word)
+            }
+            for word in _WORD_REGEX.findall(text.lower())
+        ]
+        for j, term in enumerate(prefilter.terms):
+            words = term.split()
+            hits[i, j] = any(
+                all(word in page_words[start + k] for k, word in enumerate(words))
+                for start in range(len(page_words) - len(words) + 1)
+            )
+    return hits
+
+
+@click.command()
+@click.option("--n-pages", type=int, default=20_000, help="Number of pages to score")
+@click.option("--words-per-page", type=int, default=400, help="Words per page")
+@click.option("--batch-size", type=int, default=250, help="Pages per score call")
+@click.option(
+    "--covenant-share",
+    type=float,
+    default=0.05,
+    help="Share of pages with (partly garbled) covenant language",
+)
+@click.option(
+    "--n-checked", type=int, default=500, help="Pages to check against the reference"
+)
+def main(
+    n_pages: int,
+    words_per_page: int,
+    batch_size: int,
+    covenant_share: float,
+    n_checked: int,
+) -> None:
+    """Benchmark keyword prefilter scoring, and check the terms it finds."""
+    texts = _get_texts(n_pages, words_per_page, covenant_share)
+    prefilter = KeywordPrefilter(DEFAULT_TERMS)
+
+    # The first pass matches each distinct word; later ones find it in the cache
+    for name in ("cold", "warm"):
+        start = time.perf_counter()
+        hits = np.concatenate(
+            [
+                prefilter.get_term_hits(texts[i : i + batch_size])
+                for i in range(0, n_pages, batch_size)
+            ]
+        )
+        elapsed = time.perf_counter() - start
+        console.print(
+            f"[cyan]{name}[/cyan]: {n_pages / elapsed:,.0f} pages/s "
+            f"({elapsed / n_pages * 1e6:.0f} µs/page, {hits.any(axis=1).sum():,} "
+            f"pages with terms)"
+        )
+
+    expected = _get_reference_hits(prefilter, texts[:n_checked])
+    mismatched = (hits[:n_checked] != expected).any(axis=1).sum()
+    if mismatched:
+        console.print(
+            f"[red]✗[/red] Terms differ from the reference for {mismatched:,} of "
+            f"{n_checked:,} pages"
+        )
+        raise SystemExit(1)
+    console.print(
+        f"[green]✓[/green] Terms match the reference for {n_checked:,} pages "
+        f"({expected.any(axis=1).sum():,} with terms)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark host-side prompt preparation for the Qwen detection model.
+
+Compares building each page's prompt as a string with the chat template, which vLLM
+then tokenizes in full (system message included), against building token ids from
+the pre-tokenized template and batch-tokenized documents, as `QwenInferenceService`
+does. Reports the time per 10,000 pages and checks that both give the same ids.
+
+Only the tokenizer is loaded, so this runs without a GPU.
+
+    uv run python benchmarks/prompt_prep.py --n-pages 10000 --words-per-page 400
+"""
+
+import random
+import time
+
+from rich.console import Console
+
+import rrc.utils.click as click
+from rrc.inference.detect_pending import DEFAULT_MODEL_NAME_OR_PATH
+from rrc.inference.service import _QWEN_SYSTEM_MESSAGE, QwenInferenceService
+from rrc.utils.types import InferenceInput
+
+console = Console()
+
+_WORDS = (
+    "the grantor does hereby grant convey and warrant unto grantee all that certain "
+    "real property situated in county of santa clara state california described as "
+    "follows lot block tract map recorded book page official records together with "
+    "appurtenances thereto subject to conditions restrictions easements covenants "
+    "reservations rights of way record no part said premises shall ever be sold "
+    "leased rented or occupied by any person this deed dated day 1947 $10.00"
+).split()
+
+
+def _get_texts(n_pages: int, words_per_page: int) -> list[str]:
+    rng = random.Random(0)
+    return [
+        " ".join(rng.choices(_WORDS, k=words_per_page)).capitalize() + "."
+        for _ in range(n_pages)
+    ]
+
+
+def _prepare_strings(
+    service: QwenInferenceService, texts: list[str]
+) -> list[list[int]]:
+    """Render each prompt with the chat template, and tokenize it as vLLM would."""
+    prompts = [
+        service.tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": _QWEN_SYSTEM_MESSAGE},
+                {"role": "user", "content": f"<document>{text}</document>"},
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        for text in texts
+    ]
+    return [service.tokenizer.encode(prompt) for prompt in prompts]
+
+
+def _prepare_token_ids(
+    service: QwenInferenceService, texts: list[str]
+) -> list[list[int]]:
+    prompts = service._get_qwen_prompts([InferenceInput(text=text) for text in texts])
+    return [prompt["prompt_token_ids"] for prompt in prompts]
+
+
+@click.command()
+@click.option(
+    "-m",
+    "--model-name-or-path",
+    default=DEFAULT_MODEL_NAME_OR_PATH,
+    help="Model whose tokenizer to use",
+)
+@click.option("--n-pages", type=int, default=10_000, help="Number of pages to prepare")
+@click.option("--words-per-page", type=int, default=400, help="Words per page")
+@click.option("--batch-size", type=int, default=250, help="Pages per predict call")
+def main(
+    model_name_or_path: str, n_pages: int, words_per_page: int, batch_size: int
+) -> None:
+    """Benchmark building Qwen prompts as strings vs token ids."""
+    service = QwenInferenceService({"model_name_or_path": model_name_or_path})
+    service.load_tokenizer()
+    texts = _get_texts(n_pages, words_per_page)
+
+    ids = {}
+    for name, prepare in (
+        ("strings", _prepare_strings),
+        ("token ids", _prepare_token_ids),
+    ):
+        start = time.perf_counter()
+        ids[name] = [
+            prompt_ids
+            for i in range(0, n_pages, batch_size)
+            for prompt_ids in prepare(service, texts[i : i + batch_size])
+        ]
+        elapsed = time.perf_counter() - start
+        console.print(
+            f"[cyan]{name:>9}[/cyan]: {elapsed / n_pages * 10_000:.2f}s per 10k pages "
+            f"({elapsed / n_pages * 1e6:.0f} µs/page)"
+        )
+
+    mismatched = sum(a != b for a, b in zip(*ids.values(), strict=True))
+    if mismatched:
+        console.print(
+            f"[red]✗[/red] Token ids differ from the tokenized string for "
+            f"{mismatched:,} pages"
+        )
+    else:
+        console.print("[green]✓[/green] Token ids match the tokenized strings")
+
+
+if __name__ == "__main__":
+    main()
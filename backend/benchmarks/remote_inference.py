@@ -0,0 +1,264 @@
+"""
+Check and benchmark `OpenAIInferenceService` against a local stub of an
+OpenAI-compatible completions server.
+
+The stub stands in for `vllm serve`: it decodes each prompt, answers positive if the
+document mentions a restricted race, and returns the answer token's top logprobs at
+the position the Qwen model gives its answer, as "token_id:N" strings if asked to
+(as `vllm serve` does) unless `--text-tokens` is passed. It waits `--latency-ms` per request and
+fails a share of them with 503, so this shows how throughput scales with
+`max_concurrency`, that connections are reused, and that failed requests are
+retried. Each run's results are checked against the stub's answers.
+
+Only the tokenizer is loaded, so this runs without a GPU.
+
+    uv run python benchmarks/remote_inference.py --n-pages 2000 --latency-ms 50
+"""
+
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rich.console import Console
+
+import rrc.utils.click as click
+from rrc.inference.detect_pending import DEFAULT_MODEL_NAME_OR_PATH
+from rrc.inference.service import (
+    _QWEN_ANSWER_TOKEN_INDEX,
+    _QWEN_ANSWER_TOKEN_MAP,
+    OpenAIInferenceService,
+)
+from rrc.utils.types import InferenceFailure, InferenceInput, InferenceResult
+
+console = Console()
+
+_WORDS = (
+    "the grantor does hereby grant convey and warrant unto grantee all that certain "
+    "real property situated in county of santa clara state california described as "
+    "follows lot block tract map recorded book page official records together with "
+    "appurtenances thereto subject to conditions restrictions easements covenants "
+    "reservations rights of way record"
+).split()
+_COVENANT = "no part of said premises shall ever be occupied by any person not of the caucasian race"
+_COVENANT_KEYWORD = "caucasian"
+# Probability the stub gives its answer
+_ANSWER_PROB = 0.99
+
+
+def _get_texts(n_pages: int, words_per_page: int) -> list[str]:
+    rng = random.Random(0)
+    texts = []
+    for i in range(n_pages):
+        words = rng.choices(_WORDS, k=words_per_page)
+        if i % 10 == 0:
+            words.insert(rng.randrange(len(words)), _COVENANT)
+        texts.append(" ".join(words).capitalize() + ".")
+    return texts
+
+
+class _StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+
+
+def _make_handler(
+    tokenizer,
+    latency_seconds: float,
+    error_rate: float,
+    text_tokens: bool,
+    stats: _StubStats,
+) -> type[BaseHTTPRequestHandler]:
+    rng = random.Random(0)
+    space_id = tokenizer.encode(" ", add_special_tokens=False)[0]
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep connections alive between requests, as a real server would
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with stats.lock:
+                stats.connections += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):  # noqa: N802
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(latency_seconds)
+            with stats.lock:
+                stats.requests += 1
+                fail = rng.random() < error_rate
+                stats.errors += fail
+            if fail:
+                self._send(503, {"error": "overloaded"})
+                return
+
+            answer = _COVENANT_KEYWORD in tokenizer.decode(body["prompt"])
+            as_ids = body.get("return_tokens_as_token_ids") and not text_tokens
+
+            def get_token(token_id: int) -> str:
+                return (
+                    f"token_id:{token_id}" if as_ids else tokenizer.decode([token_id])
+                )
+
+            answer_tokens = {
+                answer: get_token(token_id)
+                for answer, token_id in _QWEN_ANSWER_TOKEN_MAP.items()
+            }
+            text = json.dumps(
+                {"answer": answer, "quotation": _COVENANT if answer else None}
+            )
+            # The answer token goes where the model gives it; the tokens before it
+            # only need to be there
+            tokens = [get_token(space_id)] * _QWEN_ANSWER_TOKEN_INDEX + [
+                answer_tokens[answer]
+            ]
+            top_logprobs = [{token: 0.0} for token in tokens]
+            top_logprobs[_QWEN_ANSWER_TOKEN_INDEX] = {
+                answer_tokens[answer]: math.log(_ANSWER_PROB),
+                answer_tokens[not answer]: math.log(1 - _ANSWER_PROB),
+            }
+            n_tokens = min(body["max_tokens"], len(tokens))
+            self._send(
+                200,
+                {
+                    "choices": [
+                        {
+                            "index": 0,
+                            "text": text
+                            if body["max_tokens"] > _QWEN_ANSWER_TOKEN_INDEX + 1
+                            else text[:16],
+                            "logprobs": {
+                                "tokens": tokens[:n_tokens],
+                                "token_logprobs": [0.0] * n_tokens,
+                                "top_logprobs": top_logprobs[:n_tokens],
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ]
+                },
+            )
+
+        def _send(self, status: int, content: dict) -> None:
+            data = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def _count_errors(
+    texts: list[str], results: list[InferenceResult | InferenceFailure]
+) -> tuple[int, int]:
+    """Count results which failed, and which differ from the stub's answers."""
+    failed = wrong = 0
+    for text, result in zip(texts, results, strict=True):
+        if isinstance(result, InferenceFailure):
+            failed += 1
+        elif result.answer != (_COVENANT_KEYWORD in text) or result.confidence is None:
+            wrong += 1
+    return failed, wrong
+
+
+@click.command()
+@click.option(
+    "-m",
+    "--model-name-or-path",
+    default=DEFAULT_MODEL_NAME_OR_PATH,
+    help="Model whose tokenizer to use",
+)
+@click.option("--n-pages", type=int, default=2000, help="Number of pages to classify")
+@click.option("--words-per-page", type=int, default=200, help="Words per page")
+@click.option(
+    "--latency-ms", type=float, default=50, help="Time the stub takes per request"
+)
+@click.option(
+    "--error-rate", type=float, default=0.05, help="Share of requests to fail with 503"
+)
+@click.option(
+    "--concurrency",
+    type=int,
+    multiple=True,
+    default=(1, 8, 32),
+    help="max_concurrency values to run with",
+)
+@click.option(
+    "--answer-first", is_flag=True, default=False, help="Use the answer_first option"
+)
+@click.option(
+    "--text-tokens",
+    is_flag=True,
+    default=False,
+    help="Give logprob tokens as text, like servers without vLLM's "
+    "return_tokens_as_token_ids",
+)
+def main(
+    model_name_or_path: str,
+    n_pages: int,
+    words_per_page: int,
+    latency_ms: float,
+    error_rate: float,
+    concurrency: tuple[int, ...],
+    answer_first: bool,
+    text_tokens: bool,
+) -> None:
+    """Benchmark the remote inference service against a stub server."""
+    texts = _get_texts(n_pages, words_per_page)
+    inputs = [InferenceInput(text=text) for text in texts]
+
+    for max_concurrency in concurrency:
+        service = OpenAIInferenceService(
+            {
+                "model_name_or_path": model_name_or_path,
+                "api_base_url": "http://127.0.0.1:0/v1",
+                "max_concurrency": max_concurrency,
+                "answer_first": answer_first,
+            }
+        )
+        service.load_tokenizer()
+        stats = _StubStats()
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0),
+            _make_handler(
+                service.tokenizer, latency_ms / 1000, error_rate, text_tokens, stats
+            ),
+        )
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        service.api_base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+        with service:
+            start = time.perf_counter()
+            results = service.predict(inputs)
+            elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+
+        failed, wrong = _count_errors(texts, results)
+        console.print(
+            f"[cyan]concurrency {max_concurrency:>3}[/cyan]: {n_pages / elapsed:,.0f} "
+            f"pages/s ({elapsed:.1f}s), {stats.requests:,} requests "
+            f"({stats.errors:,} failed and retried) over {stats.connections:,} "
+            f"connections"
+        )
+        if failed or wrong:
+            console.print(
+                f"[red]✗[/red] {failed:,} pages failed and {wrong:,} got the wrong "
+                f"answer or no confidence"
+            )
+        else:
+            console.print("[green]✓[/green] All pages match the stub's answers")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Benchmark SQLite commit latency and concurrent reads with and without the tuned profile.
+
+A writer process replays `rrc detect`'s database work on a throwaway database: claim a
+batch, insert its predictions and complete it in one commit. Meanwhile reader
+processes loop over `rrc summarize`'s progress queries. For each profile this reports
+the writer's per-batch commit latency and the readers' query latency and errors.
+
+    uv run python benchmarks/sqlite_profile.py --n-pages 200000 --readers 2
+
+With `--watch`, only the readers run, against an existing database. Point it at the
+pipeline database while `rrc detect` is running to see how a live run affects readers.
+
+    uv run python benchmarks/sqlite_profile.py --watch /data/output/rrc.db
+"""
+
+import multiprocessing
+import statistics
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+import sqlalchemy as sa
+from rich.console import Console
+from rich.table import Table
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+import rrc.db.sqlite
+import rrc.utils.click as click
+from rrc.db import stages
+from rrc.db.models import Base, CovenantPrediction, Page, Provenance, Transcription
+
+console = Console()
+
+_PROFILES: dict[str, Callable[[Path], sa.Engine]] = {
+    "default": lambda path: sa.create_engine(f"sqlite:///{path}"),
+    "tuned": rrc.db.sqlite.create_engine,
+}
+
+
+def _setup(engine: sa.Engine, n_pages: int) -> None:
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        provenance = Provenance(
+            model_name="bench", record_type="transcriptions", creator="bench"
+        )
+        session.add(provenance)
+        session.flush()
+        page_ids = list(
+            session.scalars(
+                sa.insert(Page).returning(Page.id),
+                [{"image_path": f"/data/images/{i:08d}.png"} for i in range(n_pages)],
+            )
+        )
+        session.execute(
+            sa.insert(Transcription),
+            [
+                {
+                    "page_id": page_id,
+                    "provenance_id": provenance.id,
+                    "text": "lorem ipsum " * 100,
+                }
+                for page_id in page_ids
+            ],
+        )
+        stages.add_pending(session, stages.DETECT, page_ids)
+        session.commit()
+
+
+def _write(
+    profile: str, db_path: Path, batch_size: int, n_batches: int, results
+) -> None:
+    engine = _PROFILES[profile](db_path)
+    owner = stages.get_worker_id()
+    latencies = []
+    errors = 0
+    with Session(engine) as session:
+        provenance_id = session.scalar(sa.select(sa.func.min(Provenance.id)))
+        for _ in range(n_batches):
+            start = time.perf_counter()
+            try:
+                if not _write_batch(session, batch_size, owner, provenance_id):
+                    break
+            except OperationalError:
+                session.rollback()
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+    engine.dispose()
+    results.put(("writer", latencies, errors))
+
+
+def _write_batch(
+    session: Session, batch_size: int, owner: str, provenance_id: int
+) -> bool:
+    page_ids = stages.claim_batch(session, stages.DETECT, batch_size, owner)
+    if not page_ids:
+        return False
+    transcription_ids = dict(
+        session.execute(
+            sa.select(Transcription.page_id, Transcription.id).where(
+                Transcription.page_id.in_(page_ids)
+            )
+        )
+        .tuples()
+        .all()
+    )
+    done_ids = stages.complete(session, stages.DETECT, page_ids, owner)
+    session.execute(
+        sa.insert(CovenantPrediction),
+        [
+            {
+                "page_id": page_id,
+                "transcription_id": transcription_ids[page_id],
+                "provenance_id": provenance_id,
+                "answer": False,
+                "confidence": 0.01,
+            }
+            for page_id in sorted(done_ids)
+        ],
+    )
+    session.commit()
+    return True
+
+
+def _read(profile: str, db_path: Path, stop, results) -> None:
+    engine = _PROFILES[profile](db_path)
+    latencies = []
+    errors = 0
+    queries = [
+        sa.select(sa.func.count(Page.id)),
+        sa.select(sa.func.count(sa.func.distinct(Transcription.page_id))),
+        sa.select(sa.func.count(sa.func.distinct(CovenantPrediction.page_id))),
+    ]
+    with Session(engine) as session:
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                for query in queries:
+                    session.scalar(query)
+                session.rollback()
+            except OperationalError:
+                session.rollback()
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+    engine.dispose()
+    results.put(("reader", latencies, errors))
+
+
+def _run_readers(
+    context, profile: str, db_path: Path, n_readers: int, results
+) -> tuple[list, Any]:
+    stop = context.Event()
+    readers = [
+        context.Process(target=_read, args=(profile, db_path, stop, results))
+        for _ in range(n_readers)
+    ]
+    for reader in readers:
+        reader.start()
+    return readers, stop
+
+
+def _format_latencies(latencies: list[float]) -> str:
+    if not latencies:
+        return "-"
+    if len(latencies) == 1:
+        return f"{latencies[0] * 1000:.1f}"
+    q = statistics.quantiles(latencies, n=100)
+    return f"{q[49] * 1000:.1f} / {q[94] * 1000:.1f} / {max(latencies) * 1000:.1f}"
+
+
+@click.command()
+@click.option("--n-pages", type=int, default=100_000, help="Number of pages to queue")
+@click.option("--batch-size", type=int, default=250, help="Pages per detect batch")
+@click.option("--n-batches", type=int, default=200, help="Batches to commit")
+@click.option("--readers", type=int, default=2, help="Concurrent reader processes")
+@click.option(
+    "--watch",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Only run readers against this database (e.g. during a live `rrc detect`)",
+)
+@click.option("--duration", type=float, default=30, help="Seconds to watch for")
+def main(
+    n_pages: int,
+    batch_size: int,
+    n_batches: int,
+    readers: int,
+    watch: Path | None,
+    duration: float,
+) -> None:
+    """Benchmark commit latency and concurrent reads for each SQLite profile."""
+    context = multiprocessing.get_context("spawn")
+    table = Table(title="Latency in ms (p50 / p95 / max)")
+    table.add_column("Profile")
+    table.add_column("Role")
+    table.add_column("Operations", justify="right")
+    table.add_column("Latency", justify="right")
+    table.add_column("Errors", justify="right")
+
+    if watch is not None:
+        results = context.Queue()
+        processes, stop = _run_readers(context, "tuned", watch, readers, results)
+        time.sleep(duration)
+        stop.set()
+        for role, latencies, errors in (results.get() for _ in processes):
+            table.add_row(
+                "tuned",
+                role,
+                str(len(latencies)),
+                _format_latencies(latencies),
+                str(errors),
+            )
+        for process in processes:
+            process.join()
+        console.print(table)
+        return
+
+    for profile, create_engine in _PROFILES.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = Path(tmp_dir) / "bench.db"
+            engine = create_engine(db_path)
+            _setup(engine, n_pages)
+            engine.dispose()
+
+            results = context.Queue()
+            processes, stop = _run_readers(context, profile, db_path, readers, results)
+            writer = context.Process(
+                target=_write,
+                args=(profile, db_path, batch_size, n_batches, results),
+            )
+            writer.start()
+            writer_result = results.get()
+            stop.set()
+            reader_results = [results.get() for _ in processes]
+            for process in [writer, *processes]:
+                process.join()
+
+        writer_latencies = writer_result[1]
+        reader_latencies = [lat for _, lats, _ in reader_results for lat in lats]
+        reader_errors = sum(errors for _, _, errors in reader_results)
+        table.add_row(
+            profile,
+            "detect commits",
+            str(len(writer_latencies)),
+            _format_latencies(writer_latencies),
+            str(writer_result[2]),
+        )
+        table.add_row(
+            profile,
+            "summarize reads",
+            str(len(reader_latencies)),
+            _format_latencies(reader_latencies),
+            str(reader_errors),
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,10 @@ from rrc.inference.detect_pending import main as detect_cmd
 from rrc.ingest.ingest_directory import main as ingest_cmd
 from rrc.ocr.transcribe_pending import main as ocr_cmd
 from rrc.reporting.export_predictions import main as export_cmd
+from rrc.reporting.failed_pages import main as failed_cmd
+from rrc.reporting.prefilter_report import main as prefilter_report_cmd
 from rrc.reporting.summarize_db import main as summarize_cmd
+from rrc.serve.server import main as serve_cmd
 
 
 @click.group()
@@ -27,6 +30,9 @@ cli.add_command(ocr_cmd, name="ocr")
 cli.add_command(detect_cmd, name="detect")
 cli.add_command(export_cmd, name="export")
 cli.add_command(summarize_cmd, name="summarize")
+cli.add_command(prefilter_report_cmd, name="prefilter-report")
+cli.add_command(failed_cmd, name="failed")
+cli.add_command(serve_cmd, name="serve")
 
 # Update the help text for each command to add emojis
 ingest_cmd.help = ingest_cmd.help or "Ingest images from a directory into the database"
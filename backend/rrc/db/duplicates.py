@@ -0,0 +1,50 @@
+"""
+Reuse of outputs across duplicate scans.
+
+Pages with the same `Page.content_hash` are duplicate scans (see
+`rrc.ingest.ingest_directory`), so each stage runs on only one page per hash and copies
+its output to the others, and to duplicates ingested later.
+"""
+
+from collections.abc import Iterable
+from typing import TypeVar
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from rrc.db.models import CovenantPrediction, Page, Transcription
+
+_Output = TypeVar("_Output", Transcription, CovenantPrediction)
+
+
+def get_reusable_outputs(
+    session: Session, pages: list[Page], model: type[_Output]
+) -> dict[str, _Output]:
+    """Get the newest existing output for duplicates of these pages, by content hash."""
+    hashes = {page.content_hash for page in pages if page.content_hash is not None}
+    if not hashes:
+        return {}
+    stmt = (
+        select(Page.content_hash, model)
+        .join(model.page)
+        .where(Page.content_hash.in_(hashes))
+        .order_by(model.id)
+    )
+    # Later rows replace earlier ones, so the newest output of each hash wins
+    return dict(session.execute(stmt).tuples().all())
+
+
+def get_canonical_pages(pages: list[Page], seen_hashes: Iterable[str]) -> list[Page]:
+    """
+    Get the pages a stage needs to run on: pages without a content hash, and the first
+    page of each hash not in `seen_hashes`.
+    """
+    seen_hashes = set(seen_hashes)
+    canonical_pages = []
+    for page in pages:
+        if page.content_hash is None:
+            canonical_pages.append(page)
+        elif page.content_hash not in seen_hashes:
+            seen_hashes.add(page.content_hash)
+            canonical_pages.append(page)
+    return canonical_pages
@@ -0,0 +1,120 @@
+"""
+Schema migrations for databases created by earlier versions of the pipeline.
+
+New databases are created directly from the models and stamped with the latest
+version. Existing databases get any new tables from `create_all` and then run every
+migration after their recorded version, in order. Migrations should be idempotent,
+since a table created by `create_all` already has every column.
+"""
+
+from collections.abc import Callable
+
+import sqlalchemy as sa
+
+from rrc.db import stages
+from rrc.db.models import (
+    Base,
+    CovenantPrediction,
+    Page,
+    SchemaVersion,
+    StageStatus,
+    Transcription,
+)
+from rrc.utils.logger import LOGGER
+
+
+def _add_column(conn: sa.Connection, table_name: str, column_name: str) -> None:
+    """Add a (nullable) column from the models to an existing table, with its indexes."""
+    table = Base.metadata.tables[table_name]
+    column = table.c[column_name]
+    existing_columns = {col["name"] for col in sa.inspect(conn).get_columns(table_name)}
+    if column_name in existing_columns:
+        return
+
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.execute(
+        sa.text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+    )
+    for index in table.indexes:
+        if column_name in index.columns:
+            index.create(conn, checkfirst=True)
+
+
+def _add_page_content_hash(conn: sa.Connection) -> None:
+    _add_column(conn, "pages", "content_hash")
+
+
+def _add_transcription_word_geometry(conn: sa.Connection) -> None:
+    _add_column(conn, "transcriptions", "word_geometry")
+
+
+def _add_stage_statuses(conn: sa.Connection) -> None:
+    """Backfill stage statuses from the transcriptions and predictions pages have."""
+    conn.execute(sa.delete(StageStatus))
+    has_transcription = sa.exists().where(Transcription.page_id == Page.id)
+    has_prediction = sa.exists().where(CovenantPrediction.page_id == Page.id)
+    columns = ["page_id", "stage", "state"]
+    conn.execute(
+        sa.insert(StageStatus).from_select(
+            columns,
+            sa.select(
+                Page.id,
+                sa.literal(stages.OCR),
+                sa.case((has_transcription, stages.DONE), else_=stages.PENDING),
+            ),
+        )
+    )
+    conn.execute(
+        sa.insert(StageStatus).from_select(
+            columns,
+            sa.select(
+                Page.id,
+                sa.literal(stages.DETECT),
+                sa.case((has_prediction, stages.DONE), else_=stages.PENDING),
+            ).where(has_transcription),
+        )
+    )
+
+
+def _add_stage_status_leases(conn: sa.Connection) -> None:
+    _add_column(conn, "stage_statuses", "lease_owner")
+    _add_column(conn, "stage_statuses", "lease_expires_at")
+
+
+def _add_stage_status_last_error(conn: sa.Connection) -> None:
+    _add_column(conn, "stage_statuses", "last_error")
+
+
+MIGRATIONS: list[Callable[[sa.Connection], None]] = [
+    _add_page_content_hash,
+    _add_transcription_word_geometry,
+    _add_stage_statuses,
+    _add_stage_status_leases,
+    _add_stage_status_last_error,
+]
+
+
+def _set_version(conn: sa.Connection, version: int) -> None:
+    conn.execute(sa.delete(SchemaVersion))
+    conn.execute(sa.insert(SchemaVersion).values(version=version))
+
+
+def stamp_latest(engine: sa.Engine) -> None:
+    """Mark a database freshly created from the models as fully migrated."""
+    with engine.begin() as conn:
+        _set_version(conn, len(MIGRATIONS))
+
+
+def migrate(engine: sa.Engine) -> None:
+    """Apply any migrations the database hasn't had yet."""
+    with engine.begin() as conn:
+        version = conn.scalar(sa.select(sa.func.max(SchemaVersion.version))) or 0
+        if version >= len(MIGRATIONS):
+            return
+        for idx in range(version, len(MIGRATIONS)):
+            migration = MIGRATIONS[idx]
+            LOGGER.info(
+                "Applying database migration %d (%s)", idx + 1, migration.__name__
+            )
+            migration(conn)
+        _set_version(conn, len(MIGRATIONS))
@@ -3,7 +3,8 @@ from __future__ import annotations
 import datetime
 from pathlib import Path
 
-from sqlalchemy import ForeignKey, func
+import numpy as np
+from sqlalchemy import BigInteger, ForeignKey, Index, func
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -11,6 +12,7 @@ from sqlalchemy.orm import (
     relationship,
 )
 
+from rrc.ocr.geometry import WordGeometry, locate_quotation
 from rrc.utils.types import InferenceInput, OCRInput
 
 
@@ -25,12 +27,23 @@ class TimestampMixin:
     )
 
 
+class SchemaVersion(Base):
+    """The latest migration applied to the database (see `rrc.db.migrations`)."""
+
+    __tablename__ = "schema_version"
+
+    version: Mapped[int] = mapped_column(primary_key=True)
+
+
 class Page(Base, TimestampMixin):
     __tablename__ = "pages"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     image_path: Mapped[str] = mapped_column(index=True)
     image_frame_idx: Mapped[int | None] = mapped_column()
+    content_hash: Mapped[str | None] = mapped_column(index=True)
+    """Hash of the image file, or of the frame's encoded data for TIFFs. Pages with the
+    same hash are duplicate scans, which are only transcribed and classified once."""
 
     transcriptions: Mapped[list[Transcription]] = relationship(back_populates="page")
     predictions: Mapped[list[CovenantPrediction]] = relationship(back_populates="page")
@@ -42,7 +55,33 @@ class Page(Base, TimestampMixin):
         return InferenceInput(image=Path(self.image_path).read_bytes())
 
     def as_ocr_input(self) -> OCRInput:
-        return OCRInput(image=Path(self.image_path).read_bytes())
+        return OCRInput(image_path=self.image_path, frame_idx=self.image_frame_idx)
+
+
+class StageStatus(Base, TimestampMixin):
+    """
+    A page's state in a pipeline stage (see `rrc.db.stages`).
+
+    Pages get a pending OCR status when ingested and a pending detection status when
+    transcribed, so each stage finds its pending pages with an index range scan rather
+    than an anti-join against its outputs.
+    """
+
+    __tablename__ = "stage_statuses"
+    __table_args__ = (
+        Index("ix_stage_statuses_stage_state_page_id", "stage", "state", "page_id"),
+    )
+
+    page_id: Mapped[int] = mapped_column(ForeignKey("pages.id"), primary_key=True)
+    stage: Mapped[str] = mapped_column(primary_key=True)
+    state: Mapped[str] = mapped_column()
+    attempts: Mapped[int] = mapped_column(default=0)
+    lease_owner: Mapped[str | None] = mapped_column()
+    """The worker which has claimed the page, while it is claimed."""
+    lease_expires_at: Mapped[datetime.datetime | None] = mapped_column()
+    """When the claim lapses and the page can be claimed by another worker (UTC)."""
+    last_error: Mapped[str | None] = mapped_column()
+    """Why the stage last failed on the page (e.g. "truncated"), if it has."""
 
 
 class Transcription(Base, TimestampMixin):
@@ -50,6 +89,9 @@ class Transcription(Base, TimestampMixin):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     text: Mapped[str] = mapped_column()
+    word_geometry: Mapped[bytes | None] = mapped_column()
+    """Character spans and page-relative boxes of each word in `text`, packed by
+    `rrc.ocr.geometry.WordGeometry.to_bytes`."""
 
     page_id: Mapped[int] = mapped_column(ForeignKey("pages.id"), index=True)
     provenance_id: Mapped[int] = mapped_column(ForeignKey("provenances.id"), index=True)
@@ -60,6 +102,11 @@ class Transcription(Base, TimestampMixin):
     )
     provenance: Mapped[Provenance] = relationship(back_populates="transcriptions")
 
+    def get_word_geometry(self) -> WordGeometry | None:
+        if self.word_geometry is None:
+            return None
+        return WordGeometry.from_bytes(self.word_geometry)
+
 
 class CovenantPrediction(Base, TimestampMixin):
     """A prediction of whether the page contains a racial covenant."""
@@ -84,6 +131,22 @@ class CovenantPrediction(Base, TimestampMixin):
     transcription: Mapped[Transcription] = relationship(back_populates="predictions")
     provenance: Mapped[Provenance] = relationship(back_populates="predictions")
 
+    def get_quotation_boxes(self) -> np.ndarray | None:
+        """
+        Get the boxes of the quotation's words on the page image.
+
+        Boxes are (x0, y0, x1, y1) rows relative to the page size. Returns None if there
+        is no quotation, the transcription has no word geometry, or the quotation can't
+        be found in the transcription.
+        """
+        quotation = self.quotation or self.raw_passage
+        if not quotation or self.transcription is None:
+            return None
+        geometry = self.transcription.get_word_geometry()
+        if geometry is None:
+            return None
+        return locate_quotation(self.transcription.text, geometry, quotation)
+
 
 class Provenance(Base, TimestampMixin):
     """
@@ -108,3 +171,36 @@ class Provenance(Base, TimestampMixin):
     transcriptions: Mapped[list[Transcription]] = relationship(
         back_populates="provenance"
     )
+
+
+class ManifestDirectory(Base, TimestampMixin):
+    """
+    A directory scanned by ingest.
+
+    If a directory's mtime is unchanged since it was last scanned, no entries have been
+    added, removed or renamed in it, so ingest can skip listing it and only descend into
+    its recorded subdirectories.
+    """
+
+    __tablename__ = "manifest_directories"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    path: Mapped[str] = mapped_column(unique=True)
+    parent_path: Mapped[str | None] = mapped_column(index=True)
+    mtime_ns: Mapped[int] = mapped_column(BigInteger)
+
+
+class ManifestFile(Base, TimestampMixin):
+    """
+    An image file seen by ingest, whether or not it could be ingested.
+
+    Files whose size and mtime match their manifest entry are not validated again.
+    """
+
+    __tablename__ = "manifest_files"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    path: Mapped[str] = mapped_column(unique=True)
+    directory_path: Mapped[str] = mapped_column(index=True)
+    size: Mapped[int] = mapped_column(BigInteger)
+    mtime_ns: Mapped[int] = mapped_column(BigInteger)
@@ -0,0 +1,50 @@
+"""
+Connection settings for the pipeline's SQLite database.
+
+SQLite's defaults (a rollback journal with a full fsync on every commit, no mmap and a
+2 MB page cache) suit small embedded databases. The pipeline commits a batch every
+few seconds into a database of millions of rows while other processes read it, so
+engines apply `SQLITE_PRAGMAS` to every new connection instead.
+"""
+
+from pathlib import Path
+from typing import Any
+
+import sqlalchemy as sa
+
+import rrc.utils.io
+
+SQLITE_PRAGMAS: dict[str, str | int] = {
+    # Readers (e.g. `rrc summarize`) don't block the writer or each other, and commits
+    # append to the log instead of rewriting pages. WAL needs shared memory between
+    # processes, so set RRC_SQLITE_JOURNAL_MODE=DELETE if the data directory is on a
+    # network filesystem.
+    "journal_mode": rrc.utils.io.getenv("RRC_SQLITE_JOURNAL_MODE", "WAL"),
+    # With WAL, only checkpoints fsync; a power loss can lose the last commits but not
+    # corrupt the database
+    "synchronous": "NORMAL",
+    "mmap_size": 1024 * 1024 * 1024,
+    # Negative sizes are in KiB
+    "cache_size": -64 * 1024,
+    # Wait for other writers (e.g. concurrent OCR and detect processes) rather than
+    # failing immediately
+    "busy_timeout": 30_000,
+    "temp_store": "MEMORY",
+}
+
+
+def set_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+    """Apply `SQLITE_PRAGMAS` to a new connection (a "connect" event listener)."""
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def create_engine(url: Path | str | sa.URL, **kwargs: Any) -> sa.Engine:
+    """Create an engine for a SQLite database file (given by its path or URL)."""
+    if isinstance(url, Path):
+        url = f"sqlite:///{url}"
+    engine = sa.create_engine(url, **kwargs)
+    sa.event.listen(engine, "connect", set_pragmas)
+    return engine
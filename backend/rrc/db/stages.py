@@ -0,0 +1,280 @@
+"""
+Per-page status of each pipeline stage, used as the stages' work queues.
+
+Each stage's pending pages are the `StageStatus` rows with its name and the pending
+state. The composite (stage, state, page_id) index makes counting them and claiming
+the next batch in page order index range scans, however many pages are done.
+
+Workers claim batches by atomically moving them from pending to claimed under a lease,
+so several processes (on one or more machines) can share a database without
+duplicating work. A worker completes the pages it still holds the lease on; if it
+crashes, its lease expires and the pages return to the queue.
+
+A worker which fails on a page records why and returns it to the queue, until it has
+been attempted `max_attempts` times. Then it is set aside in the failed state (a
+dead letter) until requeued by hand, rather than costing every later run a retry.
+Expired leases count as failures too, so a page which crashes or hangs every worker
+that claims it is set aside the same way.
+"""
+
+import datetime
+import os
+import socket
+import time
+from collections.abc import Collection, Iterable
+
+from sqlalchemy import case, func, insert, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from rrc.db.models import StageStatus
+from rrc.utils.logger import LOGGER
+
+OCR = "ocr"
+DETECT = "detect"
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+# Recorded as the error of pages whose worker crashed or hung before releasing them
+LEASE_EXPIRED = "lease_expired"
+
+DEFAULT_LEASE_SECONDS = 1800
+DEFAULT_MAX_ATTEMPTS = 3
+
+_CLAIM_RETRIES = 10
+_CLAIM_RETRY_DELAY = 0.1
+
+
+def get_worker_id() -> str:
+    """Get an identifier for this process, to record as the owner of its leases."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def add_pending(session: Session, stage: str, page_ids: Iterable[int]) -> None:
+    """Queue pages for a stage."""
+    rows = [
+        {"page_id": page_id, "stage": stage, "state": PENDING} for page_id in page_ids
+    ]
+    if rows:
+        session.execute(insert(StageStatus), rows)
+
+
+def get_pending_count(session: Session, stage: str) -> int:
+    stmt = (
+        select(func.count())
+        .select_from(StageStatus)
+        .where(StageStatus.stage == stage, StageStatus.state == PENDING)
+    )
+    return session.scalar(stmt) or 0
+
+
+def claim_batch(
+    session: Session,
+    stage: str,
+    batch_size: int,
+    owner: str,
+    lease_seconds: int = DEFAULT_LEASE_SECONDS,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    exclude: Collection[int] = (),
+) -> list[int]:
+    """
+    Claim up to `batch_size` pending pages of a stage for `owner`, and commit.
+
+    Pages in `exclude` are left in the queue. Workers pass the pages they have failed
+    on, so those are retried by a later run rather than straight away (outputs are
+    deterministic, so an immediate retry would fail the same way).
+
+    Expired leases are released first, as failures with the "lease_expired" error:
+    their pages return to the queue, or are marked failed once they have had
+    `max_attempts` attempts. The claim is a single UPDATE (on Postgres, after
+    locking the batch with `SELECT ... FOR UPDATE SKIP LOCKED`), so concurrent workers
+    never claim the same page; if a SQLite database is locked by another writer, the claim is
+    retried.
+
+    Returns:
+        The ids of the claimed pages, in order.
+    """
+    for attempt in range(_CLAIM_RETRIES):
+        try:
+            page_ids = _claim_batch(
+                session, stage, batch_size, owner, lease_seconds, max_attempts, exclude
+            )
+            session.commit()
+            return page_ids
+        except OperationalError as e:
+            session.rollback()
+            if "locked" not in str(e.orig) or attempt == _CLAIM_RETRIES - 1:
+                raise
+            LOGGER.debug("Database locked while claiming, retrying")
+            time.sleep(_CLAIM_RETRY_DELAY * (attempt + 1))
+    return []
+
+
+def _claim_batch(
+    session: Session,
+    stage: str,
+    batch_size: int,
+    owner: str,
+    lease_seconds: int,
+    max_attempts: int,
+    exclude: Collection[int],
+) -> list[int]:
+    now = _utcnow()
+    session.execute(
+        update(StageStatus)
+        .where(
+            StageStatus.stage == stage,
+            StageStatus.state == CLAIMED,
+            StageStatus.lease_expires_at < now,
+        )
+        .values(
+            state=case((StageStatus.attempts >= max_attempts, FAILED), else_=PENDING),
+            lease_owner=None,
+            lease_expires_at=None,
+            last_error=LEASE_EXPIRED,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    candidates = (
+        select(StageStatus.page_id)
+        .where(StageStatus.stage == stage, StageStatus.state == PENDING)
+        .order_by(StageStatus.page_id)
+        .limit(batch_size)
+    )
+    if exclude:
+        candidates = candidates.where(StageStatus.page_id.not_in(list(exclude)))
+    # SQLite serializes writers, so there a single statement claims the batch
+    claimed = StageStatus.page_id.in_(candidates)
+    if session.get_bind().dialect.name == "postgresql":
+        # Lock the batch first, skipping rows another worker is claiming rather than
+        # waiting for it. Inside `IN (...)` Postgres plans the locking subquery as a
+        # semi-join which it may rescan, so concurrent claims end up waiting on each
+        # other's rows
+        page_ids = list(session.scalars(candidates.with_for_update(skip_locked=True)))
+        if not page_ids:
+            return []
+        claimed = StageStatus.page_id.in_(page_ids)
+    stmt = (
+        update(StageStatus)
+        .where(
+            StageStatus.stage == stage,
+            StageStatus.state == PENDING,
+            claimed,
+        )
+        .values(
+            state=CLAIMED,
+            lease_owner=owner,
+            lease_expires_at=now + datetime.timedelta(seconds=lease_seconds),
+            attempts=StageStatus.attempts + 1,
+        )
+        .returning(StageStatus.page_id)
+        .execution_options(synchronize_session=False)
+    )
+    return sorted(session.scalars(stmt))
+
+
+def complete(
+    session: Session, stage: str, page_ids: Iterable[int], owner: str
+) -> set[int]:
+    """
+    Mark claimed pages as done, as part of the transaction saving their outputs.
+
+    Returns:
+        The ids of the pages `owner` still held the lease on. Any others were
+        reclaimed by another worker after the lease expired, so their outputs should
+        not be saved.
+    """
+    page_ids = list(page_ids)
+    if not page_ids:
+        return set()
+    stmt = (
+        update(StageStatus)
+        .where(
+            StageStatus.stage == stage,
+            StageStatus.page_id.in_(page_ids),
+            StageStatus.state == CLAIMED,
+            StageStatus.lease_owner == owner,
+        )
+        .values(state=DONE, lease_owner=None, lease_expires_at=None)
+        .returning(StageStatus.page_id)
+        .execution_options(synchronize_session=False)
+    )
+    return set(session.scalars(stmt))
+
+
+def fail(
+    session: Session,
+    stage: str,
+    page_errors: dict[int, str],
+    owner: str,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+) -> set[int]:
+    """
+    Record why claimed pages failed and release them, as part of a transaction.
+
+    Pages which have had `max_attempts` attempts are marked failed; the rest return
+    to the queue. Pages `owner` no longer holds the lease on are left alone.
+
+    Returns:
+        The ids of the pages marked failed.
+    """
+    failed_ids: set[int] = set()
+    owned = (
+        StageStatus.stage == stage,
+        StageStatus.state == CLAIMED,
+        StageStatus.lease_owner == owner,
+    )
+    for error, page_ids in _group_by_value(page_errors).items():
+        stmt = (
+            update(StageStatus)
+            .where(*owned, StageStatus.page_id.in_(page_ids))
+            .values(
+                state=case(
+                    (StageStatus.attempts >= max_attempts, FAILED), else_=PENDING
+                ),
+                lease_owner=None,
+                lease_expires_at=None,
+                last_error=error,
+            )
+            .returning(StageStatus.page_id, StageStatus.state)
+            .execution_options(synchronize_session=False)
+        )
+        failed_ids.update(
+            page_id for page_id, state in session.execute(stmt) if state == FAILED
+        )
+    return failed_ids
+
+
+def requeue_failed(
+    session: Session, stage: str, page_ids: Iterable[int] | None = None
+) -> int:
+    """
+    Return failed pages (all of them, or just `page_ids`) to the queue with a fresh
+    set of attempts. Does not commit.
+
+    Returns:
+        The number of pages requeued.
+    """
+    stmt = (
+        update(StageStatus)
+        .where(StageStatus.stage == stage, StageStatus.state == FAILED)
+        .values(state=PENDING, attempts=0)
+        .execution_options(synchronize_session=False)
+    )
+    if page_ids is not None:
+        stmt = stmt.where(StageStatus.page_id.in_(list(page_ids)))
+    return session.execute(stmt).rowcount
+
+
+def _group_by_value(mapping: dict[int, str]) -> dict[str, list[int]]:
+    groups: dict[str, list[int]] = {}
+    for key, value in mapping.items():
+        groups.setdefault(value, []).append(key)
+    return groups
+
+
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
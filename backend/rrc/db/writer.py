@@ -0,0 +1,116 @@
+import queue
+import threading
+from collections.abc import Callable
+from typing import Generic, TypeVar
+
+from sqlalchemy.orm import Session
+
+from rrc.db.session import get_session
+from rrc.utils.logger import LOGGER
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+DEFAULT_MAX_PENDING = 2
+# How often a blocked `submit` or exit checks whether the writer thread has died
+_POLL_SECONDS = 0.5
+
+
+class _Stop:
+    pass
+
+
+class BackgroundWriter(Generic[T, R]):
+    """Write batches of results to the database on a background thread.
+
+    The thread has its own session. `submit` queues a batch for `write(session, batch)`,
+    which must commit it, and only blocks once `max_pending` batches are waiting, so the
+    model can start on the next batch while the last one is written. `on_written(batch,
+    result)` is called on the writer thread once a batch is committed, so progress only
+    counts pages that are in the database. With `merge`, batches which queued up while
+    the last write ran are merged into one and written together.
+
+    Used as a context manager, exiting writes all submitted batches before returning
+    (including when exiting with an error). If a write fails, later batches are dropped
+    and the error is raised from the next `submit` or on exit; the dropped batches' pages
+    stay claimed until their leases expire, like those of a crashed worker. The same
+    goes if the thread itself dies (e.g. `merge` fails): `submit` and exit stop waiting
+    on its queue and raise its error.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[Session, T], R],
+        *,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        on_written: Callable[[T, R], None] | None = None,
+        merge: Callable[[list[T]], T] | None = None,
+    ):
+        self.write = write
+        self.on_written = on_written
+        self.merge = merge
+        self._queue: queue.Queue[T | _Stop] = queue.Queue(maxsize=max(max_pending, 1))
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._run, name="db-writer")
+
+    def __enter__(self) -> "BackgroundWriter[T, R]":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._put(_Stop())
+        self._thread.join()
+        if self._error is not None and self._error is not exc_value:
+            if exc_type is None:
+                raise self._error
+            LOGGER.error("Failed to write results: %s", self._error)
+
+    def submit(self, batch: T) -> None:
+        if self._error is None and self._put(batch):
+            return
+        raise self._error or RuntimeError("The database writer thread has stopped")
+
+    def _put(self, item: T | _Stop) -> bool:
+        """Queue an item, or give up and return False once the writer thread dies."""
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self) -> None:
+        try:
+            self._write_batches()
+        except BaseException as e:
+            # Keep the first error; the thread has died and nothing more is written
+            if self._error is None:
+                self._error = e
+
+    def _write_batches(self) -> None:
+        session = get_session()
+        try:
+            stopping = False
+            while not stopping and not isinstance(batch := self._queue.get(), _Stop):
+                if self.merge is not None:
+                    batches = [batch]
+                    while not self._queue.empty():
+                        if isinstance(item := self._queue.get(), _Stop):
+                            stopping = True
+                            break
+                        batches.append(item)
+                    if len(batches) > 1:
+                        batch = self.merge(batches)
+                # Keep draining after a failure so `submit` never blocks on a full queue
+                if self._error is not None:
+                    continue
+                try:
+                    result = self.write(session, batch)
+                    if self.on_written is not None:
+                        self.on_written(batch, result)
+                except BaseException as e:
+                    session.rollback()
+                    self._error = e
+        finally:
+            session.close()
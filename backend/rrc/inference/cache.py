@@ -0,0 +1,255 @@
+"""
+An on-disk cache of model predictions, shared across runs and processes.
+
+The same text recurs across a collection (boilerplate deeds, rescans which don't hash
+the same, re-runs after the database is rebuilt), so predictions are cached by a hash
+of the normalized text together with everything else which determines the output:
+the service's model, prompt and sampling parameters (its cache namespace). The cache
+is a SQLite file in the data directory; once it outgrows its size limit, the least
+recently used entries are evicted.
+"""
+
+import asyncio
+import hashlib
+import time
+from pathlib import Path
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+import rrc.db.sqlite
+import rrc.utils.io
+from rrc.db.models import Provenance
+from rrc.inference.service import InferenceService
+from rrc.utils.types import InferenceFailure, InferenceInput, InferenceResult
+
+DEFAULT_CACHE_PATH = rrc.utils.io.get_data_path("prediction_cache.db")
+DEFAULT_MAX_CACHE_MB = 1024
+
+# Evict down to this fraction of the limit, so eviction doesn't run on every write
+_EVICT_TO = 0.9
+_QUERY_CHUNK_SIZE = 500
+
+_metadata = sa.MetaData()
+_entries = sa.Table(
+    "entries",
+    _metadata,
+    sa.Column("key", sa.LargeBinary, primary_key=True),
+    sa.Column("result", sa.Text, nullable=False),
+    sa.Column("size", sa.Integer, nullable=False),
+    sa.Column("last_used", sa.Float, nullable=False, index=True),
+)
+_totals = sa.Table(
+    "totals",
+    _metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("size", sa.BigInteger, nullable=False),
+)
+
+
+def get_cache_key(namespace: str, text: str) -> bytes:
+    """Get the cache key for a document, ignoring differences in whitespace."""
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{namespace}\0{normalized}".encode()).digest()
+
+
+class PredictionCache:
+    """
+    Cached predictions by key, evicting the least recently used past `max_bytes`.
+
+    Counts hits and misses for reporting.
+    """
+
+    path: Path
+    max_bytes: int
+    hits: int
+    misses: int
+
+    def __init__(self, path: Path = DEFAULT_CACHE_PATH, max_bytes: int | None = None):
+        if max_bytes is None:
+            max_bytes = DEFAULT_MAX_CACHE_MB * 1024 * 1024
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._engine = rrc.db.sqlite.create_engine(path)
+        _metadata.create_all(self._engine)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, InferenceResult]:
+        """Get the cached results for any of these keys, marking them as used."""
+        found: dict[bytes, InferenceResult] = {}
+        with self._engine.begin() as conn:
+            for i in range(0, len(keys), _QUERY_CHUNK_SIZE):
+                chunk = keys[i : i + _QUERY_CHUNK_SIZE]
+                rows = conn.execute(
+                    sa.select(_entries.c.key, _entries.c.result).where(
+                        _entries.c.key.in_(chunk)
+                    )
+                )
+                for key, result in rows:
+                    found[key] = InferenceResult.model_validate_json(result)
+            if found:
+                conn.execute(
+                    _entries.update()
+                    .where(_entries.c.key.in_(list(found)))
+                    .values(last_used=time.time())
+                )
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, results: dict[bytes, InferenceResult]) -> None:
+        """Cache results by key, evicting old entries if the cache is over its limit."""
+        if not results:
+            return
+        now = time.time()
+        rows = []
+        for key, result in results.items():
+            serialized = result.model_dump_json(exclude={"input"})
+            rows.append(
+                {
+                    "key": key,
+                    "result": serialized,
+                    "size": len(key) + len(serialized),
+                    "last_used": now,
+                }
+            )
+        with self._engine.begin() as conn:
+            replaced = conn.scalar(
+                sa.select(sa.func.coalesce(sa.func.sum(_entries.c.size), 0)).where(
+                    _entries.c.key.in_(list(results))
+                )
+            )
+            stmt = insert(_entries)
+            conn.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[_entries.c.key],
+                    set_={
+                        "result": stmt.excluded.result,
+                        "size": stmt.excluded.size,
+                        "last_used": stmt.excluded.last_used,
+                    },
+                ),
+                rows,
+            )
+            total = self._add_to_total(
+                conn, sum(row["size"] for row in rows) - replaced
+            )
+            if total > self.max_bytes:
+                self._evict(conn, total)
+
+    def _add_to_total(self, conn: sa.Connection, delta: int) -> int:
+        """Update the running total size, rather than summing every entry's size."""
+        stmt = insert(_totals).values(id=1, size=delta)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[_totals.c.id], set_={"size": _totals.c.size + delta}
+            )
+        )
+        return conn.scalar(sa.select(_totals.c.size).where(_totals.c.id == 1))
+
+    def _evict(self, conn: sa.Connection, total: int) -> None:
+        target = int(self.max_bytes * _EVICT_TO)
+        while total > target:
+            oldest = conn.execute(
+                sa.select(_entries.c.key, _entries.c.size)
+                .order_by(_entries.c.last_used)
+                .limit(_QUERY_CHUNK_SIZE)
+            ).all()
+            if not oldest:
+                break
+            evicted = []
+            for key, size in oldest:
+                evicted.append(key)
+                total -= size
+                if total <= target:
+                    break
+            conn.execute(_entries.delete().where(_entries.c.key.in_(evicted)))
+        conn.execute(_totals.update().where(_totals.c.id == 1).values(size=total))
+
+
+class CachedInferenceService(InferenceService):
+    """
+    Wraps another inference service, only running it on documents not in the cache.
+
+    Services which don't define a cache namespace are run on every document.
+    """
+
+    service: InferenceService
+    cache: PredictionCache
+    namespace: str | None
+
+    def __init__(self, service: InferenceService, cache: PredictionCache):
+        super().__init__(service.options)
+        self.service = service
+        self.cache = cache
+        self.namespace = None
+        self.supports_streaming = service.supports_streaming
+        self.supports_documents = service.supports_documents
+
+    def __enter__(self):
+        self.service.__enter__()
+        self.namespace = self.service.get_cache_namespace()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.service.__exit__(exc_type, exc_value, traceback)
+
+    def predict(
+        self, inputs: list[InferenceInput]
+    ) -> list[InferenceResult | InferenceFailure]:
+        if self.namespace is None:
+            return self.service.predict(inputs)
+        keys = [get_cache_key(self.namespace, input.text or "") for input in inputs]
+        cached = self.cache.get_many(keys)
+        to_predict = [i for i, key in enumerate(keys) if key not in cached]
+        predicted = (
+            self.service.predict([inputs[i] for i in to_predict]) if to_predict else []
+        )
+        self.cache.put_many(
+            {
+                keys[i]: result
+                for i, result in zip(to_predict, predicted, strict=True)
+                if isinstance(result, InferenceResult)
+            }
+        )
+        results: list[InferenceResult | InferenceFailure | None] = [
+            _with_input(cached[key], input) if key in cached else None
+            for key, input in zip(keys, inputs, strict=True)
+        ]
+        for i, result in zip(to_predict, predicted, strict=True):
+            results[i] = result
+        return results
+
+    async def predict_async(
+        self, input: InferenceInput
+    ) -> InferenceResult | InferenceFailure:
+        if self.namespace is None:
+            return await self.service.predict_async(input)
+        key = get_cache_key(self.namespace, input.text or "")
+        cached = await asyncio.to_thread(self.cache.get_many, [key])
+        if key in cached:
+            return _with_input(cached[key], input)
+        result = await self.service.predict_async(input)
+        if isinstance(result, InferenceResult):
+            await asyncio.to_thread(self.cache.put_many, {key: result})
+        return result
+
+    def get_provenance(self) -> Provenance:
+        return self.service.get_provenance()
+
+    def get_cache_namespace(self) -> str | None:
+        return self.namespace
+
+    def count_tokens(self, texts: list[str]) -> list[int]:
+        return self.service.count_tokens(texts)
+
+
+def _with_input(result: InferenceResult, input: InferenceInput) -> InferenceResult:
+    return result.model_copy(update={"input": input})
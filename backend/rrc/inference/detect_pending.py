@@ -1,80 +1,451 @@
+import asyncio
+import functools
 from pathlib import Path
+from typing import Any, NamedTuple
 
 import tqdm
 from rich.console import Console
-from sqlalchemy import func, select
+from sqlalchemy import insert, select
 from sqlalchemy.orm import Session, joinedload
 
 import rrc.utils.click as click
 import rrc.utils.io
+from rrc.db import duplicates, stages
 from rrc.db.models import CovenantPrediction, Page, Provenance
 from rrc.db.session import get_session
+from rrc.db.writer import DEFAULT_MAX_PENDING, BackgroundWriter
+from rrc.inference.cache import (
+    DEFAULT_MAX_CACHE_MB,
+    CachedInferenceService,
+    PredictionCache,
+)
+from rrc.inference.documents import (
+    DEFAULT_DOCUMENT_MAX_TOKENS,
+    get_page_results,
+    group_pages,
+)
+from rrc.inference.prefilter import (
+    PREFILTER_MODEL_NAME,
+    KeywordPrefilter,
+    load_terms,
+)
 from rrc.inference.service import (
     InferenceService,
     MistralInferenceService,
+    OpenAIInferenceService,
     QwenInferenceService,
 )
-from rrc.utils.types import InferenceResult
+from rrc.ocr.blank import SKIPPED_BLANK_MODEL_NAME
+from rrc.utils.types import InferenceFailure, InferenceInput, InferenceResult
 
 console = Console()
 
 _DEFAULT_BATCH_SIZE = 250
-_DEFAULT_MODEL_NAME_OR_PATH = "reglab-rrc/qwen-rrc"
-_DEFAULT_MODEL_DOWNLOAD_DIR = rrc.utils.io.get_data_path("model_cache")
-_DEFAULT_MODEL_TYPE = "qwen"
+DEFAULT_MODEL_NAME_OR_PATH = "reglab-rrc/qwen-rrc"
+DEFAULT_MODEL_DOWNLOAD_DIR = rrc.utils.io.get_data_path("model_cache")
+DEFAULT_MODEL_TYPE = "qwen"
+_DEFAULT_MAX_IN_FLIGHT = 512
+_DEFAULT_API_CONCURRENCY = 32
+
+
+_NEGATIVE_RESULT = InferenceResult(
+    answer=False, raw_passage=None, quotation=None, confidence=None
+)
+
+
+class _DetectConfig(NamedTuple):
+    batch_size: int
+    lease_seconds: int
+    max_in_flight: int
+    prefilter: KeywordPrefilter | None
+    prefilter_threshold: float | None
+    provenance_id: int
+    skipped_provenance_id: int
+    prefilter_provenance_id: int | None
+    max_attempts: int
+    document_max_tokens: int | None
+    """Token budget for classifying consecutive pages together, or None to classify
+    each page on its own."""
+
 
+class _DetectOutputs(NamedTuple):
+    rows: dict[int, dict[str, Any]]
+    """The CovenantPrediction row to insert for each page, by page id."""
+    errors: dict[int, str]
+    """Why the prediction failed for each page which has no row, by page id."""
 
-_MODEL_TYPE_CLASS_MAP: dict[str, type[InferenceService]] = {
+
+class _StreamBatch(NamedTuple):
+    outputs: _DetectOutputs
+    """Outputs for the pages which don't need the model."""
+    model_requests: list[tuple[InferenceInput, list[tuple[int, int]]]]
+    """The input for each page to send to the model, with the page and transcription
+    ids to save its result for (the page and its duplicates)."""
+
+
+MODEL_TYPE_CLASS_MAP: dict[str, type[InferenceService]] = {
     "mistral": MistralInferenceService,
     "qwen": QwenInferenceService,
+    "openai": OpenAIInferenceService,
 }
+# Model types which take the Qwen prompts, and its options
+_QWEN_MODEL_TYPES = ("qwen", "openai")
 
 
-def _get_pending_count(session: Session) -> int:
-    stmt = (
-        select(func.count())
-        .select_from(Page)
-        .where(Page.transcriptions.any(), ~Page.predictions.any())
-    )
-    return session.scalar(stmt) or 0
-
-
-def _get_next_batch(session: Session, batch_size: int, last_id: int) -> list[Page]:
+def _get_pages(session: Session, page_ids: list[int]) -> list[Page]:
     stmt = (
         select(Page)
         .options(joinedload(Page.transcriptions))
-        .where(Page.transcriptions.any(), ~Page.predictions.any(), Page.id > last_id)
+        .where(Page.id.in_(page_ids))
         .order_by(Page.id)
-        .limit(batch_size)
     )
     return list(session.execute(stmt).unique().scalars().all())
 
 
-def _save_predictions(
-    session: Session,
+def _get_detect_outputs(
     pages: list[Page],
-    results: list[InferenceResult | None],
-    provenance: Provenance,
-) -> None:
-    for page, result in zip(pages, results, strict=True):
-        if result is None:
+    predicted_pages: list[Page],
+    results: list[tuple[InferenceResult | InferenceFailure, int]],
+    reusable: dict[str, CovenantPrediction],
+) -> _DetectOutputs:
+    """
+    Get the CovenantPrediction rows and failures for a batch, copying them to any
+    duplicate pages.
+
+    Args:
+        results: The result (or failure) and its provenance id for each page which
+            was predicted.
+    """
+    by_hash = {
+        content_hash: _get_prediction_fields(prediction)
+        for content_hash, prediction in reusable.items()
+    }
+    failed_hashes: dict[str, str] = {}
+    page_fields: dict[int, tuple[Page, dict[str, Any]]] = {}
+    errors: dict[int, str] = {}
+    for page, (result, provenance_id) in zip(predicted_pages, results, strict=True):
+        if isinstance(result, InferenceFailure):
             console.print(
-                f"[yellow]⚠[/yellow] Failed to get prediction for page [cyan]{page.id}[/cyan]"
+                f"[yellow]⚠[/yellow] Failed to get prediction for page [cyan]{page.id}[/cyan] ({result.reason.value})"
             )
+            errors[page.id] = result.reason.value
+            if page.content_hash is not None:
+                failed_hashes.setdefault(page.content_hash, result.reason.value)
             continue
 
-        prediction = CovenantPrediction(
-            page=page,
-            transcription=page.transcriptions[0],
-            provenance=provenance,
-            answer=result.answer,
-            confidence=result.confidence,
-            raw_passage=result.raw_passage,
-            quotation=result.quotation,
-        )
-        session.add(prediction)
+        fields = _get_result_fields(result, provenance_id)
+        page_fields[page.id] = page, fields
+        if page.content_hash is not None:
+            by_hash.setdefault(page.content_hash, fields)
+
+    predicted_ids = {page.id for page in predicted_pages}
+    for page in pages:
+        if page.id in predicted_ids:
+            continue
+        if (fields := by_hash.get(page.content_hash)) is not None:
+            page_fields[page.id] = page, fields
+        elif (error := failed_hashes.get(page.content_hash)) is not None:
+            errors[page.id] = error
+
+    rows = {
+        page_id: {
+            "page_id": page_id,
+            "transcription_id": page.transcriptions[0].id,
+            **fields,
+        }
+        for page_id, (page, fields) in page_fields.items()
+    }
+    return _DetectOutputs(rows, errors)
+
+
+def _merge_outputs(batches: list[_DetectOutputs]) -> _DetectOutputs:
+    return _DetectOutputs(
+        {k: v for batch in batches for k, v in batch.rows.items()},
+        {k: v for batch in batches for k, v in batch.errors.items()},
+    )
 
+
+def _write_predictions(
+    session: Session, outputs: _DetectOutputs, owner: str, max_attempts: int
+) -> int:
+    """
+    Save a batch's predictions and record its failures.
+
+    Runs on the writer thread. Returns the number of pages saved.
+    """
+    # If our lease lapsed, another worker may have claimed (and predicted) the page
+    done_ids = stages.complete(session, stages.DETECT, outputs.rows, owner)
+    if len(done_ids) < len(outputs.rows):
+        console.print(
+            f"[yellow]⚠[/yellow] Lost the lease on [cyan]{len(outputs.rows) - len(done_ids)}[/cyan] pages; not saving them"
+        )
+    done_rows = [row for page_id, row in outputs.rows.items() if page_id in done_ids]
+    if done_rows:
+        session.execute(insert(CovenantPrediction), done_rows)
+    if outputs.errors:
+        failed_ids = stages.fail(
+            session, stages.DETECT, outputs.errors, owner, max_attempts
+        )
+        if failed_ids:
+            console.print(
+                f"[yellow]⚠[/yellow] Set aside [cyan]{len(failed_ids)}[/cyan] pages which failed {max_attempts} times; see `rrc failed`"
+            )
     session.commit()
+    return len(done_ids)
+
+
+def _get_result_fields(result: InferenceResult, provenance_id: int) -> dict[str, Any]:
+    return {
+        "provenance_id": provenance_id,
+        "answer": result.answer,
+        "confidence": result.confidence,
+        "raw_passage": result.raw_passage,
+        "quotation": result.quotation,
+    }
+
+
+def _get_prediction_fields(prediction: CovenantPrediction) -> dict[str, Any]:
+    return {
+        "provenance_id": prediction.provenance_id,
+        "answer": prediction.answer,
+        "confidence": prediction.confidence,
+        "raw_passage": prediction.raw_passage,
+        "quotation": prediction.quotation,
+    }
+
+
+def _get_skip_provenance_ids(
+    pages: list[Page], config: _DetectConfig
+) -> list[int | None]:
+    """
+    Get the provenance to mark each page negative under without running the model,
+    or None for the pages the model should classify.
+    """
+    # Blank pages (including those skipped by the OCR blank filter) have nothing to
+    # classify, so don't spend a model call on them
+    skip_ids = [
+        config.skipped_provenance_id
+        if not page.transcriptions[0].text.strip()
+        else None
+        for page in pages
+    ]
+    if config.prefilter is not None and pages:
+        scores = config.prefilter.score([page.transcriptions[0].text for page in pages])
+        skip_ids = [
+            config.prefilter_provenance_id
+            if skip_id is None and score < config.prefilter_threshold
+            else skip_id
+            for skip_id, score in zip(skip_ids, scores.tolist(), strict=True)
+        ]
+    return skip_ids
+
+
+def _predict_documents(
+    service: InferenceService, pages: list[Page], max_tokens: int
+) -> list[InferenceResult | InferenceFailure]:
+    """Classify runs of consecutive pages together, and get each page's result."""
+    token_counts = service.count_tokens([page.transcriptions[0].text for page in pages])
+    documents = group_pages(pages, token_counts, max_tokens)
+    results = service.predict([document.input for document in documents])
+    return [
+        page_result
+        for document, result in zip(documents, results, strict=True)
+        for page_result in get_page_results(document, result)
+    ]
+
+
+def _detect_batches(
+    service: InferenceService,
+    writer: BackgroundWriter,
+    session: Session,
+    config: _DetectConfig,
+    owner: str,
+) -> None:
+    """
+    Claim and classify batches of pending pages until none are left.
+
+    Pages which fail are left for a later run, rather than claimed again in this one.
+    """
+    failed_ids: set[int] = set()
+    while True:
+        page_ids = stages.claim_batch(
+            session,
+            stages.DETECT,
+            config.batch_size,
+            owner,
+            config.lease_seconds,
+            config.max_attempts,
+            exclude=failed_ids,
+        )
+        if not page_ids:
+            break
+
+        batch = _get_pages(session, page_ids)
+        reusable = duplicates.get_reusable_outputs(session, batch, CovenantPrediction)
+        to_predict = duplicates.get_canonical_pages(batch, reusable)
+        skip_ids = _get_skip_provenance_ids(to_predict, config)
+        to_model = [
+            page
+            for page, skip_id in zip(to_predict, skip_ids, strict=True)
+            if skip_id is None
+        ]
+        if not to_model:
+            model_results = iter([])
+        elif config.document_max_tokens is not None:
+            model_results = iter(
+                _predict_documents(service, to_model, config.document_max_tokens)
+            )
+        else:
+            model_results = iter(
+                service.predict([page.as_text_input() for page in to_model])
+            )
+        results = [
+            (next(model_results), config.provenance_id)
+            if skip_id is None
+            else (_NEGATIVE_RESULT, skip_id)
+            for skip_id in skip_ids
+        ]
+        outputs = _get_detect_outputs(batch, to_predict, results, reusable)
+        failed_ids.update(outputs.errors)
+        writer.submit(outputs)
+
+
+def _claim_stream_batch(
+    session: Session, config: _DetectConfig, owner: str, failed_ids: list[int]
+) -> _StreamBatch | None:
+    """
+    Claim a batch of pending pages and get everything the event loop needs from it
+    as plain data, or None if there are no pending pages besides `failed_ids`.
+
+    Runs on a worker thread; no ORM objects are shared with the event loop.
+    """
+    page_ids = stages.claim_batch(
+        session,
+        stages.DETECT,
+        config.batch_size,
+        owner,
+        config.lease_seconds,
+        config.max_attempts,
+        exclude=failed_ids,
+    )
+    if not page_ids:
+        return None
+
+    batch = _get_pages(session, page_ids)
+    reusable = duplicates.get_reusable_outputs(session, batch, CovenantPrediction)
+    to_predict = duplicates.get_canonical_pages(batch, reusable)
+    skip_ids = _get_skip_provenance_ids(to_predict, config)
+    to_model = [
+        page
+        for page, skip_id in zip(to_predict, skip_ids, strict=True)
+        if skip_id is None
+    ]
+
+    # Duplicates of a page sent to the model are saved along with it
+    to_model_ids = {page.id for page in to_model}
+    to_model_hashes = {page.content_hash for page in to_model} - {None}
+    model_requests = [
+        (
+            page.as_text_input(),
+            [
+                (dup.id, dup.transcriptions[0].id)
+                for dup in batch
+                if dup.id == page.id
+                or (
+                    page.content_hash is not None
+                    and dup.content_hash == page.content_hash
+                )
+            ],
+        )
+        for page in to_model
+    ]
+    ready_pages = [
+        page
+        for page in batch
+        if page.id not in to_model_ids and page.content_hash not in to_model_hashes
+    ]
+    ready_predicted = [page for page in to_predict if page.id not in to_model_ids]
+    ready_results = [
+        (_NEGATIVE_RESULT, skip_id) for skip_id in skip_ids if skip_id is not None
+    ]
+    outputs = _get_detect_outputs(ready_pages, ready_predicted, ready_results, reusable)
+    return _StreamBatch(outputs, model_requests)
+
+
+async def _detect_streaming(
+    service: InferenceService,
+    writer: BackgroundWriter,
+    session: Session,
+    config: _DetectConfig,
+    owner: str,
+) -> None:
+    """
+    Keep up to `max_in_flight` pages in the async engine until none are left.
+
+    Batches are claimed on a worker thread while the engine runs, and each result is
+    parsed and handed to the writer as soon as it completes, so a slow page holds up
+    nothing but its own row.
+
+    If a prediction raises (e.g. the engine died), no more batches are claimed; the
+    pages already in flight are finished, then the error is raised. Pages claimed but
+    not yet predicted are picked up by a later run once their lease expires. Pages
+    which fail are left for a later run too, rather than claimed again in this one.
+    """
+    in_flight = asyncio.Semaphore(config.max_in_flight)
+    tasks: set[asyncio.Task] = set()
+    errors: list[BaseException] = []
+    failed_ids: set[int] = set()
+
+    def on_done(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        if not task.cancelled() and (error := task.exception()) is not None:
+            errors.append(error)
+
+    async def predict(input: InferenceInput, page_ids: list[tuple[int, int]]) -> None:
+        try:
+            result = await service.predict_async(input)
+        finally:
+            in_flight.release()
+        if isinstance(result, InferenceFailure):
+            console.print(
+                f"[yellow]⚠[/yellow] Failed to get prediction for page [cyan]{page_ids[0][0]}[/cyan] ({result.reason.value})"
+            )
+            page_errors = {page_id: result.reason.value for page_id, _ in page_ids}
+            failed_ids.update(page_errors)
+            await asyncio.to_thread(writer.submit, _DetectOutputs({}, page_errors))
+            return
+        fields = _get_result_fields(result, config.provenance_id)
+        rows = {
+            page_id: {
+                "page_id": page_id,
+                "transcription_id": transcription_id,
+                **fields,
+            }
+            for page_id, transcription_id in page_ids
+        }
+        await asyncio.to_thread(writer.submit, _DetectOutputs(rows, {}))
+
+    while not errors:
+        batch = await asyncio.to_thread(
+            _claim_stream_batch, session, config, owner, list(failed_ids)
+        )
+        if batch is None:
+            break
+        failed_ids.update(batch.outputs.errors)
+        if batch.outputs.rows or batch.outputs.errors:
+            await asyncio.to_thread(writer.submit, batch.outputs)
+        for input, page_ids in batch.model_requests:
+            await in_flight.acquire()
+            if errors:
+                in_flight.release()
+                break
+            task = asyncio.create_task(predict(input, page_ids))
+            tasks.add(task)
+            task.add_done_callback(on_done)
+    # Tasks remove themselves from the set when done, so wait on a copy
+    await asyncio.gather(*list(tasks), return_exceptions=True)
+    if errors:
+        raise errors[0]
 
 
 @click.command()
@@ -90,7 +461,7 @@ def _save_predictions(
     "--model-name-or-path",
     "-m",
     type=str,
-    default=_DEFAULT_MODEL_NAME_OR_PATH,
+    default=DEFAULT_MODEL_NAME_OR_PATH,
     show_default=True,
     help="Name or path of the model to use",
 )
@@ -98,23 +469,174 @@ def _save_predictions(
     "--model-download-dir",
     "-d",
     type=click.Path(path_type=Path),
-    default=_DEFAULT_MODEL_DOWNLOAD_DIR,
+    default=DEFAULT_MODEL_DOWNLOAD_DIR,
     show_default=True,
 )
 @click.option(
     "--model-type",
     "-t",
-    type=click.Choice(["mistral", "qwen"]),
-    default=_DEFAULT_MODEL_TYPE,
+    type=click.Choice(list(MODEL_TYPE_CLASS_MAP)),
+    default=DEFAULT_MODEL_TYPE,
+    show_default=True,
+    help="openai sends the qwen prompts to a remote server (see --api-base-url)",
+)
+@click.option(
+    "--api-base-url",
+    type=str,
+    default=None,
+    help="Base URL of the OpenAI-compatible API serving the model with the openai "
+    "model type, e.g. http://host:8000/v1 (the key is read from RRC_OPENAI_API_KEY)",
+)
+@click.option(
+    "--api-concurrency",
+    type=int,
+    default=_DEFAULT_API_CONCURRENCY,
+    show_default=True,
+    help="Maximum number of requests in flight to the API at once",
+)
+@click.option(
+    "--lease-seconds",
+    type=int,
+    default=stages.DEFAULT_LEASE_SECONDS,
+    show_default=True,
+    help="How long a claimed batch is reserved for this process before other "
+    "processes may claim it (e.g. if this one crashed)",
+)
+@click.option(
+    "--write-queue-size",
+    type=int,
+    default=DEFAULT_MAX_PENDING,
+    show_default=True,
+    help="Number of predicted batches which may wait to be written to the database "
+    "before inference pauses",
+)
+@click.option(
+    "--prefilter-threshold",
+    type=float,
+    default=None,
+    help="Only send pages with at least this keyword score to the model, and mark the "
+    "rest negative (see `rrc prefilter-report` to choose one) [default: send all pages]",
+)
+@click.option(
+    "--prefilter-terms",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="JSON object mapping keyword prefilter terms to their weights [default: "
+    "built-in terms]",
+)
+@click.option(
+    "--answer-first",
+    is_flag=True,
+    default=False,
+    help="Generate only up to the answer first, and only generate the quotation for "
+    "pages answered positive (qwen and openai only)",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Run the model on vLLM's async engine, feeding it pending pages continuously "
+    "and saving each result as it completes, instead of in fixed batches (qwen and "
+    "openai only)",
+)
+@click.option(
+    "--max-in-flight",
+    type=int,
+    default=_DEFAULT_MAX_IN_FLIGHT,
+    show_default=True,
+    help="Maximum number of pages in the async engine at once with --stream",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    show_default=True,
+    help="Reuse predictions for text the same model has classified before, from a "
+    "cache in the data directory shared by all runs",
+)
+@click.option(
+    "--cache-size-mb",
+    type=int,
+    default=DEFAULT_MAX_CACHE_MB,
     show_default=True,
+    help="Size past which the least recently used cached predictions are evicted",
+)
+@click.option(
+    "--max-attempts",
+    type=int,
+    default=stages.DEFAULT_MAX_ATTEMPTS,
+    show_default=True,
+    help="Number of times to try a page whose output can't be parsed before setting "
+    "it aside (see `rrc failed`)",
+)
+@click.option(
+    "--documents",
+    is_flag=True,
+    default=False,
+    help="Classify consecutive pages of a document (frames of a TIFF, or images "
+    "numbered in sequence) together, so covenants across page breaks are seen whole",
+)
+@click.option(
+    "--document-max-tokens",
+    type=int,
+    default=DEFAULT_DOCUMENT_MAX_TOKENS,
+    show_default=True,
+    help="Maximum number of tokens of text to classify together with --documents",
 )
 def main(
-    batch_size: int, model_name_or_path: str, model_download_dir: Path, model_type: str
+    batch_size: int,
+    model_name_or_path: str,
+    model_download_dir: Path,
+    model_type: str,
+    api_base_url: str | None,
+    api_concurrency: int,
+    lease_seconds: int,
+    write_queue_size: int,
+    prefilter_threshold: float | None,
+    prefilter_terms: Path | None,
+    answer_first: bool,
+    stream: bool,
+    max_in_flight: int,
+    cache: bool,
+    cache_size_mb: int,
+    max_attempts: int,
+    documents: bool,
+    document_max_tokens: int,
 ) -> None:
-    """Process all pages with transcriptions but no predictions."""
+    """
+    Process all pages with transcriptions but no predictions.
+
+    Several processes can run at once against the same database; each claims its own
+    batches. With `--prefilter-threshold`, pages which score below it on keywords
+    associated with covenants are marked negative without running the model.
+    Predictions are written on a background thread while the next batch runs,
+    and pages only count as done once their predictions are committed.
+    """
+    if answer_first and model_type not in _QWEN_MODEL_TYPES:
+        raise click.BadParameter(
+            "Only supported with the qwen and openai model types",
+            param_hint="--answer-first",
+        )
+    service_class = MODEL_TYPE_CLASS_MAP[model_type]
+    for name, enabled, supported in [
+        ("--stream", stream, service_class.supports_streaming),
+        ("--documents", documents, service_class.supports_documents),
+    ]:
+        if enabled and not supported:
+            raise click.BadParameter(
+                f"Not supported with the {model_type} model type", param_hint=name
+            )
+    if (model_type == "openai") != (api_base_url is not None):
+        raise click.BadParameter(
+            "Required with, and only with, the openai model type",
+            param_hint="--api-base-url",
+        )
+    if documents and stream:
+        raise click.BadParameter(
+            "Not supported with --stream", param_hint="--documents"
+        )
     session = get_session()
-    last_id = 0
-    pending_count = _get_pending_count(session)
+    owner = stages.get_worker_id()
+    pending_count = stages.get_pending_count(session, stages.DETECT)
     if pending_count == 0:
         console.print(
             "[yellow]⚠[/yellow] No pending pages found - all pages already have predictions"
@@ -124,31 +646,99 @@ def main(
     console.print(
         f"[green]🔍[/green] Found [bold blue]{pending_count}[/bold blue] pages pending prediction"
     )
+    prefilter = None
+    if prefilter_threshold is not None:
+        prefilter = KeywordPrefilter(
+            load_terms(prefilter_terms) if prefilter_terms is not None else None
+        )
+        console.print(
+            f"[green]🔎[/green] Only pages with a keyword score of at least [cyan]{prefilter_threshold}[/cyan] will be sent to the model"
+        )
+    if documents:
+        console.print(
+            f"[green]📄[/green] Classifying consecutive pages together, up to [cyan]{document_max_tokens}[/cyan] tokens at a time"
+        )
     console.print(
         f"[green]🤖[/green] Using model: [cyan]{model_name_or_path}[/cyan] (type: [magenta]{model_type}[/magenta], batch size: [cyan]{batch_size}[/cyan])"
     )
 
-    with _MODEL_TYPE_CLASS_MAP[model_type](
+    service = service_class(
         {
             "model_name_or_path": model_name_or_path,
             "model_download_dir": model_download_dir,
+            "answer_first": answer_first,
+            "async_engine": stream,
+            "api_base_url": api_base_url,
+            "max_concurrency": api_concurrency,
         }
-    ) as service:
+    )
+    prediction_cache = None
+    if cache:
+        prediction_cache = PredictionCache(max_bytes=cache_size_mb * 1024 * 1024)
+        service = CachedInferenceService(service, prediction_cache)
+
+    with service:
         provenance = service.get_provenance()
         provenance.creator = "detect_pending"
+        skipped_provenance = Provenance(
+            model_name=SKIPPED_BLANK_MODEL_NAME,
+            record_type="covenant_predictions",
+            creator="detect_pending",
+        )
+        session.add_all([provenance, skipped_provenance])
+        prefilter_provenance = None
+        if prefilter is not None:
+            prefilter_provenance = Provenance(
+                model_name=PREFILTER_MODEL_NAME,
+                record_type="covenant_predictions",
+                creator="detect_pending",
+            )
+            session.add(prefilter_provenance)
+        session.commit()
+        config = _DetectConfig(
+            batch_size=batch_size,
+            lease_seconds=lease_seconds,
+            max_in_flight=max_in_flight,
+            prefilter=prefilter,
+            prefilter_threshold=prefilter_threshold,
+            provenance_id=provenance.id,
+            skipped_provenance_id=skipped_provenance.id,
+            prefilter_provenance_id=(
+                prefilter_provenance.id if prefilter_provenance is not None else None
+            ),
+            max_attempts=max_attempts,
+            document_max_tokens=document_max_tokens if documents else None,
+        )
+
         pbar = tqdm.tqdm(total=pending_count, desc="Processing pages")
-        while True:
-            batch = _get_next_batch(session, batch_size, last_id)
-            if not batch:
-                break
+        total_saved = 0
 
-            results = service.predict([page.as_text_input() for page in batch])
-            _save_predictions(session, batch, results, provenance)
-            last_id = batch[-1].id
-            pbar.update(len(batch))
+        def on_written(outputs: _DetectOutputs, n_saved: int) -> None:
+            nonlocal total_saved
+            total_saved += n_saved
+            pbar.update(n_saved)
 
+        writer = BackgroundWriter(
+            functools.partial(
+                _write_predictions, owner=owner, max_attempts=max_attempts
+            ),
+            max_pending=write_queue_size,
+            on_written=on_written,
+            merge=_merge_outputs,
+        )
+        with writer:
+            if stream:
+                asyncio.run(_detect_streaming(service, writer, session, config, owner))
+            else:
+                _detect_batches(service, writer, session, config, owner)
+
+    if prediction_cache is not None:
+        lookups = prediction_cache.hits + prediction_cache.misses
+        console.print(
+            f"[green]💾[/green] Prediction cache: [bold blue]{prediction_cache.hits}[/bold blue] of [bold blue]{lookups}[/bold blue] pages sent to the model were cached ([cyan]{prediction_cache.hit_rate:.1%}[/cyan] hit rate)"
+        )
     console.print(
-        f"[green]✓[/green] Successfully completed processing [bold blue]{pending_count}[/bold blue] pages with predictions"
+        f"[green]✓[/green] Successfully completed processing [bold blue]{total_saved}[/bold blue] pages with predictions"
     )
 
 
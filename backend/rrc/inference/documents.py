@@ -0,0 +1,157 @@
+"""
+Grouping consecutive pages into documents, for classifying them in one request.
+
+A covenant can run across a page break, which neither page shows whole when they are
+classified separately. Consecutive frames of a TIFF, and consecutive single-page
+images whose names differ only in a sequence number (`deed_0041.png`,
+`deed_0042.png`), are taken to be pages of one document, and classified together up
+to a token budget. Each covenant found is attributed back to the page its passage
+starts on.
+"""
+
+import re
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple
+
+from rrc.db.models import Page
+from rrc.utils.types import InferenceFailure, InferenceInput, InferenceResult
+
+DEFAULT_DOCUMENT_MAX_TOKENS = 4096
+
+_PAGE_SEPARATOR = "\n\n"
+_SEQUENCE_NUMBER_REGEX = re.compile(r"^(.*?)(\d+)$")
+_WORD_REGEX = re.compile(r"\w+")
+# Number of words from the start of a passage to look for verbatim
+_PASSAGE_START_WORDS = 5
+
+
+class Document(NamedTuple):
+    pages: list[Page]
+    input: InferenceInput
+
+
+def _get_sequence_key(path: Path) -> tuple[Path, str, str, int] | None:
+    if (match := _SEQUENCE_NUMBER_REGEX.match(path.stem)) is None:
+        return None
+    return path.parent, match.group(1), path.suffix.lower(), int(match.group(2))
+
+
+def _is_next_page(page: Page, next_page: Page) -> bool:
+    """Check if `next_page` looks like the page after `page` in the same document."""
+    if page.image_frame_idx is not None or next_page.image_frame_idx is not None:
+        return (
+            page.image_path == next_page.image_path
+            and next_page.image_frame_idx == (page.image_frame_idx or 0) + 1
+        )
+    key = _get_sequence_key(Path(page.image_path))
+    next_key = _get_sequence_key(Path(next_page.image_path))
+    return (
+        key is not None
+        and next_key is not None
+        and key[:3] == next_key[:3]
+        and next_key[3] == key[3] + 1
+    )
+
+
+def group_pages(
+    pages: list[Page], token_counts: list[int], max_tokens: int
+) -> list[Document]:
+    """
+    Group runs of consecutive pages (in the given order) into documents of at most
+    `max_tokens` tokens. A page over the budget on its own is a document by itself.
+    """
+    groups: list[list[Page]] = []
+    group_tokens = 0
+    for page, n_tokens in zip(pages, token_counts, strict=True):
+        if (
+            groups
+            and _is_next_page(groups[-1][-1], page)
+            and group_tokens + n_tokens <= max_tokens
+        ):
+            groups[-1].append(page)
+            group_tokens += n_tokens
+        else:
+            groups.append([page])
+            group_tokens = n_tokens
+    return [
+        Document(
+            group,
+            InferenceInput(
+                text=_PAGE_SEPARATOR.join(page.transcriptions[0].text for page in group)
+            ),
+        )
+        for group in groups
+    ]
+
+
+def _get_words(text: str) -> list[str]:
+    return _WORD_REGEX.findall(text.lower())
+
+
+def get_passage_page(page_texts: list[str], passage: str) -> int:
+    """
+    Get the index of the page a passage starts on.
+
+    Looks for the passage's first words verbatim (ignoring case, punctuation and
+    line breaks, including across a page break); failing that, for example if OCR
+    errors were fixed in the passage, picks the page sharing the most words with it.
+    """
+    passage_words = _get_words(passage)
+    if not passage_words:
+        return 0
+    words: list[str] = []
+    word_pages: list[int] = []
+    for i, text in enumerate(page_texts):
+        page_words = _get_words(text)
+        words.extend(page_words)
+        word_pages.extend([i] * len(page_words))
+
+    start = passage_words[:_PASSAGE_START_WORDS]
+    for j in range(len(words) - len(start) + 1):
+        if words[j : j + len(start)] == start:
+            return word_pages[j]
+
+    passage_counts = Counter(passage_words)
+    overlaps = [
+        sum((Counter(_get_words(text)) & passage_counts).values())
+        for text in page_texts
+    ]
+    return max(range(len(page_texts)), key=overlaps.__getitem__)
+
+
+def get_page_results(
+    document: Document, result: InferenceResult | InferenceFailure
+) -> list[InferenceResult | InferenceFailure]:
+    """
+    Get each page's result from its document's.
+
+    A covenant is attributed to the page its passage starts on; the document's other
+    pages are negative, without a confidence of their own. If the document is
+    negative (or failed), so is each of its pages.
+    """
+    if len(document.pages) == 1:
+        return [result]
+    page_inputs = [page.as_text_input() for page in document.pages]
+    if isinstance(result, InferenceFailure) or not result.answer:
+        return [
+            result.model_copy(update={"input": page_input})
+            for page_input in page_inputs
+        ]
+
+    passage_page = get_passage_page(
+        [page_input.text for page_input in page_inputs],
+        result.raw_passage or result.quotation or "",
+    )
+    return [
+        result.model_copy(update={"input": page_input})
+        if i == passage_page
+        else InferenceResult(
+            answer=False,
+            raw_passage=None,
+            quotation=None,
+            confidence=None,
+            input=page_input,
+        )
+        for i, page_input in enumerate(page_inputs)
+    ]
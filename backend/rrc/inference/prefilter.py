@@ -0,0 +1,192 @@
+"""
+Cheap keyword scoring of transcriptions, to skip the model on pages which are clearly
+not covenants.
+
+Racial covenants name the groups they restrict, so a page which mentions none of the
+usual terms (even misspelled by OCR) is almost certainly negative. Each term has a
+weight, and a page's score is the total weight of the distinct terms found on it.
+"""
+
+import json
+import re
+from collections import defaultdict
+from itertools import chain, combinations
+from pathlib import Path
+
+import numpy as np
+
+PREFILTER_MODEL_NAME = "keyword_prefilter"
+"""Provenance model name for predictions made by the keyword prefilter."""
+
+DEFAULT_TERMS: dict[str, float] = {
+    # Groups named by covenants
+    "african": 1.0,
+    "asiatic": 1.0,
+    "caucasian": 1.0,
+    "chinese": 1.0,
+    "colored": 1.0,
+    "ethiopian": 1.0,
+    "filipino": 1.0,
+    "hebrew": 1.0,
+    "hindu": 1.0,
+    "japanese": 1.0,
+    "jewish": 1.0,
+    "malay": 1.0,
+    "mexican": 1.0,
+    "mongolian": 1.0,
+    "negro": 1.0,
+    "negroes": 1.0,
+    "semitic": 1.0,
+    "white": 0.5,
+    # The language of the restriction itself
+    "race": 1.0,
+    "races": 1.0,
+    "racial": 1.0,
+    "nationality": 1.0,
+    "blood": 0.5,
+    "descent": 0.5,
+    "occupied by": 0.5,
+    "servants": 0.5,
+}
+
+_WORD_REGEX = re.compile(r"[a-z0-9]+")
+_MAX_CACHED_WORDS = 1_000_000
+# Characters OCR commonly confuses, folded to one of each group before matching (so
+# "ncgro", "n3gro" and "racc" match at any length): c/e/3, i/l/1, o/0, s/5, g/q
+_OCR_CONFUSIONS = str.maketrans("e3i105q", "ccllosg")
+
+
+def _fold(word: str) -> str:
+    return word.translate(_OCR_CONFUSIONS)
+
+
+def _get_max_edits(word: str) -> int:
+    """
+    Get the number of OCR errors to tolerate in a word, besides confused characters:
+    none in short words, whose near misses are mostly other real words (e.g. "race"
+    and "rate").
+    """
+    if len(word) <= 5:
+        return 0
+    return 1 if len(word) <= 8 else 2
+
+
+def _get_deletions(word: str, max_edits: int) -> set[str]:
+    return {
+        "".join(c for i, c in enumerate(word) if i not in removed)
+        for n in range(max_edits + 1)
+        for removed in combinations(range(len(word)), n)
+    }
+
+
+def _get_edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(
+                min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            )
+        previous = current
+    return previous[-1]
+
+
+def load_terms(path: Path) -> dict[str, float]:
+    """Load prefilter terms from a JSON object mapping each term to its weight."""
+    terms = json.loads(path.read_text())
+    if not isinstance(terms, dict) or not terms:
+        raise ValueError(f"Expected a JSON object of terms to weights in {path}")
+    return {str(term).lower(): float(weight) for term, weight in terms.items()}
+
+
+class KeywordPrefilter:
+    """
+    Score pages by the terms they contain, tolerating OCR errors.
+
+    Characters OCR commonly confuses (e.g. "c" for "e") are tolerated in every term;
+    longer words also match within one or two edits. Terms may be phrases, which must
+    appear as consecutive words. Fuzzy matching uses a deletion index (as in
+    SymSpell), and each distinct word seen is only matched once, so scoring a batch
+    costs little more than splitting it into words.
+
+    A batch is matched as a whole: its words are deduplicated, the distinct words
+    matched against the term words, and the matches spread back over every word of
+    every page and combined into terms with array operations.
+    """
+
+    terms: list[str]
+    weights: np.ndarray
+
+    def __init__(self, terms: dict[str, float] | None = None):
+        if terms is None:
+            terms = DEFAULT_TERMS
+        self.terms = list(terms)
+        self.weights = np.array([terms[term] for term in self.terms], dtype=np.float32)
+        # Each distinct word of the terms, and the indices of each term's words
+        self._words = list(
+            dict.fromkeys(w for term in self.terms for w in term.split())
+        )
+        word_indices = {word: i for i, word in enumerate(self._words)}
+        self._term_words = [
+            [word_indices[word] for word in term.split()] for term in self.terms
+        ]
+        self._deletion_index: dict[str, set[int]] = defaultdict(set)
+        for i, word in enumerate(self._words):
+            for deletion in _get_deletions(_fold(word), _get_max_edits(word)):
+                self._deletion_index[deletion].add(i)
+        self._matches: dict[str, np.ndarray] = {}
+
+    def get_term_hits(self, texts: list[str]) -> np.ndarray:
+        """Get a (pages, terms) boolean array of which terms appear on each page."""
+        hits = np.zeros((len(texts), len(self.terms)), dtype=bool)
+        page_words = [_WORD_REGEX.findall(text.lower()) for text in texts]
+        n_words = np.array([len(words) for words in page_words], dtype=np.int64)
+        if not n_words.sum():
+            return hits
+        # The page of each word in the batch, and which term words each distinct
+        # word matches
+        pages = np.repeat(np.arange(len(texts)), n_words)
+        words = list(chain.from_iterable(page_words))
+        distinct = {word: i for i, word in enumerate(dict.fromkeys(words))}
+        word_ids = np.fromiter(
+            map(distinct.__getitem__, words), dtype=np.intp, count=len(words)
+        )
+        matches = np.stack([self._match_word(word) for word in distinct])
+        # Few words match any term, so phrases are only looked for from those
+        matched = np.flatnonzero(matches.any(axis=1)[word_ids])
+        for j, term_words in enumerate(self._term_words):
+            starts = matched[matches[word_ids[matched], term_words[0]]]
+            for k, term_word in enumerate(term_words[1:], start=1):
+                starts = starts[starts + k < len(words)]
+                following = starts + k
+                starts = starts[
+                    (pages[following] == pages[starts])
+                    & matches[word_ids[following], term_word]
+                ]
+            hits[pages[starts], j] = True
+        return hits
+
+    def score(self, texts: list[str]) -> np.ndarray:
+        """Get each page's score: the total weight of the distinct terms on it."""
+        return self.get_term_hits(texts) @ self.weights
+
+    def _match_word(self, word: str) -> np.ndarray:
+        """Get a boolean mask of the term words this word could be an OCR reading of."""
+        if (matches := self._matches.get(word)) is not None:
+            return matches
+        folded = _fold(word)
+        candidates = set()
+        # A word can be at most two letters shorter than the terms it may match
+        depth = 2 if len(word) >= 7 else 1 if len(word) >= 5 else 0
+        for deletion in _get_deletions(folded, depth):
+            candidates.update(self._deletion_index.get(deletion, ()))
+        matches = np.zeros(len(self._words), dtype=bool)
+        for i in candidates:
+            term_word = self._words[i]
+            matches[i] = _get_edit_distance(folded, _fold(term_word)) <= _get_max_edits(
+                term_word
+            )
+        if len(self._matches) >= _MAX_CACHED_WORDS:
+            self._matches.clear()
+        self._matches[word] = matches
+        return matches
@@ -1,20 +1,36 @@
 import abc
+import asyncio
+import itertools
 import json
+import logging
 import math
 import re
+import threading
 import traceback
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, NamedTuple
 
+import requests
+import requests.adapters
+import tenacity
 import vllm
 import vllm.sequence
 from transformers import AutoTokenizer
+from vllm.inputs import TokensPrompt
 
+import rrc.utils.io
 from rrc.db.models import Provenance
 from rrc.utils.logger import LOGGER
 from rrc.utils.ml import DEFAULT_DEVICE
-from rrc.utils.types import InferenceInput, InferenceResult, InputType
+from rrc.utils.types import (
+    FailureReason,
+    InferenceFailure,
+    InferenceInput,
+    InferenceResult,
+    InputType,
+)
 
 
 def require_input_type(
@@ -35,11 +51,163 @@ def require_input_type(
     return decorator
 
 
+def _get_failure(output: vllm.CompletionOutput) -> InferenceFailure:
+    if output.finish_reason == _REQUEST_ERROR_FINISH_REASON:
+        LOGGER.error("Request failed: %s", output.text)
+        return InferenceFailure(reason=FailureReason.REQUEST_ERROR, output=output.text)
+    if output.finish_reason == "length":
+        LOGGER.warning("Output truncated at max_tokens (output: '%s')", output.text)
+        return InferenceFailure(reason=FailureReason.TRUNCATED, output=output.text)
+    LOGGER.error(
+        "Error parsing output (output: '%s'): %s", output.text, traceback.format_exc()
+    )
+    return InferenceFailure(reason=FailureReason.PARSE_ERROR, output=output.text)
+
+
+def _is_truncated(result: InferenceResult | InferenceFailure) -> bool:
+    return (
+        isinstance(result, InferenceFailure)
+        and result.reason == FailureReason.TRUNCATED
+    )
+
+
+_MAX_MODEL_LEN = 8192
+_DEFAULT_WINDOW_OVERLAP_TOKENS = 256
+# Room for the document's wrapping and for tokens merging differently at a window's
+# edges than in the whole document
+_WINDOW_MARGIN_TOKENS = 16
+# Windows are widened to whole words, unless that would add more than this many chars
+_MAX_WORD_CHARS = 32
+
+
+def _count_tokens(tokenizer: AutoTokenizer, texts: list[str]) -> list[int]:
+    if not texts:
+        return []
+    return [
+        len(ids)
+        for ids in tokenizer(
+            texts, add_special_tokens=False, return_attention_mask=False
+        )["input_ids"]
+    ]
+
+
+def _split_document(
+    tokenizer: AutoTokenizer,
+    input: InferenceInput,
+    max_tokens: int,
+    overlap_tokens: int,
+) -> list[InferenceInput]:
+    """
+    Split a document which is too long for the model into windows of at most
+    `max_tokens` tokens, each overlapping the last by `overlap_tokens` so a covenant
+    at a boundary appears whole in at least one of them (unless it is longer than the
+    overlap).
+    """
+    offsets = tokenizer(
+        input.text, add_special_tokens=False, return_offsets_mapping=True
+    )["offset_mapping"]
+    window_tokens = max_tokens - _WINDOW_MARGIN_TOKENS
+    stride = max(window_tokens - overlap_tokens, 1)
+    windows = []
+    for start in range(0, len(offsets), stride):
+        end = min(start + window_tokens, len(offsets))
+        start_char, end_char = _widen_to_words(
+            input.text, offsets[start][0], offsets[end - 1][1]
+        )
+        windows.append(InferenceInput(text=input.text[start_char:end_char]))
+        if end == len(offsets):
+            break
+    LOGGER.info(
+        "Split a document of %d tokens into %d windows", len(offsets), len(windows)
+    )
+    return windows
+
+
+def _widen_to_words(text: str, start: int, end: int) -> tuple[int, int]:
+    """Widen a span of text so it doesn't start or end partway through a word."""
+    word_start = start
+    while (
+        word_start > 0
+        and not text[word_start - 1].isspace()
+        and start - word_start < _MAX_WORD_CHARS
+    ):
+        word_start -= 1
+    if word_start == 0 or text[word_start - 1].isspace():
+        start = word_start
+    word_end = end
+    while (
+        word_end < len(text)
+        and not text[word_end].isspace()
+        and word_end - end < _MAX_WORD_CHARS
+    ):
+        word_end += 1
+    if word_end == len(text) or text[word_end].isspace():
+        end = word_end
+    return start, end
+
+
+def _merge_windows(
+    inputs: list[InferenceInput],
+    owners: list[int],
+    results: list[InferenceResult | InferenceFailure],
+) -> list[InferenceResult | InferenceFailure]:
+    """
+    Combine the results for each document's windows into one result per document.
+
+    Args:
+        owners: The index in `inputs` of the document each result is for.
+    """
+    document_results: list[list[InferenceResult | InferenceFailure]] = [
+        [] for _ in inputs
+    ]
+    for owner, result in zip(owners, results, strict=True):
+        document_results[owner].append(result)
+    merged = []
+    for input, window_results in zip(inputs, document_results, strict=True):
+        result = (
+            window_results[0]
+            if len(window_results) == 1
+            else _merge_window_results(window_results)
+        )
+        result.input = input
+        merged.append(result)
+    return merged
+
+
+def _merge_window_results(
+    results: list[InferenceResult | InferenceFailure],
+) -> InferenceResult | InferenceFailure:
+    """
+    Get a document's result from its windows': the most confident answer, with the
+    quotation of the window it came from.
+
+    Confidence is the probability of a positive answer, so a window with a covenant
+    decides the document. If any window failed and none found a covenant, the
+    document fails, as the failed window might have had one.
+    """
+    predicted = [result for result in results if isinstance(result, InferenceResult)]
+    failures = [result for result in results if isinstance(result, InferenceFailure)]
+    if not predicted:
+        return failures[0]
+    best = max(
+        predicted,
+        key=lambda result: (result.answer, result.confidence or 0.0),
+    )
+    if failures and not best.answer:
+        return failures[0]
+    return best
+
+
 class InferenceService(abc.ABC):
     """Abstract base class for inference services."""
 
     options: dict[str, Any]
 
+    supports_streaming: bool = False
+    """Whether the service implements `predict_async` (for `rrc detect --stream`)."""
+    supports_documents: bool = False
+    """Whether the service implements `count_tokens` (for `rrc detect --documents`)."""
+
     def __init__(self, options: dict[str, Any] | None = None):
         if options is None:
             options = {}
@@ -52,22 +220,58 @@ class InferenceService(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def predict(self, inputs: list[InferenceInput]) -> list[InferenceResult | None]:
+    def predict(
+        self, inputs: list[InferenceInput]
+    ) -> list[InferenceResult | InferenceFailure]:
+        """Classify each document, or say why its output couldn't be parsed."""
         pass
 
+    async def predict_async(
+        self, input: InferenceInput
+    ) -> InferenceResult | InferenceFailure:
+        """
+        Classify one document, alongside any other concurrent calls. Only called on
+        services which set `supports_streaming`.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support streaming")
+
     @abc.abstractmethod
     def get_provenance(self) -> Provenance:
         pass
 
+    def get_cache_namespace(self) -> str | None:
+        """
+        Get a string identifying everything besides the document which determines this
+        service's predictions (model, prompt, sampling and parsing parameters, and any
+        options which change outputs), or None if its predictions shouldn't be cached.
+        Only called once the service is entered.
+        """
+        return None
+
+    def count_tokens(self, texts: list[str]) -> list[int]:
+        """
+        Count the tokens in each text, as part of a prompt. Only called on services
+        which set `supports_documents`, once the service is entered.
+        """
+        raise NotImplementedError(f"{type(self).__name__} doesn't count tokens")
+
 
 _MISTRAL_ANSWER_TOKEN_MAP = {True: 5613, False: 2501}
 _MISTRAL_CONFIDENCE_THRESHOLD = 0.75
+_MISTRAL_SAMPLING_OPTIONS = {"max_tokens": 256, "temperature": 0.0, "logprobs": 10}
+_MISTRAL_RETRY_MAX_TOKENS = 1024
 
 
 class MistralInferenceService(InferenceService):
+    supports_documents = True
+
     model_name_or_path: str
     model_download_dir: Path
     vllm_model: vllm.LLM
+    tokenizer: AutoTokenizer
+
+    retry_max_tokens: int
+    window_overlap_tokens: int
 
     _PROMPT_TEMPLATE = """### Instruction:
 Determine whether the property deed contains a racial covenant. A racial covenant is a clause in a document that \
@@ -91,6 +295,12 @@ with spelling and formatting errors fixed.
         super().__init__(options)
         self.model_name_or_path = self.options.get("model_name_or_path")
         self.model_download_dir = self.options.get("model_download_dir")
+        self.retry_max_tokens = self.options.get(
+            "retry_max_tokens", _MISTRAL_RETRY_MAX_TOKENS
+        )
+        self.window_overlap_tokens = self.options.get(
+            "window_overlap_tokens", _DEFAULT_WINDOW_OVERLAP_TOKENS
+        )
 
     def __enter__(self):
         if DEFAULT_DEVICE is None:
@@ -100,7 +310,11 @@ with spelling and formatting errors fixed.
             device=DEFAULT_DEVICE,
             enforce_eager=True,
             download_dir=self.model_download_dir,
-            max_model_len=8192,
+            max_model_len=_MAX_MODEL_LEN,
+        )
+        self.tokenizer = self.vllm_model.get_tokenizer()
+        self._template_tokens = len(
+            self.tokenizer.encode(self._PROMPT_TEMPLATE.format(document=""))
         )
         return self
 
@@ -114,24 +328,67 @@ with spelling and formatting errors fixed.
         return self._PROMPT_TEMPLATE.format(document=input.text)
 
     @require_input_type(InputType.TEXT)
-    def predict(self, inputs: list[InferenceInput]) -> list[InferenceResult | None]:
-        prompts = [self._get_mistral_prompt(input) for input in inputs]
+    def predict(
+        self, inputs: list[InferenceInput]
+    ) -> list[InferenceResult | InferenceFailure]:
+        """
+        Classify each document, retrying truncated outputs with `retry_max_tokens`.
+
+        Documents too long for the model are split into overlapping windows, and the
+        windows' results merged.
+        """
+        window_inputs, owners = self._split_long_documents(inputs)
+        prompts = [self._get_mistral_prompt(input) for input in window_inputs]
         results: list[vllm.RequestOutput] = self.vllm_model.generate(
-            prompts,
-            sampling_params=vllm.SamplingParams(
-                max_tokens=256,
-                temperature=0.0,
-                logprobs=10,
-            ),
+            prompts, sampling_params=vllm.SamplingParams(**_MISTRAL_SAMPLING_OPTIONS)
         )
         parsed_results = [self._parse_output(result) for result in results]
-        for result, input in zip(parsed_results, inputs, strict=True):
-            if result is None:
-                continue
-            result.input = input
-        return parsed_results
+        if truncated := [i for i, r in enumerate(parsed_results) if _is_truncated(r)]:
+            results = self.vllm_model.generate(
+                [prompts[i] for i in truncated],
+                sampling_params=vllm.SamplingParams(
+                    **{**_MISTRAL_SAMPLING_OPTIONS, "max_tokens": self.retry_max_tokens}
+                ),
+            )
+            for i, result in zip(truncated, results, strict=True):
+                parsed_results[i] = self._parse_output(result)
+        return _merge_windows(inputs, owners, parsed_results)
+
+    def _split_long_documents(
+        self, inputs: list[InferenceInput]
+    ) -> tuple[list[InferenceInput], list[int]]:
+        """
+        Get the inputs to generate for: each document, or its windows if its prompt
+        won't fit in the model's context with room for the output.
+
+        Returns:
+            The inputs, and the index of the document each is from.
+        """
+        if any(input.text is None for input in inputs):
+            raise ValueError("Text input is required for text inference")
+        max_document_tokens = (
+            _MAX_MODEL_LEN
+            - max(_MISTRAL_SAMPLING_OPTIONS["max_tokens"], self.retry_max_tokens)
+            - self._template_tokens
+        )
+        lengths = self.count_tokens([input.text for input in inputs])
+        window_inputs, owners = [], []
+        for i, (input, length) in enumerate(zip(inputs, lengths, strict=True)):
+            windows = [input]
+            if length > max_document_tokens:
+                windows = _split_document(
+                    self.tokenizer,
+                    input,
+                    max_document_tokens,
+                    self.window_overlap_tokens,
+                )
+            window_inputs.extend(windows)
+            owners.extend([i] * len(windows))
+        return window_inputs, owners
 
-    def _parse_output(self, output: vllm.RequestOutput) -> InferenceResult | None:
+    def _parse_output(
+        self, output: vllm.RequestOutput
+    ) -> InferenceResult | InferenceFailure:
         try:
             chosen_output = output.outputs[0]
 
@@ -156,12 +413,7 @@ with spelling and formatting errors fixed.
                 confidence=confidence,
             )
         except Exception:
-            LOGGER.error(
-                "Error parsing output (output: '%s'): %s",
-                chosen_output.text,
-                traceback.format_exc(),
-            )
-            return None
+            return _get_failure(chosen_output)
 
     def _compute_confidence(
         self, first_token_logprobs: dict[int, vllm.sequence.Logprob], answer: bool
@@ -183,6 +435,23 @@ with spelling and formatting errors fixed.
             creator=None,
         )
 
+    def count_tokens(self, texts: list[str]) -> list[int]:
+        return _count_tokens(self.tokenizer, texts)
+
+    def get_cache_namespace(self) -> str:
+        return json.dumps(
+            {
+                "service": type(self).__name__,
+                "model": str(self.model_name_or_path),
+                "prompt": self._PROMPT_TEMPLATE,
+                "sampling": _MISTRAL_SAMPLING_OPTIONS,
+                "confidence_threshold": _MISTRAL_CONFIDENCE_THRESHOLD,
+                "retry_max_tokens": self.retry_max_tokens,
+                "window_overlap_tokens": self.window_overlap_tokens,
+            },
+            sort_keys=True,
+        )
+
 
 _QWEN_SYSTEM_MESSAGE = """You are a legal expert which classifies whether a historical property deed contains a racially restrictive covenant, a provision which discriminates on the basis of race, ethnicity, national origin, or other protected class.
 
@@ -194,68 +463,277 @@ Given the text of a deed or excerpt, output a JSON object with the following fie
 _QWEN_ANSWER_TOKEN_INDEX = 5
 _QWEN_ANSWER_TOKEN_MAP = {True: 830, False: 895}
 _QWEN_CONFIDENCE_THRESHOLD = 0.96
+_QWEN_MAX_TOKENS = 512
+_QWEN_RETRY_MAX_TOKENS = 2048
+_QWEN_SAMPLING_OPTIONS = {"temperature": 0.0, "logprobs": 8}
+_QWEN_USER_MESSAGE_PLACEHOLDER = "\0user message\0"
 
 
 class QwenInferenceService(InferenceService):
+    supports_streaming = True
+    supports_documents = True
+
     model_name_or_path: str
     model_download_dir: Path
-    vllm_model: vllm.LLM
+    vllm_model: vllm.LLM | None
+    async_engine: vllm.AsyncLLMEngine | None
     tokenizer: AutoTokenizer
 
+    answer_first: bool
+    use_async_engine: bool
+    retry_max_tokens: int
+    window_overlap_tokens: int
+
     def __init__(self, options: dict[str, Any] = None):
         super().__init__(options)
         self.model_name_or_path = self.options.get("model_name_or_path")
         self.model_download_dir = self.options.get("model_download_dir")
+        self.answer_first = self.options.get("answer_first", False)
+        self.retry_max_tokens = self.options.get(
+            "retry_max_tokens", _QWEN_RETRY_MAX_TOKENS
+        )
+        self.window_overlap_tokens = self.options.get(
+            "window_overlap_tokens", _DEFAULT_WINDOW_OVERLAP_TOKENS
+        )
+        self.use_async_engine = self.options.get("async_engine", False)
+        self.vllm_model = None
+        self.async_engine = None
+        self._request_ids = itertools.count()
 
     def __enter__(self):
-        self.vllm_model = vllm.LLM(
-            model=self.model_name_or_path,
-            device=DEFAULT_DEVICE,
-            enforce_eager=True,
-            download_dir=self.model_download_dir,
-            max_model_len=8192,
-            enable_prefix_caching=True,
-        )
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name_or_path)
+        engine_args = {
+            "model": self.model_name_or_path,
+            "device": DEFAULT_DEVICE,
+            "enforce_eager": True,
+            "download_dir": self.model_download_dir,
+            "max_model_len": _MAX_MODEL_LEN,
+            "enable_prefix_caching": True,
+        }
+        if self.use_async_engine:
+            self.async_engine = vllm.AsyncLLMEngine.from_engine_args(
+                vllm.AsyncEngineArgs(**engine_args)
+            )
+        else:
+            self.vllm_model = vllm.LLM(**engine_args)
+        self.load_tokenizer()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         # TODO: Should we to purge the VLLM model?
-        pass
+        if self.async_engine is not None:
+            self.async_engine.shutdown_background_loop()
 
-    def _get_qwen_prompt(self, input: InferenceInput) -> str:
-        if input.text is None:
-            raise ValueError("Text input is required for text inference")
-
-        user_message = f"<document>{input.text}</document>"
-        return self.tokenizer.apply_chat_template(
+    def load_tokenizer(self) -> None:
+        """Load the tokenizer and tokenize the prompt template around documents."""
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.model_name_or_path, use_fast=True
+        )
+        prefix, suffix = self._get_prompt_template()
+        self._prefix_ids = self.tokenizer.encode(prefix, add_special_tokens=False)
+        self._suffix_ids = self.tokenizer.encode(suffix, add_special_tokens=False)
+
+    def _get_prompt_template(self) -> tuple[str, str]:
+        """
+        Get the rendered chat template before and after the user message.
+
+        The user message follows a newline and precedes a special token, and the
+        tokenizer's pre-tokenization never joins text across either, so tokenizing
+        the parts separately gives the same ids as tokenizing the whole prompt
+        (`benchmarks/prompt_prep.py` checks this).
+        """
+        template = self.tokenizer.apply_chat_template(
             [
                 {"role": "system", "content": _QWEN_SYSTEM_MESSAGE},
-                {"role": "user", "content": user_message},
+                {"role": "user", "content": _QWEN_USER_MESSAGE_PLACEHOLDER},
             ],
             tokenize=False,
             add_generation_prompt=True,
         )
+        prefix, suffix = template.split(_QWEN_USER_MESSAGE_PLACEHOLDER)
+        return prefix, suffix
+
+    def _get_qwen_prompts(self, inputs: list[InferenceInput]) -> list[TokensPrompt]:
+        """
+        Get the prompts for a batch as token ids, so vLLM doesn't tokenize them again.
+
+        Only the documents are tokenized (together, by the fast tokenizer); the ids of
+        the system message and template around them are reused.
+        """
+        if any(input.text is None for input in inputs):
+            raise ValueError("Text input is required for text inference")
+        if not inputs:
+            return []
+
+        documents = self.tokenizer(
+            [f"<document>{input.text}</document>" for input in inputs],
+            add_special_tokens=False,
+            return_attention_mask=False,
+        )["input_ids"]
+        return [
+            TokensPrompt(
+                prompt_token_ids=[*self._prefix_ids, *document, *self._suffix_ids]
+            )
+            for document in documents
+        ]
+
+    def _get_windowed_prompts(
+        self, inputs: list[InferenceInput]
+    ) -> tuple[list[TokensPrompt], list[int]]:
+        """
+        Get the prompts to generate for: each document's, or its windows' if it won't
+        fit in the model's context with room for the output.
+
+        Returns:
+            The prompts, and the index of the document each is for.
+        """
+        max_prompt_tokens = _MAX_MODEL_LEN - max(
+            _QWEN_MAX_TOKENS, self.retry_max_tokens
+        )
+        template_tokens = len(self._prefix_ids) + len(self._suffix_ids)
+        prompts, owners = [], []
+        for i, (input, prompt) in enumerate(
+            zip(inputs, self._get_qwen_prompts(inputs), strict=True)
+        ):
+            windows = [prompt]
+            if len(prompt["prompt_token_ids"]) > max_prompt_tokens:
+                windows = self._get_qwen_prompts(
+                    _split_document(
+                        self.tokenizer,
+                        input,
+                        max_prompt_tokens - template_tokens,
+                        self.window_overlap_tokens,
+                    )
+                )
+            prompts.extend(windows)
+            owners.extend([i] * len(windows))
+        return prompts, owners
 
     @require_input_type(InputType.TEXT)
-    def predict(self, inputs: list[InferenceInput]) -> list[InferenceResult | None]:
-        prompts = [self._get_qwen_prompt(input) for input in inputs]
-        results: list[vllm.RequestOutput] = self.vllm_model.generate(
-            prompts,
-            sampling_params=vllm.SamplingParams(
-                max_tokens=512,
-                temperature=0.0,
-                logprobs=8,
-            ),
+    def predict(
+        self, inputs: list[InferenceInput]
+    ) -> list[InferenceResult | InferenceFailure]:
+        """
+        Classify each document.
+
+        With the `answer_first` option, a first pass only generates up to the answer
+        token. Documents whose answer is negative (or below the confidence threshold)
+        are done at that point, and only the rest are generated in full to extract
+        the quotation. Outputs truncated at `max_tokens` are generated once more with
+        `retry_max_tokens`. Documents too long for the model are split into
+        overlapping windows, and the windows' results merged.
+        """
+        prompts, owners = self._get_windowed_prompts(inputs)
+        parsed_results: list[InferenceResult | InferenceFailure | None]
+        parsed_results = [None] * len(prompts)
+        to_generate = list(range(len(prompts)))
+        if self.answer_first:
+            answers = self._generate(prompts, _QWEN_ANSWER_TOKEN_INDEX + 1)
+            to_generate = []
+            for i, answer in enumerate(answers):
+                if (result := self._parse_answer(answer)) is not None:
+                    parsed_results[i] = result
+                else:
+                    to_generate.append(i)
+        if to_generate:
+            results = self._generate(
+                [prompts[i] for i in to_generate], _QWEN_MAX_TOKENS
+            )
+            for i, result in zip(to_generate, results, strict=True):
+                parsed_results[i] = self._parse_output(result)
+        if truncated := [i for i in to_generate if _is_truncated(parsed_results[i])]:
+            results = self._generate(
+                [prompts[i] for i in truncated], self.retry_max_tokens
+            )
+            for i, result in zip(truncated, results, strict=True):
+                parsed_results[i] = self._parse_output(result)
+        return _merge_windows(inputs, owners, parsed_results)
+
+    async def predict_async(
+        self, input: InferenceInput
+    ) -> InferenceResult | InferenceFailure:
+        """
+        Classify one document on the async engine, which batches it with any other
+        requests in flight. Honors `answer_first` like `predict`.
+        """
+        if input.input_type != InputType.TEXT:
+            raise ValueError(f"Input type for this service must be {InputType.TEXT}")
+        prompts, owners = self._get_windowed_prompts([input])
+        results = await asyncio.gather(
+            *(self._predict_prompt_async(prompt) for prompt in prompts)
+        )
+        (result,) = _merge_windows([input], owners, results)
+        return result
+
+    async def _predict_prompt_async(
+        self, prompt: TokensPrompt
+    ) -> InferenceResult | InferenceFailure:
+        result = None
+        if self.answer_first:
+            answer = await self._generate_async(prompt, _QWEN_ANSWER_TOKEN_INDEX + 1)
+            result = self._parse_answer(answer)
+        if result is None:
+            output = await self._generate_async(prompt, _QWEN_MAX_TOKENS)
+            result = self._parse_output(output)
+        if _is_truncated(result):
+            output = await self._generate_async(prompt, self.retry_max_tokens)
+            result = self._parse_output(output)
+        return result
+
+    def _generate(
+        self, prompts: list[TokensPrompt], max_tokens: int
+    ) -> list[vllm.RequestOutput]:
+        return self.vllm_model.generate(
+            prompts, sampling_params=self._get_sampling_params(max_tokens)
         )
-        parsed_results = [self._parse_output(result) for result in results]
-        for result, input in zip(parsed_results, inputs, strict=True):
-            if result is None:
-                continue
-            result.input = input
-        return parsed_results
 
-    def _parse_output(self, output: vllm.RequestOutput) -> InferenceResult | None:
+    async def _generate_async(
+        self, prompt: TokensPrompt, max_tokens: int
+    ) -> vllm.RequestOutput:
+        if self.async_engine is None:
+            raise RuntimeError("Streaming requires the async_engine option")
+        final_output = None
+        async for output in self.async_engine.generate(
+            prompt,
+            self._get_sampling_params(max_tokens),
+            request_id=str(next(self._request_ids)),
+        ):
+            final_output = output
+        return final_output
+
+    def _get_sampling_params(self, max_tokens: int) -> vllm.SamplingParams:
+        return vllm.SamplingParams(max_tokens=max_tokens, **_QWEN_SAMPLING_OPTIONS)
+
+    def _parse_answer(self, output: vllm.RequestOutput) -> InferenceResult | None:
+        """
+        Get the result of a first pass which stopped at the answer token, if it is
+        negative.
+
+        Returns None if the document needs a full pass: the answer is positive, or
+        the output doesn't have the expected shape.
+        """
+        chosen_output = output.outputs[0]
+        if (
+            chosen_output.logprobs is None
+            or len(chosen_output.logprobs) <= _QWEN_ANSWER_TOKEN_INDEX
+            or len(chosen_output.token_ids) <= _QWEN_ANSWER_TOKEN_INDEX
+        ):
+            return None
+        answer_token = chosen_output.token_ids[_QWEN_ANSWER_TOKEN_INDEX]
+        if answer_token not in _QWEN_ANSWER_TOKEN_MAP.values():
+            return None
+        answer = answer_token == _QWEN_ANSWER_TOKEN_MAP[True]
+        confidence = self._compute_confidence(
+            chosen_output.logprobs[_QWEN_ANSWER_TOKEN_INDEX], answer
+        )
+        if answer and (confidence is None or confidence >= _QWEN_CONFIDENCE_THRESHOLD):
+            return None
+        return InferenceResult(
+            answer=False, raw_passage=None, quotation=None, confidence=confidence
+        )
+
+    def _parse_output(
+        self, output: vllm.RequestOutput
+    ) -> InferenceResult | InferenceFailure:
         try:
             chosen_output = output.outputs[0]
             parsed_json = json.loads(chosen_output.text)
@@ -280,12 +758,7 @@ class QwenInferenceService(InferenceService):
                 confidence=confidence,
             )
         except Exception:
-            LOGGER.error(
-                "Error parsing output (output: '%s'): %s",
-                chosen_output.text,
-                traceback.format_exc(),
-            )
-            return None
+            return _get_failure(chosen_output)
 
     def _compute_confidence(
         self, answer_token_logprobs: dict[int, vllm.sequence.Logprob], answer: bool
@@ -309,3 +782,212 @@ class QwenInferenceService(InferenceService):
             record_type="covenant_predictions",
             creator=None,
         )
+
+    def count_tokens(self, texts: list[str]) -> list[int]:
+        return _count_tokens(self.tokenizer, texts)
+
+    def get_cache_namespace(self) -> str:
+        return json.dumps(self._get_cache_fields(), sort_keys=True)
+
+    def _get_cache_fields(self) -> dict[str, Any]:
+        """Get everything which determines the predictions, for the cache namespace."""
+        # The rendered template covers the system message and the chat template
+        prefix, suffix = self._get_prompt_template()
+        prompt = f"{prefix}<document>{{document}}</document>{suffix}"
+        return {
+            "service": type(self).__name__,
+            "model": str(self.model_name_or_path),
+            "prompt": prompt,
+            "sampling": {**_QWEN_SAMPLING_OPTIONS, "max_tokens": _QWEN_MAX_TOKENS},
+            "confidence_threshold": _QWEN_CONFIDENCE_THRESHOLD,
+            "answer_first": self.answer_first,
+            "retry_max_tokens": self.retry_max_tokens,
+            "window_overlap_tokens": self.window_overlap_tokens,
+        }
+
+
+_REMOTE_MAX_CONCURRENCY = 32
+_REMOTE_MAX_ATTEMPTS = 5
+_REMOTE_TIMEOUT_SECONDS = 300
+# Finish reason of the outputs made up for requests which failed, to parse as failures
+_REQUEST_ERROR_FINISH_REASON = "request_error"
+_TOKEN_ID_PREFIX = "token_id:"
+
+
+class _RemoteCompletion(NamedTuple):
+    """The parts of a `vllm.CompletionOutput` which are parsed, from a remote server."""
+
+    text: str
+    token_ids: list[int]
+    logprobs: list[dict[int, vllm.sequence.Logprob]] | None
+    finish_reason: str | None
+
+
+class _RemoteOutput(NamedTuple):
+    outputs: list[_RemoteCompletion]
+
+
+def _is_retryable(e: BaseException) -> bool:
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (
+            e.response.status_code == 429 or e.response.status_code >= 500
+        )
+    return isinstance(e, requests.ConnectionError | requests.Timeout)
+
+
+class OpenAIInferenceService(QwenInferenceService):
+    """
+    The Qwen model, served by a remote OpenAI-compatible completions endpoint (such as
+    `vllm serve`) rather than loaded in this process.
+
+    Sends the same prompts (as token ids) and parses the outputs the same way; only
+    the tokenizer is loaded locally. Requests go out concurrently over a pool of
+    keep-alive connections, and are retried with backoff on connection errors, 429s
+    and 5xxs.
+
+    Options:
+        api_base_url: Base URL of the API, e.g. "http://host:8000/v1".
+        api_key: Sent as a bearer token, by default from `RRC_OPENAI_API_KEY`.
+        served_model_name: Model name the server knows the model by, by default
+            `model_name_or_path`.
+        max_concurrency: Maximum number of requests in flight at once.
+        max_attempts: Number of times to try each request.
+        timeout: Seconds to wait for each response.
+    """
+
+    api_base_url: str
+    served_model_name: str
+    max_concurrency: int
+
+    def __init__(self, options: dict[str, Any] = None):
+        super().__init__(options)
+        self.api_base_url = self.options.get("api_base_url")
+        self.api_key = self.options.get("api_key") or rrc.utils.io.getenv(
+            "RRC_OPENAI_API_KEY"
+        )
+        self.served_model_name = self.options.get(
+            "served_model_name", self.model_name_or_path
+        )
+        self.max_concurrency = self.options.get(
+            "max_concurrency", _REMOTE_MAX_CONCURRENCY
+        )
+        self.timeout = self.options.get("timeout", _REMOTE_TIMEOUT_SECONDS)
+        self._retrying = tenacity.Retrying(
+            retry=tenacity.retry_if_exception(_is_retryable),
+            stop=tenacity.stop_after_attempt(
+                self.options.get("max_attempts", _REMOTE_MAX_ATTEMPTS)
+            ),
+            wait=tenacity.wait_exponential_jitter(initial=0.5, max=30),
+            before_sleep=tenacity.before_sleep_log(LOGGER, logging.WARNING),
+            reraise=True,
+        )
+
+    def __enter__(self):
+        if not self.api_base_url:
+            raise ValueError("The api_base_url option is required")
+        self.load_tokenizer()
+        self._answer_token_ids = {
+            self.tokenizer.decode([token_id]): token_id
+            for token_id in _QWEN_ANSWER_TOKEN_MAP.values()
+        }
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.max_concurrency
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        if self.api_key:
+            self._session.headers["Authorization"] = f"Bearer {self.api_key}"
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        # Bounds requests from predict_async too, which run on the default executor
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(cancel_futures=True)
+        self._session.close()
+
+    def _get_cache_fields(self) -> dict[str, Any]:
+        # The server picks the weights by this name; the local model is the tokenizer
+        return {**super()._get_cache_fields(), "served_model": self.served_model_name}
+
+    def _generate(
+        self, prompts: list[TokensPrompt], max_tokens: int
+    ) -> list[_RemoteOutput]:
+        return list(
+            self._executor.map(
+                lambda prompt: self._complete(prompt, max_tokens), prompts
+            )
+        )
+
+    async def _generate_async(
+        self, prompt: TokensPrompt, max_tokens: int
+    ) -> _RemoteOutput:
+        return await asyncio.to_thread(self._complete, prompt, max_tokens)
+
+    def _complete(self, prompt: TokensPrompt, max_tokens: int) -> _RemoteOutput:
+        """Get a completion, or an output with the error if the request failed."""
+        payload = {
+            "model": self.served_model_name,
+            "prompt": prompt["prompt_token_ids"],
+            "max_tokens": max_tokens,
+            "temperature": _QWEN_SAMPLING_OPTIONS["temperature"],
+            "logprobs": _QWEN_SAMPLING_OPTIONS["logprobs"],
+            # A vLLM extension: give tokens as "token_id:N" rather than their text
+            "return_tokens_as_token_ids": True,
+        }
+        try:
+            with self._slots:
+                response = self._retrying(self._post, payload)
+            completion = self._get_completion(response["choices"][0])
+        except (requests.RequestException, KeyError, IndexError, ValueError) as e:
+            completion = _RemoteCompletion(
+                repr(e), [], None, _REQUEST_ERROR_FINISH_REASON
+            )
+        return _RemoteOutput([completion])
+
+    def _post(self, payload: dict[str, Any]) -> dict[str, Any]:
+        response = self._session.post(
+            f"{self.api_base_url.rstrip('/')}/completions",
+            json=payload,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def _get_completion(self, choice: dict[str, Any]) -> _RemoteCompletion:
+        """
+        Convert a completion choice to the shape of a vLLM output.
+
+        Tokens are mapped back to ids only as far as the answer token (all the parsing
+        needs).
+        """
+        token_ids, logprobs = [], None
+        if (choice_logprobs := choice.get("logprobs")) is not None:
+            n_tokens = _QWEN_ANSWER_TOKEN_INDEX + 1
+            token_ids = [
+                self._get_token_id(token)
+                for token in choice_logprobs["tokens"][:n_tokens]
+            ]
+            logprobs = [
+                {
+                    self._get_token_id(token): vllm.sequence.Logprob(logprob)
+                    for token, logprob in (top or {}).items()
+                }
+                for top in choice_logprobs["top_logprobs"][:n_tokens]
+            ]
+        return _RemoteCompletion(
+            choice["text"], token_ids, logprobs, choice.get("finish_reason")
+        )
+
+    def _get_token_id(self, token: str) -> int:
+        """
+        Get the id of a token given as "token_id:N", or -1 if it isn't given that way.
+
+        Servers without vLLM's `return_tokens_as_token_ids` give tokens as text, which
+        can't be mapped back to ids in general (byte-level pieces, leading spaces), so
+        only the answer tokens are recognized, by comparing with their decoded text.
+        """
+        if token.startswith(_TOKEN_ID_PREFIX):
+            return int(token.removeprefix(_TOKEN_ID_PREFIX))
+        return self._answer_token_ids.get(token, -1)
@@ -1,15 +1,25 @@
+import functools
+import hashlib
+import itertools
+import os
+import struct
 from collections import defaultdict
-from collections.abc import Iterator
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
 from pathlib import Path
-from typing import TypeVar
+from typing import Any, NamedTuple, TypeVar
 
 import PIL.Image
 import tqdm
+from PIL import TiffImagePlugin
 from rich.console import Console
-from sqlalchemy import select
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
 
 import rrc.utils.click as click
-from rrc.db.models import Page
+from rrc.db import stages
+from rrc.db.models import ManifestDirectory, ManifestFile, Page
 from rrc.db.session import get_session
 from rrc.utils.io import get_image_path
 
@@ -17,81 +27,403 @@ console = Console()
 
 _VALID_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tiff", ".tif", ".bmp"}
 _MIN_FILE_SIZE = 1024  # Below 1 KB is probably not a real image, we'll save our effort
+_HASH_DIGEST_SIZE = 16
+_HASH_CHUNK_SIZE = 1 << 20
 
 _DEFAULT_IMAGE_DIR = get_image_path()
+_DEFAULT_WORKERS = 1
+_DEFAULT_POOL = "thread"
 
+_POOL_CLASS_MAP: dict[str, type[Executor]] = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
 
-def _get_image_paths(directory: Path) -> list[Path]:
-    """Get all image files in directory recursively."""
-    image_paths: list[Path] = []
-    for ext in _VALID_EXTENSIONS:
-        image_paths.extend(directory.rglob(f"*{ext}"))
-    return sorted(
-        [
-            p
-            for p in image_paths
-            if p.stat().st_size >= _MIN_FILE_SIZE and not p.name.startswith(".")
-        ]
-    )
 
+class _ImageFile(NamedTuple):
+    path: Path
+    size: int
+    mtime_ns: int
+    image_path: Path
+    """The path pages are stored under: `path`, resolved if it is a symlink."""
 
-def _validate_and_get_frame_count(path: Path) -> int | None:
-    """Validate image can be opened and return number of frames if multi-frame."""
-    try:
-        with PIL.Image.open(path) as img:
-            n_frames = getattr(img, "n_frames", 1)
-            return n_frames
-    except Exception as e:
-        console.print(f"[red]✗[/red] Failed to open image [cyan]{path}[/cyan]: {e}")
-        return None
-
-
-def _get_existing_paths(session) -> defaultdict[str, set[int | None]]:
-    """Get mapping of image paths to their existing frame indices."""
-    stmt = select(Page.image_path, Page.image_frame_idx)
-    existing = defaultdict(set)
-    for path, frame_idx in session.execute(stmt):
-        existing[path].add(frame_idx)
-    return existing
-
-
-def _create_page_records(session, paths: list[Path]) -> None:
-    """Create Page records for new image paths."""
-    pbar = tqdm.tqdm(total=len(paths), desc="Validating/ingesting images")
-    success = fail = 0
-
-    for batch in _chunks(paths, 1000):
-        pages = []
-        for path in batch:
-            n_frames = _validate_and_get_frame_count(path)
-            if n_frames is None:
-                fail += 1
-                pbar.set_postfix(success=success, failed=fail)
+
+class _ImageWalker:
+    """Single-pass, streaming walk of an image directory tree.
+
+    Directories whose mtime matches the manifest are not listed again; the walker only
+    stats them and descends into their recorded subdirectories. In listed directories,
+    files whose size and mtime match the manifest are skipped. Directory records are
+    only saved by `save_manifest` once the caller has ingested everything yielded, so
+    an interrupted run rescans rather than skipping unfinished directories.
+    """
+
+    def __init__(self, session: Session, root: Path):
+        self.session = session
+        self.root = root.resolve()
+        self.n_listed_dirs = 0
+        self.n_skipped_dirs = 0
+
+        # Plain tuples rather than ORM objects, which would be expired (and lazily
+        # reloaded one by one) after every batch commit during the walk
+        self._known_dirs: dict[str, int] = {}
+        self._subdirs: defaultdict[str, list[str]] = defaultdict(list)
+        stmt = select(
+            ManifestDirectory.path,
+            ManifestDirectory.parent_path,
+            ManifestDirectory.mtime_ns,
+        )
+        for path, parent_path, mtime_ns in session.execute(stmt):
+            self._known_dirs[path] = mtime_ns
+            if parent_path is not None:
+                self._subdirs[parent_path].append(path)
+        self._scanned_dirs: dict[str, int] = {}
+
+    def __iter__(self) -> Iterator[_ImageFile]:
+        stack = [str(self.root)]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime_ns = Path(directory).stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            if self._known_dirs.get(directory) == mtime_ns:
+                self.n_skipped_dirs += 1
+                stack.extend(sorted(self._subdirs[directory], reverse=True))
                 continue
 
-            if n_frames == 1:
-                pages.append(Page(image_path=str(path.resolve()), image_frame_idx=None))
+            self.n_listed_dirs += 1
+            subdirs, files = self._list_directory(directory)
+            yield from self._filter_known_files(directory, files)
+            self._scanned_dirs[directory] = mtime_ns
+            stack.extend(reversed(subdirs))
+
+    def _list_directory(self, directory: str) -> tuple[list[str], list[_ImageFile]]:
+        subdirs: list[str] = []
+        files: list[_ImageFile] = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if (
+                    entry.name.startswith(".")
+                    or Path(entry.name).suffix not in _VALID_EXTENSIONS
+                    or not entry.is_file()
+                ):
+                    continue
+                stat = entry.stat()
+                if stat.st_size >= _MIN_FILE_SIZE:
+                    path = Path(entry.path)
+                    # Only symlinks need resolving, as the walk starts from a resolved
+                    # root and doesn't follow symlinked directories
+                    image_path = path.resolve() if entry.is_symlink() else path
+                    files.append(
+                        _ImageFile(path, stat.st_size, stat.st_mtime_ns, image_path)
+                    )
+        subdirs.sort()
+        files.sort()
+        return subdirs, files
+
+    def _filter_known_files(
+        self, directory: str, files: list[_ImageFile]
+    ) -> Iterator[_ImageFile]:
+        stmt = select(
+            ManifestFile.path, ManifestFile.size, ManifestFile.mtime_ns
+        ).where(ManifestFile.directory_path == directory)
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self.session.execute(stmt)
+        }
+        for file in files:
+            if known.get(str(file.path)) != (file.size, file.mtime_ns):
+                yield file
+
+    def save_manifest(self) -> None:
+        """Record every directory listed during the walk as up to date."""
+        for paths in _chunks(self._scanned_dirs, 1000):
+            self.session.execute(
+                delete(ManifestDirectory).where(ManifestDirectory.path.in_(paths))
+            )
+            self.session.add_all(
+                ManifestDirectory(
+                    path=path,
+                    parent_path=_get_parent_path(path),
+                    mtime_ns=self._scanned_dirs[path],
+                )
+                for path in paths
+            )
+        self.session.commit()
+
+
+def _get_parent_path(path: str) -> str | None:
+    parent = str(Path(path).parent)
+    return parent if parent != path else None
+
+
+def _count_tiff_frames(path: Path) -> int:
+    """Count the frames of a TIFF by following its IFD chain.
+
+    PIL's `n_frames` parses every tag of every IFD; we only need the entry count and
+    next-IFD offset of each one, which is two tiny reads per frame.
+    """
+    with path.open("rb") as f:
+        header = f.read(16)
+        if header[:2] == b"II":
+            endian = "<"
+        elif header[:2] == b"MM":
+            endian = ">"
+        else:
+            raise ValueError("Not a TIFF file")
+
+        (version,) = struct.unpack(f"{endian}H", header[2:4])
+        if version == 42:
+            count_fmt, offset_fmt, entry_size = "H", "I", 12
+            (offset,) = struct.unpack(f"{endian}I", header[4:8])
+        elif version == 43:  # BigTIFF
+            count_fmt, offset_fmt, entry_size = "Q", "Q", 20
+            (offset,) = struct.unpack(f"{endian}Q", header[8:16])
+        else:
+            raise ValueError(f"Unknown TIFF version {version}")
+        count_size = struct.calcsize(count_fmt)
+        offset_size = struct.calcsize(offset_fmt)
+
+        n_frames = 0
+        seen_offsets = set()
+        while offset:
+            if offset in seen_offsets:
+                raise ValueError("Cyclic IFD chain")
+            seen_offsets.add(offset)
+            f.seek(offset)
+            (n_entries,) = struct.unpack(f"{endian}{count_fmt}", f.read(count_size))
+            f.seek(offset + count_size + n_entries * entry_size)
+            (offset,) = struct.unpack(f"{endian}{offset_fmt}", f.read(offset_size))
+            n_frames += 1
+        return n_frames
+
+
+def _validate_and_get_frame_count(path: Path) -> tuple[str | None, int]:
+    """Validate image header can be read and return its format and number of frames."""
+    with PIL.Image.open(path) as img:
+        if img.format == "TIFF":
+            return img.format, _count_tiff_frames(path)
+        return img.format, getattr(img, "n_frames", 1)
+
+
+def _hash_file(path: Path) -> str:
+    """Hash a file's contents, streaming it in chunks."""
+    digest = hashlib.blake2b(digest_size=_HASH_DIGEST_SIZE)
+    with path.open("rb") as f:
+        while chunk := f.read(_HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hash_tiff_frames(path: Path, n_frames: int) -> list[str]:
+    """Hash each frame of a TIFF from its encoded strip or tile data.
+
+    The data is hashed as stored, without decoding, along with the tags needed to
+    interpret it, so a page scanned into two different multi-page TIFFs gets the same
+    hash in both.
+    """
+    hashes = []
+    with PIL.Image.open(path) as img, path.open("rb") as f:
+        for frame_idx in range(n_frames):
+            img.seek(frame_idx)
+            tags = img.tag_v2
+            offsets = tags.get(TiffImagePlugin.STRIPOFFSETS) or tags.get(
+                TiffImagePlugin.TILEOFFSETS
+            )
+            byte_counts = tags.get(TiffImagePlugin.STRIPBYTECOUNTS) or tags.get(
+                TiffImagePlugin.TILEBYTECOUNTS
+            )
+            if offsets is None or byte_counts is None:
+                raise ValueError(f"Frame {frame_idx} has no image data offsets")
+            if isinstance(offsets, int):
+                offsets, byte_counts = (offsets,), (byte_counts,)
+
+            digest = hashlib.blake2b(digest_size=_HASH_DIGEST_SIZE)
+            header = (
+                img.size,
+                img.mode,
+                tags.get(TiffImagePlugin.COMPRESSION),
+                tags.get(TiffImagePlugin.JPEGTABLES),
+            )
+            digest.update(repr(header).encode())
+            for offset, byte_count in zip(offsets, byte_counts, strict=True):
+                f.seek(offset)
+                remaining = byte_count
+                while remaining > 0 and (
+                    chunk := f.read(min(remaining, _HASH_CHUNK_SIZE))
+                ):
+                    digest.update(chunk)
+                    remaining -= len(chunk)
+            hashes.append(digest.hexdigest())
+    return hashes
+
+
+def _hash_frames(path: Path, n_frames: int) -> list[str]:
+    """Hash each frame of a multi-frame image other than a TIFF from its pixels.
+
+    Other formats don't store frames independently (e.g. animated PNGs and GIFs store
+    changes to the previous frame), so the frames are decoded.
+    """
+    hashes = []
+    with PIL.Image.open(path) as img:
+        for frame_idx in range(n_frames):
+            img.seek(frame_idx)
+            digest = hashlib.blake2b(digest_size=_HASH_DIGEST_SIZE)
+            digest.update(repr((img.size, img.mode)).encode())
+            digest.update(img.tobytes())
+            hashes.append(digest.hexdigest())
+    return hashes
+
+
+class _ProbeResult(NamedTuple):
+    n_frames: int | None
+    content_hashes: list[str] | None
+    """One hash per frame, or None if hashing was disabled."""
+    error: str | None
+
+
+def _probe_image(path: Path, hash_content: bool = True) -> _ProbeResult:
+    """Validate an image, count its frames and optionally hash its contents.
+
+    Errors are returned rather than printed so that pool workers stay silent and the
+    main process reports failures in order.
+    """
+    try:
+        image_format, n_frames = _validate_and_get_frame_count(path)
+        content_hashes = None
+        if hash_content:
+            # Go by the format rather than the extension, and give each frame of a
+            # multi-frame file its own hash, so frames aren't taken as duplicates
+            if image_format == "TIFF":
+                content_hashes = _hash_tiff_frames(path, n_frames)
+            elif n_frames > 1:
+                content_hashes = _hash_frames(path, n_frames)
             else:
-                pages.extend(
-                    Page(image_path=str(path.resolve()), image_frame_idx=i)
-                    for i in range(n_frames)
+                content_hashes = [_hash_file(path)]
+        return _ProbeResult(n_frames, content_hashes, None)
+    except Exception as e:
+        return _ProbeResult(None, None, str(e))
+
+
+def _get_existing_paths(session: Session, paths: list[str]) -> set[str]:
+    """Get the subset of image paths which already have Page records."""
+    stmt = select(Page.image_path).where(Page.image_path.in_(paths)).distinct()
+    return set(session.scalars(stmt))
+
+
+def _save_manifest_files(session: Session, files: list[_ImageFile]) -> None:
+    """Record files as seen, replacing any entries from earlier runs."""
+    paths = [str(file.path) for file in files]
+    session.execute(delete(ManifestFile).where(ManifestFile.path.in_(paths)))
+    session.execute(
+        insert(ManifestFile),
+        [
+            {
+                "path": str(file.path),
+                "directory_path": str(file.path.parent),
+                "size": file.size,
+                "mtime_ns": file.mtime_ns,
+            }
+            for file in files
+        ],
+    )
+
+
+def _get_page_rows(
+    path: Path, n_frames: int, content_hashes: list[str] | None
+) -> Iterator[dict[str, Any]]:
+    """Get the Page rows to insert for a validated image."""
+    for frame_idx in range(n_frames):
+        yield {
+            "image_path": str(path),
+            "image_frame_idx": frame_idx if n_frames > 1 else None,
+            "content_hash": content_hashes[frame_idx] if content_hashes else None,
+        }
+
+
+def _create_page_records(
+    session: Session,
+    files: Iterable[_ImageFile],
+    workers: int = _DEFAULT_WORKERS,
+    pool: str = _DEFAULT_POOL,
+    hash_content: bool = True,
+) -> tuple[int, int, int]:
+    """Create Page records for new image files.
+
+    Returns:
+        Counts of files ingested, files which failed validation, and files which
+        already had Page records.
+    """
+    pbar = tqdm.tqdm(desc="Validating/ingesting images", unit="file")
+    success = fail = existing = 0
+
+    with _get_executor(workers, pool) as executor:
+        probe = executor.map if executor is not None else map
+        for batch in _chunks(files, 1000):
+            existing_paths = _get_existing_paths(
+                session, [str(file.image_path) for file in batch]
+            )
+            # A symlink and its target may both be in the batch
+            new_paths = list(
+                dict.fromkeys(
+                    file.image_path
+                    for file in batch
+                    if str(file.image_path) not in existing_paths
                 )
-            success += 1
-            pbar.set_postfix(success=success, failed=fail)
+            )
+            existing += len(batch) - len(new_paths)
 
-        if pages:
-            session.add_all(pages)
+            page_rows: list[dict[str, Any]] = []
+            probe_results = probe(
+                functools.partial(_probe_image, hash_content=hash_content), new_paths
+            )
+            for path, (n_frames, content_hashes, error) in zip(
+                new_paths, probe_results, strict=True
+            ):
+                if n_frames is None:
+                    console.print(
+                        f"[red]✗[/red] Failed to open image [cyan]{path}[/cyan]: {error}"
+                    )
+                    fail += 1
+                    pbar.set_postfix(success=success, failed=fail)
+                    continue
+
+                page_rows.extend(_get_page_rows(path, n_frames, content_hashes))
+                success += 1
+                pbar.set_postfix(success=success, failed=fail)
+
+            # Bulk executemany inserts, which skip the ORM's per-object unit of work
+            if page_rows:
+                page_ids = session.scalars(insert(Page).returning(Page.id), page_rows)
+                stages.add_pending(session, stages.OCR, page_ids)
+            _save_manifest_files(session, batch)
             session.commit()
-        pbar.update(len(batch))
+            pbar.update(len(batch))
+
+    pbar.close()
+    return success, fail, existing
+
+
+def _get_executor(workers: int, pool: str) -> AbstractContextManager[Executor | None]:
+    """Get a pool executor for image validation, or None to validate in-process."""
+    if workers <= 1:
+        return nullcontext()
+    return _POOL_CLASS_MAP[pool](max_workers=workers)
 
 
 T = TypeVar("T")
 
 
-def _chunks(lst: list[T], n: int) -> Iterator[list[T]]:
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+def _chunks(items: Iterable[T], n: int) -> Iterator[list[T]]:
+    """Yield successive n-sized chunks from items."""
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, n)):
+        yield chunk
 
 
 @click.command()
@@ -103,39 +435,54 @@ def _chunks(lst: list[T], n: int) -> Iterator[list[T]]:
     show_default=True,
     help="Directory containing images to ingest",
 )
-def main(input_dir: Path) -> None:
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=_DEFAULT_WORKERS,
+    show_default=True,
+    help="Number of workers validating image headers in parallel",
+)
+@click.option(
+    "--pool",
+    type=click.Choice(list(_POOL_CLASS_MAP)),
+    default=_DEFAULT_POOL,
+    show_default=True,
+    help="Run validation workers as threads (best for network storage) or processes",
+)
+@click.option(
+    "--hash/--no-hash",
+    "hash_content",
+    default=True,
+    show_default=True,
+    help="Hash image contents so duplicate scans are only transcribed and classified once",
+)
+def main(input_dir: Path, workers: int, pool: str, hash_content: bool) -> None:
     """Create Page records for all images in a directory that don't already exist."""
     session = get_session()
 
-    image_paths = _get_image_paths(input_dir)
-    if not image_paths:
-        console.print(
-            f"[yellow]⚠[/yellow] No image files found in [cyan]{input_dir}[/cyan]"
-        )
-        return
-
+    walker = _ImageWalker(session, input_dir)
     console.print(
-        f"[green]✓[/green] Found [bold blue]{len(image_paths)}[/bold blue] image files in [cyan]{input_dir}[/cyan]"
+        f"[green]➤[/green] Scanning [cyan]{input_dir}[/cyan] for new or changed images..."
     )
+    success, fail, existing = _create_page_records(
+        session, walker, workers, pool, hash_content
+    )
+    walker.save_manifest()
 
-    existing_paths = _get_existing_paths(session)
     console.print(
-        f"[green]✓[/green] Found [bold blue]{len(existing_paths)}[/bold blue] existing page records in database"
+        f"[green]✓[/green] Listed [bold blue]{walker.n_listed_dirs}[/bold blue] directories "
+        f"(skipped [bold blue]{walker.n_skipped_dirs}[/bold blue] unchanged)"
     )
-
-    new_paths = [p for p in image_paths if str(p.resolve()) not in existing_paths]
-    if not new_paths:
+    if success + fail + existing == 0:
         console.print(
             "[yellow]⚠[/yellow] No new images to ingest - all images already processed"
         )
         return
 
     console.print(
-        f"[green]➤[/green] Ingesting [bold blue]{len(new_paths)}[/bold blue] new images..."
-    )
-    _create_page_records(session, new_paths)
-    console.print(
-        f"[green]✓[/green] Successfully completed ingesting [bold blue]{len(new_paths)}[/bold blue] new images"
+        f"[green]✓[/green] Successfully completed ingesting [bold blue]{success}[/bold blue] new images "
+        f"([bold red]{fail}[/bold red] failed, [bold blue]{existing}[/bold blue] already in database)"
     )
 
 
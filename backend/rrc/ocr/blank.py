@@ -0,0 +1,26 @@
+"""Cheap detection of blank and near-blank pages, such as blank backs and separators."""
+
+import numpy as np
+
+SKIPPED_BLANK_MODEL_NAME = "skipped_blank"
+"""Provenance model name for records skipped because the page is (nearly) blank."""
+
+DEFAULT_BLANK_THRESHOLD = 0.002
+
+_THUMBNAIL_SIZE = 256
+_INK_CONTRAST = 64
+
+
+def get_ink_coverage(image: np.ndarray) -> float:
+    """
+    Get the fraction of a page covered by ink, estimated on a subsampled thumbnail.
+
+    Ink is any pixel differing markedly from the background level (the median), so
+    this works for both dark-on-light scans and light-on-dark microfilm negatives.
+    """
+    step = max(1, max(image.shape[:2]) // _THUMBNAIL_SIZE)
+    thumbnail = image[::step, ::step].astype(np.int16)
+    if thumbnail.ndim == 3:
+        thumbnail = thumbnail.mean(axis=2)
+    background = np.median(thumbnail)
+    return float(np.mean(np.abs(thumbnail - background) > _INK_CONTRAST))
@@ -0,0 +1,120 @@
+"""
+Compact storage of OCR word geometry, for locating text on the page image.
+
+Each transcription's words are stored as two packed arrays: the character span of
+each word in the transcription text (int32) and its bounding box relative to the page
+size (float16). That is 16 bytes per word, so a dense page of 500 words takes 8 KB.
+"""
+
+import re
+import struct
+from difflib import SequenceMatcher
+from typing import NamedTuple
+
+import numpy as np
+
+_MAGIC = b"RWG1"
+_HEADER = struct.Struct("<4sI")
+
+_MIN_BLOCK_SIZE = 4
+"""Minimum size of a matching block when fuzzily matching a quotation."""
+_MIN_MATCH_RATIO = 0.6
+"""Minimum fraction of a quotation that must fuzzily match the transcription."""
+
+_WHITESPACE_REGEX = re.compile(r"\s+")
+
+
+class WordGeometry(NamedTuple):
+    spans: np.ndarray
+    """(n, 2) int32 array of each word's [start, end) character offsets in the text."""
+    boxes: np.ndarray
+    """(n, 4) float16 array of each word's (x0, y0, x1, y1) box, relative to the page."""
+
+    @classmethod
+    def from_words(
+        cls,
+        spans: list[tuple[int, int]],
+        boxes: list[tuple[float, float, float, float]],
+    ) -> "WordGeometry":
+        return cls(
+            spans=np.array(spans, dtype=np.int32).reshape(-1, 2),
+            boxes=np.array(boxes, dtype=np.float16).reshape(-1, 4),
+        )
+
+    def to_bytes(self) -> bytes:
+        n_words = len(self.spans)
+        return (
+            _HEADER.pack(_MAGIC, n_words)
+            + self.spans.astype("<i4", copy=False).tobytes()
+            + self.boxes.astype("<f2", copy=False).tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "WordGeometry":
+        magic, n_words = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("Not a packed word geometry blob")
+        spans_offset = _HEADER.size
+        boxes_offset = spans_offset + n_words * 2 * 4
+        spans = np.frombuffer(data, "<i4", n_words * 2, spans_offset)
+        boxes = np.frombuffer(data, "<f2", n_words * 4, boxes_offset)
+        return cls(spans=spans.reshape(-1, 2), boxes=boxes.reshape(-1, 4))
+
+    def get_boxes(self, start: int, end: int) -> np.ndarray:
+        """Get the boxes of words overlapping the character range [start, end)."""
+        mask = (self.spans[:, 0] < end) & (self.spans[:, 1] > start)
+        return self.boxes[mask].astype(np.float32)
+
+
+def _normalize(text: str) -> tuple[str, list[int]]:
+    """Lowercase and collapse whitespace, returning the offset of each kept character."""
+    normalized: list[str] = []
+    offsets: list[int] = []
+    pos = 0
+    for match in _WHITESPACE_REGEX.finditer(text):
+        for idx in range(pos, match.start()):
+            normalized.append(text[idx].lower())
+            offsets.append(idx)
+        normalized.append(" ")
+        offsets.append(match.start())
+        pos = match.end()
+    for idx in range(pos, len(text)):
+        normalized.append(text[idx].lower())
+        offsets.append(idx)
+    return "".join(normalized), offsets
+
+
+def find_quotation_span(text: str, quotation: str) -> tuple[int, int] | None:
+    """
+    Find the [start, end) character range of a quotation in a transcription.
+
+    Tries an exact match ignoring case and whitespace first, then falls back to fuzzy
+    matching, since quotations may fix OCR errors. Returns None if neither matches.
+    """
+    norm_text, offsets = _normalize(text)
+    norm_quotation = _normalize(quotation.strip())[0]
+    if not norm_quotation or not norm_text:
+        return None
+
+    if (idx := norm_text.find(norm_quotation)) >= 0:
+        return offsets[idx], offsets[idx + len(norm_quotation) - 1] + 1
+
+    matcher = SequenceMatcher(None, norm_text, norm_quotation, autojunk=False)
+    blocks = [
+        block
+        for block in matcher.get_matching_blocks()
+        if block.size >= _MIN_BLOCK_SIZE
+    ]
+    if sum(block.size for block in blocks) < _MIN_MATCH_RATIO * len(norm_quotation):
+        return None
+    return offsets[blocks[0].a], offsets[blocks[-1].a + blocks[-1].size - 1] + 1
+
+
+def locate_quotation(
+    text: str, geometry: WordGeometry, quotation: str
+) -> np.ndarray | None:
+    """Get the page-relative boxes of the words making up a quotation, if found."""
+    span = find_quotation_span(text, quotation)
+    if span is None:
+        return None
+    return geometry.get_boxes(*span)
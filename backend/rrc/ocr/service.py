@@ -1,4 +1,7 @@
 import abc
+import math
+from collections.abc import Iterator
+from contextlib import ExitStack
 from io import BytesIO
 from typing import Any
 
@@ -8,8 +11,9 @@ from doctr.models import ocr_predictor
 from PIL import Image
 
 from rrc.db.models import Provenance
+from rrc.ocr.geometry import WordGeometry
 from rrc.utils.logger import LOGGER
-from rrc.utils.ml import DEFAULT_DEVICE
+from rrc.utils.ml import DEFAULT_DEVICE, get_available_cores, set_cpu_threads
 from rrc.utils.types import OCRInput, OCRResult
 
 
@@ -19,6 +23,8 @@ class OCRService(abc.ABC):
     options: dict[str, Any]
 
     def __init__(self, options: dict[str, Any] | None = None):
+        if options is None:
+            options = {}
         self.options = options
 
     def __enter__(self):
@@ -27,8 +33,21 @@ class OCRService(abc.ABC):
     def __exit__(self, exc_type, exc_value, traceback):
         pass
 
+    def prepare(self, inputs: list[OCRInput]) -> list[Any]:
+        """
+        Do the CPU-side work (reading, decoding) for inputs ahead of `predict`.
+
+        Called from worker threads, so it must not touch the model. Inputs which are
+        frames of the same file should be passed in the same call so the file is only
+        opened once.
+        """
+        return inputs
+
     @abc.abstractmethod
-    def predict(self, inputs: list[OCRInput]) -> list[OCRResult]:
+    def predict(
+        self, inputs: list[OCRInput], prepared: list[Any] | None = None
+    ) -> list[OCRResult]:
+        """Run OCR on inputs, using the outputs of `prepare` for them if given."""
         pass
 
     @abc.abstractmethod
@@ -36,17 +55,77 @@ class OCRService(abc.ABC):
         pass
 
 
+def _to_rgb(image: np.ndarray) -> np.ndarray:
+    """Expand a grayscale image to the three channels doctr takes."""
+    if image.ndim == 2:
+        return np.repeat(image[:, :, np.newaxis], 3, axis=2)
+    return image
+
+
 _DOCTR_DET_ARCH = "db_resnet50"
 _DOCTR_RECO_ARCH = "crnn_vgg16_bn"
 
+DEFAULT_MAX_PIXELS = 12_000_000
+"""Roughly a legal-size page at 300 DPI; larger images are downscaled to fit."""
+DEFAULT_TARGET_DPI = 300
+DEFAULT_MAX_DECODE_PIXELS = 2 * Image.MAX_IMAGE_PIXELS
+"""PIL's own limit, which it enforces when an image is opened (on its first frame)."""
+DEFAULT_MAX_BATCH_PIXELS = 300_000_000
+
 
 class DoctrOCRService(OCRService):
+    """
+    OCR with doctr.
+
+    Options:
+        max_pixels: Images are downscaled on decode to at most this many pixels.
+        target_dpi: Images with a higher recorded DPI are downscaled to this DPI.
+        grayscale: Decode images to grayscale. Prepared pages take a third of the
+            memory; they are only expanded to the three channels the model takes
+            one chunk at a time, in `predict`.
+        max_decode_pixels: Images (or frames) larger than this are rejected before
+            decoding, to guard against decompression bombs. PIL's own limit
+            (`Image.MAX_IMAGE_PIXELS`, which is process-wide and left as it is)
+            applies too.
+        max_batch_pixels: Batches are passed to the model in chunks of at most this
+            many pixels, so memory is bounded by pixels rather than page count.
+        device: Device to run the model on, by default CUDA or MPS if available.
+            OCR only runs on CPU if this is "cpu".
+        num_threads: Number of threads torch uses within each op on CPU, by default
+            one per core available to the process.
+    """
+
+    max_pixels: int
+    target_dpi: int | None
+    grayscale: bool
+    max_decode_pixels: int
+    max_batch_pixels: int
+    device: str | None
+    num_threads: int | None
+
     def __init__(self, options: dict[str, Any] | None = None):
         super().__init__(options)
+        self.max_pixels = self.options.get("max_pixels", DEFAULT_MAX_PIXELS)
+        self.target_dpi = self.options.get("target_dpi", DEFAULT_TARGET_DPI)
+        self.grayscale = self.options.get("grayscale", True)
+        self.max_decode_pixels = self.options.get(
+            "max_decode_pixels", DEFAULT_MAX_DECODE_PIXELS
+        )
+        self.max_batch_pixels = self.options.get(
+            "max_batch_pixels", DEFAULT_MAX_BATCH_PIXELS
+        )
+        self.device = self.options.get("device") or DEFAULT_DEVICE
+        self.num_threads = self.options.get("num_threads")
 
     def __enter__(self):
-        if DEFAULT_DEVICE is None:
-            raise RuntimeError("No CUDA or MPS device available")
+        if self.device is None:
+            raise RuntimeError(
+                "No CUDA or MPS device available; set the device to cpu to run on CPU"
+            )
+        if self.device == "cpu":
+            # torch defaults to one thread per core on the machine, which oversubscribes
+            # when several OCR processes share it
+            set_cpu_threads(self.num_threads or len(get_available_cores()))
         self.model = ocr_predictor(
             det_arch=_DOCTR_DET_ARCH,
             reco_arch=_DOCTR_RECO_ARCH,
@@ -54,40 +133,99 @@ class DoctrOCRService(OCRService):
             assume_straight_pages=True,
             det_bs=16,
             reco_bs=1024,
-        ).to(DEFAULT_DEVICE)
-        LOGGER.info("Doctr OCR model loaded on device %s", DEFAULT_DEVICE)
+        ).to(self.device)
+        LOGGER.info("Doctr OCR model loaded on device %s", self.device)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         pass
 
-    def predict(self, inputs: list[OCRInput]) -> list[OCRResult]:
-        model_inputs = [self._prepare_input(input) for input in inputs]
-        results: list[doctr.io.Page] = self.model(model_inputs).pages
+    def prepare(self, inputs: list[OCRInput]) -> list[np.ndarray]:
+        with ExitStack() as stack:
+            open_images: dict[str, Image.Image] = {}
+            arrays = []
+            for input in inputs:
+                if input.image_path is None:
+                    img = stack.enter_context(Image.open(BytesIO(input.image)))
+                elif (img := open_images.get(input.image_path)) is None:
+                    img = stack.enter_context(Image.open(input.image_path))
+                    open_images[input.image_path] = img
+                arrays.append(self._prepare_input(img, input.frame_idx))
+            return arrays
+
+    def predict(
+        self, inputs: list[OCRInput], prepared: list[np.ndarray] | None = None
+    ) -> list[OCRResult]:
+        model_inputs = prepared if prepared is not None else self.prepare(inputs)
+        results: list[doctr.io.Page] = []
+        for chunk in self._chunk_by_pixels(model_inputs):
+            results.extend(self.model([_to_rgb(image) for image in chunk]).pages)
         return [
             self._parse_output(result, input)
             for result, input in zip(results, inputs, strict=True)
         ]
 
-    def _prepare_input(self, input: OCRInput) -> Image.Image:
-        img = Image.open(BytesIO(input.image))
-        return np.array(img.convert("RGB"))
+    def _chunk_by_pixels(self, images: list[np.ndarray]) -> Iterator[list[np.ndarray]]:
+        chunk: list[np.ndarray] = []
+        chunk_pixels = 0
+        for image in images:
+            pixels = image.shape[0] * image.shape[1]
+            if chunk and chunk_pixels + pixels > self.max_batch_pixels:
+                yield chunk
+                chunk, chunk_pixels = [], 0
+            chunk.append(image)
+            chunk_pixels += pixels
+        if chunk:
+            yield chunk
+
+    def _prepare_input(self, img: Image.Image, frame_idx: int | None) -> np.ndarray:
+        # Seeking decodes only the requested frame of a multi-page image
+        img.seek(frame_idx or 0)
+        width, height = img.size
+        if width * height > self.max_decode_pixels:
+            raise Image.DecompressionBombError(
+                f"Image has {width * height} pixels, more than the limit of "
+                f"{self.max_decode_pixels}"
+            )
+
+        mode = "L" if self.grayscale else "RGB"
+        target_size = self._get_target_size(img)
+        if target_size is not None:
+            # JPEGs can be decoded directly at a 1/2, 1/4 or 1/8 scale
+            img.draft(mode, target_size)
+        frame = img.convert(mode)
+        if target_size is not None:
+            # Box-reduces by an integer factor, then resamples the remainder
+            frame.thumbnail(target_size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        return np.array(frame)
+
+    def _get_target_size(self, img: Image.Image) -> tuple[int, int] | None:
+        """Get the size to downscale an image to, or None to keep it as is."""
+        width, height = img.size
+        scale = min(1.0, math.sqrt(self.max_pixels / (width * height)))
+        dpi = img.info.get("dpi")
+        if self.target_dpi and dpi and min(dpi) > self.target_dpi:
+            scale = min(scale, self.target_dpi / min(dpi))
+        if scale >= 1.0:
+            return None
+        return max(1, int(width * scale)), max(1, int(height * scale))
 
     def _parse_output(self, page: doctr.io.Page, input: OCRInput) -> OCRResult:
         all_lines: list[doctr.io.Line] = []
         for block in page.blocks:
             all_lines.extend(block.lines)
         all_lines.sort(key=lambda ln: ln.geometry[0][1])
-        span_boxes = {}
+        spans: list[tuple[int, int]] = []
+        boxes: list[tuple[float, float, float, float]] = []
         output_text = ""
         for line_idx, line in enumerate(all_lines):
             for word_idx, word in enumerate(line.words):
-                span = (len(output_text), len(output_text) + len(word.value))
-                span_boxes[span] = (
-                    word.geometry.tolist()
-                    if isinstance(word.geometry, np.ndarray)
-                    else word.geometry
-                )
+                spans.append((len(output_text), len(output_text) + len(word.value)))
+                # Straight pages give ((x0, y0), (x1, y1)); rotated ones give polygons
+                points = np.asarray(word.geometry, dtype=np.float32).reshape(-1, 2)
+                x0, y0 = points.min(axis=0)
+                x1, y1 = points.max(axis=0)
+                boxes.append((x0, y0, x1, y1))
                 output_text += word.value
                 if word_idx < len(line.words) - 1:
                     output_text += " "
@@ -95,6 +233,7 @@ class DoctrOCRService(OCRService):
                 output_text += "\n"
         return OCRResult(
             text=output_text,
+            word_geometry=WordGeometry.from_words(spans, boxes).to_bytes(),
             input=input,
         )
 
@@ -1,17 +1,102 @@
+import functools
+import multiprocessing
+import queue
+from collections.abc import Callable, Iterator
+from typing import Any, NamedTuple
+
 import tqdm
+from PIL import Image
 from rich.console import Console
-from sqlalchemy import select
+from sqlalchemy import insert, select
 from sqlalchemy.orm import Session
 
 import rrc.utils.click as click
+from rrc.db import duplicates, stages
 from rrc.db.models import Page, Provenance, Transcription
 from rrc.db.session import get_session
-from rrc.ocr.service import DoctrOCRService
-from rrc.utils.types import OCRResult
+from rrc.db.writer import DEFAULT_MAX_PENDING, BackgroundWriter
+from rrc.ocr.blank import (
+    DEFAULT_BLANK_THRESHOLD,
+    SKIPPED_BLANK_MODEL_NAME,
+    get_ink_coverage,
+)
+from rrc.ocr.service import (
+    DEFAULT_MAX_BATCH_PIXELS,
+    DEFAULT_MAX_DECODE_PIXELS,
+    DEFAULT_MAX_PIXELS,
+    DEFAULT_TARGET_DPI,
+    DoctrOCRService,
+    OCRService,
+)
+from rrc.utils.logger import LOGGER
+from rrc.utils.ml import get_available_cores, pin_to_cores
+from rrc.utils.prefetch import Prefetcher
+from rrc.utils.types import OCRInput, OCRResult
 
 console = Console()
 
 _DEFAULT_BATCH_SIZE = 50
+_DEFAULT_PREFETCH_WORKERS = 4
+_DEFAULT_PREFETCH_DEPTH = 2
+_PROGRESS_POLL_INTERVAL = 0.5
+# Errors reading or decoding an image, which fail just the pages it holds
+_IMAGE_ERRORS = (Image.DecompressionBombError, OSError, ValueError)
+
+
+class _TranscribeConfig(NamedTuple):
+    service_options: dict[str, Any]
+    batch_size: int
+    prefetch_workers: int
+    prefetch_depth: int
+    blank_threshold: float
+    lease_seconds: int
+    write_queue_size: int
+    max_attempts: int
+    provenance_id: int
+    skipped_provenance_id: int
+
+
+class _PendingBatch(NamedTuple):
+    pages: list[Page]
+    to_transcribe: list[Page]
+    """The canonical pages of the batch, which actually need OCR."""
+    reusable: dict[str, Transcription]
+
+
+class _TranscriptionOutput(NamedTuple):
+    text: str
+    word_geometry: bytes | None
+    provenance_id: int
+
+    @classmethod
+    def from_result(
+        cls, result: OCRResult, provenance_id: int
+    ) -> "_TranscriptionOutput":
+        return cls(result.text, result.word_geometry, provenance_id)
+
+    @classmethod
+    def from_transcription(cls, transcription: Transcription) -> "_TranscriptionOutput":
+        return cls(
+            transcription.text,
+            transcription.word_geometry,
+            transcription.provenance_id,
+        )
+
+
+class _TranscribedBatch(NamedTuple):
+    rows: dict[int, dict[str, Any]]
+    """The Transcription row to insert for each page, by page id."""
+    errors: dict[int, str]
+    """Why each page whose image couldn't be read failed, by page id."""
+    n_blank: int
+
+
+class _LoadedPage(NamedTuple):
+    input: OCRInput
+    image: Any
+    ink_coverage: float
+    error: str | None = None
+    """Why the image couldn't be read, if it couldn't."""
 
 
 @click.command()
@@ -23,13 +108,135 @@ _DEFAULT_BATCH_SIZE = 50
     show_default=True,
     help="Number of pages to process in each batch",
 )
-def main(batch_size: int) -> None:
-    """Process all pages without transcriptions."""
+@click.option(
+    "--prefetch-workers",
+    type=int,
+    default=_DEFAULT_PREFETCH_WORKERS,
+    show_default=True,
+    help="Number of CPU threads reading and decoding images for upcoming batches",
+)
+@click.option(
+    "--prefetch-depth",
+    type=int,
+    default=_DEFAULT_PREFETCH_DEPTH,
+    show_default=True,
+    help="Number of batches to decode ahead of the one being transcribed (0 to disable)",
+)
+@click.option(
+    "--max-pixels",
+    type=int,
+    default=DEFAULT_MAX_PIXELS,
+    show_default=True,
+    help="Downscale images to at most this many pixels before OCR",
+)
+@click.option(
+    "--target-dpi",
+    type=int,
+    default=DEFAULT_TARGET_DPI,
+    show_default=True,
+    help="Downscale images scanned at a higher DPI to this DPI (0 to disable)",
+)
+@click.option(
+    "--grayscale/--color",
+    default=True,
+    show_default=True,
+    help="Convert images to grayscale before OCR",
+)
+@click.option(
+    "--max-decode-pixels",
+    type=int,
+    default=DEFAULT_MAX_DECODE_PIXELS,
+    show_default=True,
+    help="Reject images larger than this many pixels (decompression bomb guard)",
+)
+@click.option(
+    "--max-batch-pixels",
+    type=int,
+    default=DEFAULT_MAX_BATCH_PIXELS,
+    show_default=True,
+    help="Maximum total pixels passed to the OCR model at once",
+)
+@click.option(
+    "--blank-threshold",
+    type=float,
+    default=DEFAULT_BLANK_THRESHOLD,
+    show_default=True,
+    help="Skip OCR for pages with less than this fraction of ink coverage (0 to disable)",
+)
+@click.option(
+    "--device",
+    type=click.Choice(["auto", "cuda", "mps", "cpu"]),
+    default="auto",
+    show_default=True,
+    help="Device to run OCR on; auto uses CUDA or MPS if available",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of OCR processes claiming batches, each with its own model copy "
+    "and (on CPU) a block of the cores",
+)
+@click.option(
+    "--threads-per-worker",
+    type=int,
+    default=None,
+    help="Threads each CPU worker uses per op [default: its share of the cores]",
+)
+@click.option(
+    "--lease-seconds",
+    type=int,
+    default=stages.DEFAULT_LEASE_SECONDS,
+    show_default=True,
+    help="How long a claimed batch is reserved for this process before other "
+    "processes may claim it (e.g. if this one crashed)",
+)
+@click.option(
+    "--write-queue-size",
+    type=int,
+    default=DEFAULT_MAX_PENDING,
+    show_default=True,
+    help="Number of transcribed batches which may wait to be written to the database "
+    "before OCR pauses",
+)
+@click.option(
+    "--max-attempts",
+    type=int,
+    default=stages.DEFAULT_MAX_ATTEMPTS,
+    show_default=True,
+    help="Number of times to try a page whose image can't be read (e.g. it is "
+    "corrupt or over --max-decode-pixels) before setting it aside (see `rrc failed`)",
+)
+def main(
+    batch_size: int,
+    prefetch_workers: int,
+    prefetch_depth: int,
+    max_pixels: int,
+    target_dpi: int,
+    grayscale: bool,
+    max_decode_pixels: int,
+    max_batch_pixels: int,
+    blank_threshold: float,
+    device: str,
+    workers: int,
+    threads_per_worker: int | None,
+    lease_seconds: int,
+    write_queue_size: int,
+    max_attempts: int,
+) -> None:
+    """
+    Process all pages without transcriptions.
+
+    Several processes can run at once against the same database; each claims its own
+    batches. Pages whose images can't be read are returned to the queue, and set
+    aside after `--max-attempts` tries.
+    """
     session = get_session()
-    last_id = 0
 
     # Get count of pending pages
-    pending_count = _get_pending_count(session)
+    pending_count = stages.get_pending_count(session, stages.OCR)
     if pending_count == 0:
         console.print(
             "[yellow]⚠[/yellow] No pending pages found - all pages already transcribed"
@@ -40,54 +247,365 @@ def main(batch_size: int) -> None:
         f"[green]📄[/green] Found [bold blue]{pending_count}[/bold blue] pages pending transcription (batch size: [cyan]{batch_size}[/cyan])"
     )
 
-    # Process in batches
-    with DoctrOCRService() as service:
-        provenance = service.get_provenance()
-        provenance.creator = "transcribe_pending"
-        pbar = tqdm.tqdm(total=pending_count, desc="Processing pages")
-        while True:
-            batch = _get_next_batch(session, batch_size, last_id)
-            if not batch:
-                break
-
-            results = service.predict([page.as_ocr_input() for page in batch])
-            _save_transcriptions(session, batch, results, provenance)
-            last_id = batch[-1].id
-            pbar.update(len(batch))
+    # Only CPU workers need cores of their own; GPU workers mostly wait on the device
+    core_blocks = _get_core_blocks(workers) if workers > 1 and device == "cpu" else None
 
-    console.print(
-        f"[green]✓[/green] Successfully completed transcribing [bold blue]{pending_count}[/bold blue] pages"
+    service_options = {
+        "max_pixels": max_pixels,
+        "target_dpi": target_dpi,
+        "grayscale": grayscale,
+        "max_decode_pixels": max_decode_pixels,
+        "max_batch_pixels": max_batch_pixels,
+        "device": None if device == "auto" else device,
+        "num_threads": threads_per_worker,
+    }
+    provenance = DoctrOCRService(service_options).get_provenance()
+    provenance.creator = "transcribe_pending"
+    skipped_provenance = Provenance(
+        model_name=SKIPPED_BLANK_MODEL_NAME,
+        record_type="transcriptions",
+        creator="transcribe_pending",
+    )
+    session.add_all([provenance, skipped_provenance])
+    session.commit()
+    config = _TranscribeConfig(
+        service_options=service_options,
+        batch_size=batch_size,
+        prefetch_workers=prefetch_workers,
+        prefetch_depth=prefetch_depth,
+        blank_threshold=blank_threshold,
+        lease_seconds=lease_seconds,
+        write_queue_size=write_queue_size,
+        max_attempts=max_attempts,
+        provenance_id=provenance.id,
+        skipped_provenance_id=skipped_provenance.id,
     )
 
+    pbar = tqdm.tqdm(total=pending_count, desc="Processing pages")
+    n_saved = n_blank = 0
 
-def _get_pending_count(session: Session) -> int:
-    stmt = select(Page).where(~Page.transcriptions.any())
-    return len(session.scalars(stmt).all())
+    def on_progress(n_pages: int, n_batch_blank: int) -> None:
+        nonlocal n_saved, n_blank
+        n_saved += n_pages
+        n_blank += n_batch_blank
+        pbar.set_postfix(skipped_blank=n_blank)
+        pbar.update(n_pages)
 
+    if workers == 1:
+        _transcribe(config, on_progress)
+    else:
+        _run_workers(config, workers, core_blocks, on_progress)
 
-def _get_next_batch(session: Session, batch_size: int, last_id: int) -> list[Page]:
-    stmt = (
-        select(Page)
-        .where(~Page.transcriptions.any(), Page.id > last_id)
-        .order_by(Page.id)
-        .limit(batch_size)
+    console.print(
+        f"[green]✓[/green] Successfully completed transcribing [bold blue]{n_saved}[/bold blue] pages"
     )
-    return list(session.scalars(stmt))
 
 
-def _save_transcriptions(
-    session: Session,
-    pages: list[Page],
-    results: list[OCRResult],
-    provenance: Provenance,
+def _transcribe(
+    config: _TranscribeConfig, on_progress: Callable[[int, int], None]
 ) -> None:
-    for page, result in zip(pages, results, strict=True):
-        transcription = Transcription(
-            page=page, provenance=provenance, text=result.text
+    """
+    Claim and transcribe batches of pending pages until none are left.
+
+    Upcoming batches are claimed and decoded in the background, and results are
+    written in the background too, so the model only waits on the database when the
+    writer falls behind. Other processes may be transcribing from the same queue at
+    the same time.
+
+    Args:
+        on_progress: Called with the number of pages saved and how many of them were
+            blank after each batch is written.
+    """
+    owner = stages.get_worker_id()
+    # Pages whose images couldn't be read, left for a later run rather than claimed
+    # again in this one (updated here, read by the prefetch thread)
+    failed_ids: set[int] = set()
+    with (
+        DoctrOCRService(config.service_options) as service,
+        BackgroundWriter(
+            functools.partial(
+                _write_transcriptions, owner=owner, max_attempts=config.max_attempts
+            ),
+            max_pending=config.write_queue_size,
+            on_written=lambda batch, n_saved: on_progress(n_saved, batch.n_blank),
+        ) as writer,
+    ):
+        prefetcher = Prefetcher(
+            _iter_pending_batches(
+                config.batch_size,
+                owner,
+                config.lease_seconds,
+                config.max_attempts,
+                failed_ids,
+            ),
+            functools.partial(_load_pages, service),
+            workers=config.prefetch_workers,
+            depth=config.prefetch_depth,
+            # Frames of one file are decoded together, from a single open handle
+            group_key=lambda page: page.image_path,
+        )
+        for batch, loaded in prefetcher:
+            is_blank = [
+                page.error is None and page.ink_coverage < config.blank_threshold
+                for page in loaded
+            ]
+            to_ocr = [
+                page
+                for page, blank in zip(loaded, is_blank, strict=True)
+                if page.error is None and not blank
+            ]
+            results = iter(
+                service.predict(
+                    [page.input for page in to_ocr], [page.image for page in to_ocr]
+                )
+                if to_ocr
+                else []
+            )
+            outputs = [
+                None
+                if page.error is not None
+                else _TranscriptionOutput("", None, config.skipped_provenance_id)
+                if blank
+                else _TranscriptionOutput.from_result(
+                    next(results), config.provenance_id
+                )
+                for page, blank in zip(loaded, is_blank, strict=True)
+            ]
+            errors = {
+                page.id: loaded_page.error
+                for page, loaded_page in zip(batch.to_transcribe, loaded, strict=True)
+                if loaded_page.error is not None
+            }
+            rows, errors = _get_transcription_rows(batch, outputs, errors)
+            failed_ids.update(errors)
+            writer.submit(_TranscribedBatch(rows, errors, sum(is_blank)))
+
+
+def _get_core_blocks(workers: int) -> list[list[int]]:
+    """
+    Split the available CPU cores into contiguous blocks, one per worker.
+
+    Pinning each worker to its own block keeps workers (and their torch threads) from
+    competing for cores.
+    """
+    cores = get_available_cores()
+    if workers > len(cores):
+        raise click.BadParameter(
+            f"Can't run {workers} workers on {len(cores)} cores", param_hint="--workers"
         )
-        session.add(transcription)
+    return [
+        cores[idx * len(cores) // workers : (idx + 1) * len(cores) // workers]
+        for idx in range(workers)
+    ]
+
 
+def _run_workers(
+    config: _TranscribeConfig,
+    workers: int,
+    core_blocks: list[list[int]] | None,
+    on_progress: Callable[[int, int], None],
+) -> None:
+    """
+    Transcribe pending pages in worker processes, each with its own model, and pinned
+    to its own block of cores if `core_blocks` is given.
+    """
+    if core_blocks is None:
+        console.print(
+            f"[green]⚙[/green] Running [bold blue]{workers}[/bold blue] OCR workers"
+        )
+    else:
+        console.print(
+            f"[green]⚙[/green] Running [bold blue]{workers}[/bold blue] OCR workers across [cyan]{sum(map(len, core_blocks))}[/cyan] cores"
+        )
+
+    # Forking after torch or the database engine is initialized isn't safe
+    context = multiprocessing.get_context("spawn")
+    progress: multiprocessing.Queue = context.Queue()
+    processes = [
+        context.Process(
+            target=_run_worker,
+            args=(config, core_blocks[idx] if core_blocks else None, progress),
+            name=f"ocr-worker-{idx}",
+        )
+        for idx in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        while any(process.is_alive() for process in processes) or not progress.empty():
+            try:
+                on_progress(*progress.get(timeout=_PROGRESS_POLL_INTERVAL))
+            except queue.Empty:
+                pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"OCR workers failed: {', '.join(failed)}")
+
+
+def _run_worker(
+    config: _TranscribeConfig,
+    cores: list[int] | None,
+    progress: multiprocessing.Queue,
+) -> None:
+    if cores is not None:
+        pin_to_cores(cores)
+        service_options = dict(config.service_options)
+        service_options["num_threads"] = service_options["num_threads"] or len(cores)
+        config = config._replace(service_options=service_options)
+    _transcribe(
+        config,
+        lambda n_pages, n_blank: progress.put((n_pages, n_blank)),
+    )
+
+
+def _iter_pending_batches(
+    batch_size: int,
+    owner: str,
+    lease_seconds: int,
+    max_attempts: int,
+    failed_ids: set[int],
+) -> Iterator[tuple[_PendingBatch, list[Page]]]:
+    """Claim pending batches, yielding them along with the pages in each needing OCR.
+
+    Runs on the prefetch thread, so it uses its own session. Pages are detached from it
+    before being handed over, so only their loaded columns may be used. Pages in
+    `failed_ids` are not claimed.
+    """
+    session = get_session()
+    while True:
+        page_ids = stages.claim_batch(
+            session,
+            stages.OCR,
+            batch_size,
+            owner,
+            lease_seconds,
+            max_attempts,
+            exclude=failed_ids,
+        )
+        if not page_ids:
+            break
+
+        pages = _get_pages(session, page_ids)
+        reusable = duplicates.get_reusable_outputs(session, pages, Transcription)
+        to_transcribe = duplicates.get_canonical_pages(pages, reusable)
+        session.close()
+        yield _PendingBatch(pages, to_transcribe, reusable), to_transcribe
+
+
+def _load_pages(service: OCRService, pages: list[Page]) -> list[_LoadedPage]:
+    inputs = [page.as_ocr_input() for page in pages]
+    try:
+        images = service.prepare(inputs)
+    except _IMAGE_ERRORS:
+        # Find the frames which can't be read, so the file's others are still read
+        return [_load_page(service, input) for input in inputs]
+    return [
+        _LoadedPage(input, image, get_ink_coverage(image))
+        for input, image in zip(inputs, images, strict=True)
+    ]
+
+
+def _load_page(service: OCRService, input: OCRInput) -> _LoadedPage:
+    try:
+        (image,) = service.prepare([input])
+    except _IMAGE_ERRORS as e:
+        LOGGER.warning(
+            "Can't read %s (frame %s): %s", input.image_path, input.frame_idx, e
+        )
+        error = (
+            "image_too_large"
+            if isinstance(e, Image.DecompressionBombError)
+            else "invalid_image"
+        )
+        return _LoadedPage(input, None, 0.0, error)
+    return _LoadedPage(input, image, get_ink_coverage(image))
+
+
+def _get_pages(session: Session, page_ids: list[int]) -> list[Page]:
+    stmt = select(Page).where(Page.id.in_(page_ids)).order_by(Page.id)
+    return list(session.scalars(stmt))
+
+
+def _get_transcription_rows(
+    batch: _PendingBatch,
+    outputs: list[_TranscriptionOutput | None],
+    errors: dict[int, str],
+) -> tuple[dict[int, dict[str, Any]], dict[int, str]]:
+    """
+    Get the Transcription rows for a batch, copying outputs (and failures) to any
+    duplicate pages.
+
+    Args:
+        outputs: The transcription output for each page to transcribe, or None if it
+            failed.
+        errors: Why each page to transcribe which failed did, by page id.
+
+    Returns:
+        The row to insert for each page which didn't fail, and why each page which
+        did failed, by page id.
+    """
+    by_hash = {
+        content_hash: _TranscriptionOutput.from_transcription(transcription)
+        for content_hash, transcription in batch.reusable.items()
+    }
+    errors_by_hash: dict[str, str] = {}
+    page_outputs: dict[int, _TranscriptionOutput] = {}
+    page_errors = dict(errors)
+    for page, output in zip(batch.to_transcribe, outputs, strict=True):
+        if output is None:
+            if page.content_hash is not None:
+                errors_by_hash[page.content_hash] = errors[page.id]
+            continue
+        page_outputs[page.id] = output
+        if page.content_hash is not None:
+            by_hash.setdefault(page.content_hash, output)
+    for page in batch.pages:
+        if page.id in page_outputs or page.id in page_errors:
+            continue
+        if page.content_hash in by_hash:
+            page_outputs[page.id] = by_hash[page.content_hash]
+        else:
+            page_errors[page.id] = errors_by_hash[page.content_hash]
+    rows = {
+        page_id: {"page_id": page_id, **output._asdict()}
+        for page_id, output in page_outputs.items()
+    }
+    return rows, page_errors
+
+
+def _write_transcriptions(
+    session: Session, batch: _TranscribedBatch, owner: str, max_attempts: int
+) -> int:
+    """
+    Save a batch's transcriptions, queue its pages for detection, and record its
+    failures.
+
+    Runs on the writer thread. Returns the number of pages saved.
+    """
+    # If our lease lapsed, another worker may have claimed (and transcribed) the page
+    done_ids = stages.complete(session, stages.OCR, batch.rows, owner)
+    if len(done_ids) < len(batch.rows):
+        console.print(
+            f"[yellow]⚠[/yellow] Lost the lease on [cyan]{len(batch.rows) - len(done_ids)}[/cyan] pages; not saving them"
+        )
+    rows = [row for page_id, row in batch.rows.items() if page_id in done_ids]
+    if rows:
+        session.execute(insert(Transcription), rows)
+    stages.add_pending(session, stages.DETECT, sorted(done_ids))
+    if batch.errors:
+        failed_ids = stages.fail(session, stages.OCR, batch.errors, owner, max_attempts)
+        if failed_ids:
+            console.print(
+                f"[yellow]⚠[/yellow] Set aside [cyan]{len(failed_ids)}[/cyan] pages whose images couldn't be read {max_attempts} times; see `rrc failed --stage ocr`"
+            )
     session.commit()
+    return len(done_ids)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import csv
+import json
 from datetime import datetime
 from pathlib import Path
 
@@ -23,6 +24,7 @@ _CSV_FIELDS = [
     "positive_prob",
     "raw_passage",
     "quotation",
+    "quotation_boxes",
     "model_name",
     "prediction_id",
     "created_at",
@@ -43,7 +45,10 @@ def main(output_dir: Path) -> None:
     output_dir.mkdir(parents=True, exist_ok=True)
     session = get_session()
 
-    stmt = select(CovenantPrediction).options(joinedload(CovenantPrediction.page))
+    stmt = select(CovenantPrediction).options(
+        joinedload(CovenantPrediction.page),
+        joinedload(CovenantPrediction.transcription),
+    )
     predictions: list[CovenantPrediction] = session.execute(stmt).scalars().all()
     console.print(
         f"[green]📊[/green] Found [bold blue]{len(predictions)}[/bold blue] predictions to export to [cyan]{output_dir}[/cyan]"
@@ -60,12 +65,16 @@ def main(output_dir: Path) -> None:
         neg_writer.writeheader()
 
         for pred in tqdm.tqdm(predictions, desc="Exporting predictions"):
+            boxes = pred.get_quotation_boxes() if pred.answer else None
             row = {
                 "image_path": pred.page.image_path,
                 "frame_idx": pred.page.image_frame_idx,
                 "positive_prob": pred.confidence,
                 "raw_passage": pred.raw_passage,
                 "quotation": pred.quotation,
+                "quotation_boxes": (
+                    json.dumps(boxes.round(4).tolist()) if boxes is not None else None
+                ),
                 "model_name": pred.provenance.model_name,
                 "prediction_id": pred.id,
                 "created_at": pred.created_at.isoformat(),
@@ -0,0 +1,107 @@
+from rich.console import Console
+from rich.table import Table
+from sqlalchemy import func, select
+
+import rrc.utils.click as click
+from rrc.db import stages
+from rrc.db.models import Page, StageStatus
+from rrc.db.session import get_session
+
+console = Console()
+
+
+@click.command()
+@click.option(
+    "--stage",
+    type=click.Choice([stages.OCR, stages.DETECT]),
+    default=stages.DETECT,
+    show_default=True,
+    help="Stage whose failed pages to list",
+)
+@click.option(
+    "--limit",
+    type=int,
+    default=50,
+    show_default=True,
+    help="Maximum number of failed pages to list",
+)
+@click.option(
+    "--page-id",
+    "page_ids",
+    type=int,
+    multiple=True,
+    help="Only list or requeue this failed page (may be given more than once)",
+)
+@click.option(
+    "--requeue",
+    is_flag=True,
+    help="Return the stage's failed pages (all of them, or those given by `--page-id`) "
+    "to its queue, with a fresh set of attempts",
+)
+def main(stage: str, limit: int, page_ids: tuple[int, ...], requeue: bool) -> None:
+    """
+    List the pages a stage has set aside after failing on them too many times.
+
+    Once a page has failed `--max-attempts` times (e.g. because the model's output was
+    cut off or couldn't be parsed), it is no longer retried. Look into why, then use
+    `--requeue` to run them again, or `--requeue --page-id` to run just some of them.
+    """
+    session = get_session()
+    failed = [StageStatus.stage == stage, StageStatus.state == stages.FAILED]
+    if page_ids:
+        failed.append(StageStatus.page_id.in_(page_ids))
+
+    if requeue:
+        n_requeued = stages.requeue_failed(session, stage, page_ids or None)
+        session.commit()
+        console.print(
+            f"[green]✓[/green] Requeued [cyan]{n_requeued:,}[/cyan] failed pages for [bold]{stage}[/bold]"
+        )
+        return
+
+    total = session.scalar(select(func.count()).where(*failed)) or 0
+    if total == 0:
+        console.print(f"[green]✓[/green] No failed pages for [bold]{stage}[/bold]")
+        return
+
+    reasons = session.execute(
+        select(StageStatus.last_error, func.count())
+        .where(*failed)
+        .group_by(StageStatus.last_error)
+        .order_by(func.count().desc())
+    ).all()
+    console.print(
+        f"[yellow]⚠[/yellow] [bold]{total:,}[/bold] failed pages for [bold]{stage}[/bold]: "
+        + ", ".join(f"{count:,} {reason or 'unknown'}" for reason, count in reasons)
+    )
+
+    table = Table(title=f"Failed {stage} pages")
+    table.add_column("Page", justify="right", style="cyan")
+    table.add_column("Image")
+    table.add_column("Frame", justify="right")
+    table.add_column("Attempts", justify="right", style="magenta")
+    table.add_column("Last error", style="yellow")
+    table.add_column("Updated (UTC)", style="blue")
+    rows = session.execute(
+        select(Page, StageStatus)
+        .join(StageStatus, StageStatus.page_id == Page.id)
+        .where(*failed)
+        .order_by(Page.id)
+        .limit(limit)
+    )
+    for page, status in rows:
+        table.add_row(
+            str(page.id),
+            page.image_path,
+            str(page.image_frame_idx) if page.image_frame_idx is not None else "",
+            str(status.attempts),
+            status.last_error or "",
+            f"{status.updated_at:%Y-%m-%d %H:%M:%S}",
+        )
+    console.print(table)
+    if total > limit:
+        console.print(f"... and {total - limit:,} more (see `--limit`)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+from pathlib import Path
+
+import numpy as np
+import tqdm
+from rich.console import Console
+from rich.table import Table
+from sqlalchemy import func, select
+
+import rrc.utils.click as click
+from rrc.db.models import CovenantPrediction, Page, Provenance, Transcription
+from rrc.db.session import get_session
+from rrc.inference.prefilter import PREFILTER_MODEL_NAME, KeywordPrefilter, load_terms
+from rrc.ocr.blank import SKIPPED_BLANK_MODEL_NAME
+
+console = Console()
+
+_DEFAULT_THRESHOLDS = (0.5, 1.0, 1.5, 2.0)
+_CHUNK_SIZE = 1000
+
+
+@click.command()
+@click.option(
+    "-t",
+    "--threshold",
+    "thresholds",
+    type=float,
+    multiple=True,
+    default=_DEFAULT_THRESHOLDS,
+    show_default=True,
+    help="Prefilter threshold to evaluate (may be given more than once)",
+)
+@click.option(
+    "--terms",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="JSON object mapping prefilter terms to their weights [default: built-in "
+    "terms]",
+)
+@click.option(
+    "--show-missed",
+    type=int,
+    default=5,
+    show_default=True,
+    help="Number of positives missed at the lowest threshold to show",
+)
+def main(thresholds: tuple[float, ...], terms: Path | None, show_missed: int) -> None:
+    """
+    Report how the keyword prefilter would do against existing model predictions.
+
+    For each threshold, shows how many pages the model called positive would still be
+    sent to it (recall) and how many pages would skip it. Pick the highest threshold
+    whose recall you can accept and pass it to `rrc detect --prefilter-threshold`.
+
+    Predictions copied to duplicate scans aren't counted, as the model was only run
+    on one page of each.
+    """
+    session = get_session()
+    prefilter = KeywordPrefilter(load_terms(terms) if terms is not None else None)
+
+    stmt = (
+        select(
+            CovenantPrediction.page_id,
+            CovenantPrediction.provenance_id,
+            Page.content_hash,
+            CovenantPrediction.answer,
+            CovenantPrediction.quotation,
+            Transcription.text,
+        )
+        .join(CovenantPrediction.page)
+        .join(CovenantPrediction.transcription)
+        .join(CovenantPrediction.provenance)
+        .where(
+            Provenance.model_name.not_in(
+                [SKIPPED_BLANK_MODEL_NAME, PREFILTER_MODEL_NAME]
+            )
+        )
+        .order_by(CovenantPrediction.id)
+    )
+    count_stmt = select(func.count()).select_from(stmt.subquery())
+    total = session.scalar(count_stmt) or 0
+    if total == 0:
+        console.print(
+            "[yellow]⚠[/yellow] No model predictions found - run `rrc detect` without the prefilter on a sample first"
+        )
+        return
+
+    # A page predicted more than once counts as positive if any prediction was. The
+    # first prediction of each content hash under a provenance is the one the model
+    # made; later ones were copied to duplicates of its page
+    page_scores: dict[int, float] = {}
+    positives: dict[int, str | None] = {}
+    predicted: set[tuple[str, int]] = set()
+    with tqdm.tqdm(total=total, desc="Scoring pages") as pbar:
+        for rows in session.execute(
+            stmt.execution_options(yield_per=_CHUNK_SIZE)
+        ).partitions():
+            pbar.update(len(rows))
+            made = []
+            for row in rows:
+                _, provenance_id, content_hash, *_ = row
+                if content_hash is None:
+                    made.append(row)
+                elif (content_hash, provenance_id) not in predicted:
+                    predicted.add((content_hash, provenance_id))
+                    made.append(row)
+            if not made:
+                continue
+            scores = prefilter.score([text for *_, text in made])
+            for (page_id, _, _, answer, quotation, _), score in zip(
+                made, scores.tolist(), strict=True
+            ):
+                page_scores[page_id] = score
+                if answer:
+                    positives[page_id] = quotation
+
+    page_ids = np.fromiter(page_scores, dtype=np.int64, count=len(page_scores))
+    scores = np.fromiter(page_scores.values(), dtype=np.float32, count=len(page_ids))
+    is_positive = np.isin(page_ids, list(positives))
+    n_positive = int(is_positive.sum())
+
+    table = Table(title=f"Keyword prefilter on {len(page_ids):,} predicted pages")
+    table.add_column("Threshold", justify="right", style="cyan")
+    table.add_column("Positives kept", justify="right", style="green")
+    table.add_column("Recall", justify="right", style="bold")
+    table.add_column("Pages sent to model", justify="right", style="blue")
+    table.add_column("Model calls saved", justify="right", style="magenta")
+    for threshold in sorted(thresholds):
+        kept = scores >= threshold
+        n_kept_positive = int((kept & is_positive).sum())
+        recall = n_kept_positive / n_positive if n_positive else 1.0
+        n_sent = int(kept.sum())
+        table.add_row(
+            f"{threshold:g}",
+            f"{n_kept_positive:,}/{n_positive:,}",
+            f"{recall:.2%}",
+            f"{n_sent:,}",
+            f"{1 - n_sent / len(page_ids):.1%}",
+        )
+    console.print(table)
+
+    for threshold in sorted(thresholds):
+        missed = page_ids[is_positive & (scores < threshold)]
+        if len(missed) == 0:
+            continue
+        console.print(
+            f"[yellow]⚠[/yellow] [bold]{len(missed):,}[/bold] positives would be missed at threshold [cyan]{threshold:g}[/cyan], e.g.:"
+        )
+        for page_id in missed[:show_missed].tolist():
+            console.print(
+                f"  page [cyan]{page_id}[/cyan] (score {page_scores[page_id]:g}): {positives[page_id]!r}"
+            )
+        break
+
+
+if __name__ == "__main__":
+    main()
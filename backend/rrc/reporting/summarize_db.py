@@ -18,9 +18,13 @@ def create_image_stats_table(session) -> Table:
 
     total_pages = session.scalar(select(func.count(Page.id)))
     unique_images = session.scalar(select(func.count(func.distinct(Page.image_path))))
+    unique_contents = session.scalar(
+        select(func.count(func.distinct(Page.content_hash)))
+    )
 
     table.add_row("Total Pages", f"{total_pages:,}")
     table.add_row("Unique Image Files", f"{unique_images:,}")
+    table.add_row("Unique Page Contents (hashed)", f"{unique_contents:,}")
     return table
 
 
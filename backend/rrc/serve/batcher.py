@@ -0,0 +1,167 @@
+"""
+Dynamic batching of concurrent requests to a model.
+
+Models are much faster per item on batches, but requests to a server arrive one page
+at a time. A `MicroBatcher` queues items from concurrent requests and runs them
+through the model together: a batch runs once `max_batch_size` items are waiting, or
+`max_wait_seconds` after its first item arrived, whichever is sooner. While a batch
+runs, the next one fills.
+"""
+
+import asyncio
+import collections
+from collections.abc import Callable
+from typing import Any, Generic, TypeVar
+
+from rrc.utils.logger import LOGGER
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class QueueFullError(Exception):
+    """Raised when a batcher already has as many items pending as it accepts."""
+
+
+class RequestTooLargeError(Exception):
+    """Raised for more items than a batcher ever accepts at once, however idle."""
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Collects items from concurrent callers into batches for `predict`.
+
+    `predict` runs on a worker thread, one batch at a time. Callers are turned away
+    with `QueueFullError` once `max_pending` items are queued or running, so a
+    backlog shows up as errors clients can back off on, rather than ever-growing
+    latency. Callers with more than `max_pending` items at once could never be
+    accepted, so get `RequestTooLargeError` instead. Items whose callers have gone
+    away (cancelling their futures) stop counting as soon as they do.
+    """
+
+    predict: Callable[[list[T]], list[R]]
+    max_batch_size: int
+    max_wait_seconds: float
+    max_pending: int
+    n_batches: int
+    n_items: int
+
+    def __init__(
+        self,
+        predict: Callable[[list[T]], list[R]],
+        *,
+        max_batch_size: int,
+        max_wait_seconds: float,
+        max_pending: int,
+    ):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.max_pending = max_pending
+        self.n_batches = 0
+        self.n_items = 0
+        self._queue: collections.deque[tuple[T, asyncio.Future[R]]] = (
+            collections.deque()
+        )
+        # Queued items whose futures are still pending; the queue may also hold
+        # cancelled ones until a batch is formed
+        self._n_queued = 0
+        self._n_running = 0
+        self._arrived = asyncio.Event()
+
+    @property
+    def n_pending(self) -> int:
+        """The number of items queued or in the running batch."""
+        return self._n_queued + self._n_running
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "queued": self._n_queued,
+            "in_batch": self._n_running,
+            "max_pending": self.max_pending,
+            "batches": self.n_batches,
+            "items": self.n_items,
+            "mean_batch_size": self.n_items / self.n_batches if self.n_batches else 0,
+        }
+
+    def check_capacity(self, n_items: int) -> None:
+        """
+        Raise `RequestTooLargeError` if `n_items` items would never be accepted, or
+        `QueueFullError` if they wouldn't be accepted now.
+        """
+        if n_items > self.max_pending:
+            raise RequestTooLargeError(
+                f"{n_items} items is more than the {self.max_pending} accepted at once"
+            )
+        if self.n_pending + n_items > self.max_pending:
+            raise QueueFullError(
+                f"{self.n_pending} items pending; can't accept {n_items} more"
+            )
+
+    async def submit(self, items: list[T]) -> list[R]:
+        """
+        Get the model's results for items, batched with any other callers'.
+
+        The items are accepted all together or not at all.
+        """
+        self.check_capacity(len(items))
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in items]
+        for future in futures:
+            future.add_done_callback(self._on_queued_done)
+        self._queue.extend(zip(items, futures, strict=True))
+        self._n_queued += len(items)
+        self._arrived.set()
+        return list(await asyncio.gather(*futures))
+
+    async def run(self) -> None:
+        """Form and run batches until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._queue:
+                self._arrived.clear()
+                await self._arrived.wait()
+
+            # Give other callers until the deadline to fill the batch
+            deadline = loop.time() + self.max_wait_seconds
+            while self._n_queued < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), remaining)
+                except TimeoutError:
+                    break
+
+            batch = []
+            while self._queue and len(batch) < self.max_batch_size:
+                item, future = self._queue.popleft()
+                # Skip items whose callers have gone away (already uncounted)
+                if future.remove_done_callback(self._on_queued_done):
+                    self._n_queued -= 1
+                    batch.append((item, future))
+            if batch:
+                await self._run_batch(batch)
+
+    def _on_queued_done(self, future: asyncio.Future[R]) -> None:
+        """Stop counting a queued item once its caller has gone away."""
+        self._n_queued -= 1
+
+    async def _run_batch(self, batch: list[tuple[T, asyncio.Future[R]]]) -> None:
+        self._n_running = len(batch)
+        try:
+            results = await asyncio.to_thread(self.predict, [item for item, _ in batch])
+        except Exception as e:
+            LOGGER.exception("Error running a batch of %d items", len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results, strict=True):
+                if not future.done():
+                    future.set_result(result)
+            self.n_batches += 1
+            self.n_items += len(batch)
+        finally:
+            self._n_running = 0
@@ -0,0 +1,431 @@
+"""
+An HTTP server which keeps the OCR and detection models loaded between requests.
+
+Each `rrc ocr` or `rrc detect` run loads its model from scratch. `rrc serve` loads them
+once and takes pages over HTTP, so other pipelines can submit pages without waiting
+for a cold start. Concurrent requests are batched together for the models (see
+`rrc.serve.batcher`).
+
+Endpoints:
+    POST /ocr: Transcribe uploaded images (every frame of multi-page TIFFs).
+    POST /detect: Classify texts, as `rrc detect` would.
+    GET /health: Whether the models are up, and their queues.
+"""
+
+import asyncio
+import contextlib
+from collections.abc import AsyncIterator
+from io import BytesIO
+from pathlib import Path
+from typing import NamedTuple
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image, UnidentifiedImageError
+from pydantic import BaseModel
+from rich.console import Console
+
+import rrc.utils.click as click
+from rrc.inference.cache import (
+    DEFAULT_MAX_CACHE_MB,
+    CachedInferenceService,
+    PredictionCache,
+)
+from rrc.inference.detect_pending import (
+    DEFAULT_MODEL_DOWNLOAD_DIR,
+    DEFAULT_MODEL_NAME_OR_PATH,
+    DEFAULT_MODEL_TYPE,
+    MODEL_TYPE_CLASS_MAP,
+)
+from rrc.inference.service import InferenceService
+from rrc.ocr.service import DoctrOCRService, OCRService
+from rrc.serve.batcher import MicroBatcher, QueueFullError, RequestTooLargeError
+from rrc.utils.types import InferenceFailure, InferenceInput, InferenceResult, OCRInput
+
+console = Console()
+
+_DEFAULT_HOST = "127.0.0.1"
+_DEFAULT_PORT = 8000
+_DEFAULT_OCR_MAX_BATCH_SIZE = 16
+_DEFAULT_DETECT_MAX_BATCH_SIZE = 256
+_DEFAULT_MAX_WAIT_MS = 20
+_DEFAULT_MAX_PENDING = 1024
+# Seconds clients are asked to wait before retrying when the queue is full
+_RETRY_AFTER_SECONDS = 1
+
+
+class _ServeConfig(NamedTuple):
+    ocr_max_batch_size: int
+    detect_max_batch_size: int
+    max_wait_seconds: float
+    max_pending: int
+
+
+class DetectRequest(BaseModel):
+    texts: list[str]
+
+
+class Prediction(BaseModel):
+    answer: bool | None
+    """Whether the text has a covenant, or None if the model's output couldn't be
+    parsed (see `error`)."""
+    confidence: float | None = None
+    raw_passage: str | None = None
+    quotation: str | None = None
+    error: str | None = None
+
+
+class DetectResponse(BaseModel):
+    predictions: list[Prediction]
+
+
+class TranscribedPage(BaseModel):
+    frame_idx: int | None
+    text: str
+
+
+class TranscribedFile(BaseModel):
+    filename: str | None
+    pages: list[TranscribedPage]
+
+
+class OCRResponse(BaseModel):
+    files: list[TranscribedFile]
+
+
+def _get_ocr_inputs(image: bytes) -> list[OCRInput]:
+    """Get an input for each frame of an image."""
+    with Image.open(BytesIO(image)) as img:
+        n_frames = getattr(img, "n_frames", 1)
+    return [
+        OCRInput(image=image, frame_idx=frame_idx if n_frames > 1 else None)
+        for frame_idx in range(n_frames)
+    ]
+
+
+def _get_prediction(result: InferenceResult | InferenceFailure) -> Prediction:
+    if isinstance(result, InferenceFailure):
+        return Prediction(answer=None, error=result.reason.value)
+    return Prediction(
+        answer=result.answer,
+        confidence=result.confidence,
+        raw_passage=result.raw_passage,
+        quotation=result.quotation,
+    )
+
+
+def _get_busy_error(e: QueueFullError) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=f"Server busy: {e}",
+        headers={"Retry-After": str(_RETRY_AFTER_SECONDS)},
+    )
+
+
+def _get_too_large_error(e: RequestTooLargeError) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Request too large: {e}; split it up")
+
+
+def create_app(
+    ocr_service: OCRService | None,
+    inference_service: InferenceService | None,
+    config: _ServeConfig,
+) -> FastAPI:
+    """
+    Create the app. The services are entered (loading their models) when it starts,
+    and exited when it stops.
+    """
+    batchers: dict[str, MicroBatcher] = {}
+    if ocr_service is not None:
+        batchers["ocr"] = MicroBatcher(
+            lambda items: ocr_service.predict(
+                [input for input, _ in items], [prepared for _, prepared in items]
+            ),
+            max_batch_size=config.ocr_max_batch_size,
+            max_wait_seconds=config.max_wait_seconds,
+            max_pending=config.max_pending,
+        )
+    if inference_service is not None:
+        batchers["detect"] = MicroBatcher(
+            inference_service.predict,
+            max_batch_size=config.detect_max_batch_size,
+            max_wait_seconds=config.max_wait_seconds,
+            max_pending=config.max_pending,
+        )
+    tasks: dict[str, asyncio.Task] = {}
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+        with contextlib.ExitStack() as stack:
+            for service in (ocr_service, inference_service):
+                if service is not None:
+                    stack.enter_context(service)
+            for name, batcher in batchers.items():
+                tasks[name] = asyncio.create_task(batcher.run())
+            console.print(
+                f"[green]✓[/green] Serving [cyan]{', '.join(batchers)}[/cyan]"
+            )
+            try:
+                yield
+            finally:
+                for task in tasks.values():
+                    task.cancel()
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    app = FastAPI(title="RRC Pipeline", lifespan=lifespan)
+
+    def get_batcher(name: str) -> MicroBatcher:
+        if name not in batchers:
+            raise HTTPException(status_code=404, detail=f"{name} is not being served")
+        return batchers[name]
+
+    @app.post("/ocr")
+    async def ocr(files: list[UploadFile]) -> OCRResponse:
+        batcher = get_batcher("ocr")
+        images = [await file.read() for file in files]
+        try:
+            inputs = await asyncio.to_thread(
+                lambda: [_get_ocr_inputs(image) for image in images]
+            )
+            flat_inputs = [input for file_inputs in inputs for input in file_inputs]
+            # Don't spend time decoding pages which won't be accepted
+            batcher.check_capacity(len(flat_inputs))
+            # Decode on a worker thread, so the model only waits on the batcher
+            prepared = await asyncio.to_thread(ocr_service.prepare, flat_inputs)
+        except QueueFullError as e:
+            raise _get_busy_error(e) from e
+        except RequestTooLargeError as e:
+            raise _get_too_large_error(e) from e
+        except (
+            UnidentifiedImageError,
+            Image.DecompressionBombError,
+            ValueError,
+            OSError,
+        ) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {e}") from e
+        try:
+            results = iter(
+                await batcher.submit(list(zip(flat_inputs, prepared, strict=True)))
+            )
+        except QueueFullError as e:
+            raise _get_busy_error(e) from e
+        return OCRResponse(
+            files=[
+                TranscribedFile(
+                    filename=file.filename,
+                    pages=[
+                        TranscribedPage(
+                            frame_idx=input.frame_idx, text=next(results).text
+                        )
+                        for input in file_inputs
+                    ],
+                )
+                for file, file_inputs in zip(files, inputs, strict=True)
+            ]
+        )
+
+    @app.post("/detect")
+    async def detect(request: DetectRequest) -> DetectResponse:
+        batcher = get_batcher("detect")
+        # As in `rrc detect`, blank pages are negative without running the model
+        to_model = [text for text in request.texts if text.strip()]
+        try:
+            results = iter(
+                await batcher.submit([InferenceInput(text=text) for text in to_model])
+            )
+        except QueueFullError as e:
+            raise _get_busy_error(e) from e
+        except RequestTooLargeError as e:
+            raise _get_too_large_error(e) from e
+        return DetectResponse(
+            predictions=[
+                _get_prediction(next(results))
+                if text.strip()
+                else Prediction(answer=False)
+                for text in request.texts
+            ]
+        )
+
+    @app.get("/health")
+    async def health() -> JSONResponse:
+        stopped = [name for name, task in tasks.items() if task.done()]
+        status = "ok" if len(tasks) == len(batchers) and not stopped else "error"
+        return JSONResponse(
+            status_code=200 if status == "ok" else 503,
+            content={
+                "status": status,
+                "services": {
+                    name: {"running": name not in stopped, **batcher.get_stats()}
+                    for name, batcher in batchers.items()
+                },
+            },
+        )
+
+    return app
+
+
+@click.command()
+@click.option("--host", default=_DEFAULT_HOST, show_default=True)
+@click.option("--port", type=int, default=_DEFAULT_PORT, show_default=True)
+@click.option(
+    "--ocr/--no-ocr", default=True, show_default=True, help="Serve the OCR model"
+)
+@click.option(
+    "--detect/--no-detect",
+    default=True,
+    show_default=True,
+    help="Serve the detection model",
+)
+@click.option(
+    "--ocr-device",
+    type=click.Choice(["auto", "cuda", "mps", "cpu"]),
+    default="auto",
+    show_default=True,
+    help="Device to run OCR on; auto uses CUDA or MPS if available",
+)
+@click.option(
+    "--model-name-or-path",
+    "-m",
+    type=str,
+    default=DEFAULT_MODEL_NAME_OR_PATH,
+    show_default=True,
+    help="Name or path of the detection model to use",
+)
+@click.option(
+    "--model-download-dir",
+    "-d",
+    type=click.Path(path_type=Path),
+    default=DEFAULT_MODEL_DOWNLOAD_DIR,
+    show_default=True,
+)
+@click.option(
+    "--model-type",
+    "-t",
+    type=click.Choice(list(MODEL_TYPE_CLASS_MAP)),
+    default=DEFAULT_MODEL_TYPE,
+    show_default=True,
+    help="openai sends the qwen prompts to a remote server (see --api-base-url)",
+)
+@click.option(
+    "--api-base-url",
+    type=str,
+    default=None,
+    help="Base URL of the OpenAI-compatible API serving the model with the openai "
+    "model type (the key is read from RRC_OPENAI_API_KEY)",
+)
+@click.option(
+    "--ocr-max-batch-size",
+    type=int,
+    default=_DEFAULT_OCR_MAX_BATCH_SIZE,
+    show_default=True,
+    help="Maximum number of pages to transcribe at once",
+)
+@click.option(
+    "--detect-max-batch-size",
+    type=int,
+    default=_DEFAULT_DETECT_MAX_BATCH_SIZE,
+    show_default=True,
+    help="Maximum number of texts to classify at once",
+)
+@click.option(
+    "--max-wait-ms",
+    type=float,
+    default=_DEFAULT_MAX_WAIT_MS,
+    show_default=True,
+    help="How long to hold a batch open for more requests once it has its first page",
+)
+@click.option(
+    "--max-pending",
+    type=int,
+    default=_DEFAULT_MAX_PENDING,
+    show_default=True,
+    help="Number of pages each model may have queued or running before requests "
+    "are turned away with 503 (Retry-After); requests with more pages get 413",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    show_default=True,
+    help="Reuse predictions for text the detection model has classified before, "
+    "from the cache `rrc detect` uses",
+)
+@click.option(
+    "--cache-size-mb",
+    type=int,
+    default=DEFAULT_MAX_CACHE_MB,
+    show_default=True,
+    help="Size past which the least recently used cached predictions are evicted",
+)
+def main(
+    host: str,
+    port: int,
+    ocr: bool,
+    detect: bool,
+    ocr_device: str,
+    model_name_or_path: str,
+    model_download_dir: Path,
+    model_type: str,
+    api_base_url: str | None,
+    ocr_max_batch_size: int,
+    detect_max_batch_size: int,
+    max_wait_ms: float,
+    max_pending: int,
+    cache: bool,
+    cache_size_mb: int,
+) -> None:
+    """
+    Serve the OCR and detection models over HTTP, keeping them loaded.
+
+    Concurrent requests are batched for the models: a batch runs once it is full or
+    `--max-wait-ms` after its first page arrived. Requests beyond `--max-pending`
+    pages are turned away with 503 until the queue drains, and requests with more than
+    `--max-pending` pages of their own with 413. Runs in one process, so
+    each model is loaded once.
+    """
+    if not ocr and not detect:
+        raise click.UsageError("Nothing to serve: pass --ocr and/or --detect")
+    if detect and (model_type == "openai") != (api_base_url is not None):
+        raise click.BadParameter(
+            "Required with, and only with, the openai model type",
+            param_hint="--api-base-url",
+        )
+
+    ocr_service = None
+    if ocr:
+        ocr_service = DoctrOCRService(
+            {"device": None if ocr_device == "auto" else ocr_device}
+        )
+    inference_service = None
+    if detect:
+        inference_service = MODEL_TYPE_CLASS_MAP[model_type](
+            {
+                "model_name_or_path": model_name_or_path,
+                "model_download_dir": model_download_dir,
+                "api_base_url": api_base_url,
+                "max_concurrency": detect_max_batch_size,
+            }
+        )
+        if cache:
+            inference_service = CachedInferenceService(
+                inference_service,
+                PredictionCache(max_bytes=cache_size_mb * 1024 * 1024),
+            )
+    console.print(
+        f"[green]🌐[/green] Starting server on [cyan]http://{host}:{port}[/cyan]"
+    )
+    app = create_app(
+        ocr_service,
+        inference_service,
+        _ServeConfig(
+            ocr_max_batch_size=ocr_max_batch_size,
+            detect_max_batch_size=detect_max_batch_size,
+            max_wait_seconds=max_wait_ms / 1000,
+            max_pending=max_pending,
+        ),
+    )
+    uvicorn.run(app, host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import os
+
 import torch
 
 
@@ -11,3 +13,21 @@ def get_default_device() -> str:
 
 
 DEFAULT_DEVICE = get_default_device()
+
+
+def get_available_cores() -> list[int]:
+    """Get the CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def pin_to_cores(cores: list[int]) -> None:
+    """Restrict this process to the given CPU cores, where the OS supports it."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+def set_cpu_threads(num_threads: int) -> None:
+    """Set the number of threads torch uses within each CPU op."""
+    torch.set_num_threads(max(num_threads, 1))
@@ -0,0 +1,117 @@
+import threading
+from collections.abc import Callable, Hashable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from typing import Generic, NamedTuple, TypeVar
+
+B = TypeVar("B")
+T = TypeVar("T")
+U = TypeVar("U")
+
+_POLL_INTERVAL = 0.1
+
+
+class _Done:
+    pass
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _Group(NamedTuple, Generic[U]):
+    indices: list[int]
+    future: Future[list[U]]
+
+
+class Prefetcher(Generic[B, T, U]):
+    """Prepare upcoming batches on CPU worker threads while the current one is consumed.
+
+    A producer thread pulls `(batch, items)` pairs from `batches`, groups each batch's
+    items by `group_key` (by default, every item on its own) and submits `prepare` for
+    each group to a pool of `workers` threads. At most `depth` batches are fetched and
+    prepared ahead of the one being consumed, which bounds memory to `depth + 1`
+    prepared batches. Iterating yields `(batch, prepared)` pairs in order, where
+    `prepared` has one entry per item.
+
+    `batches` is iterated on the producer thread, so if it queries the database it must
+    use its own session. With `depth=0`, everything runs inline on the calling thread.
+    """
+
+    def __init__(
+        self,
+        batches: Iterable[tuple[B, list[T]]],
+        prepare: Callable[[list[T]], list[U]],
+        *,
+        workers: int,
+        depth: int,
+        group_key: Callable[[T], Hashable] | None = None,
+    ):
+        self.batches = batches
+        self.prepare = prepare
+        self.group_key = group_key
+        self.workers = max(workers, 1)
+        self.depth = depth
+
+    def __iter__(self) -> Iterator[tuple[B, list[U]]]:
+        if self.depth <= 0:
+            for batch, items in self.batches:
+                yield batch, self.prepare(items)
+            return
+
+        queue: Queue[tuple[B, list[_Group[U]]] | _Done | _Failed] = Queue()
+        slots = threading.Semaphore(self.depth)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(self.workers, thread_name_prefix="prefetch")
+
+        def produce() -> None:
+            try:
+                for batch, items in self.batches:
+                    while not slots.acquire(timeout=_POLL_INTERVAL):
+                        if stop.is_set():
+                            return
+                    if stop.is_set():
+                        return
+                    groups = [
+                        _Group(indices, executor.submit(self.prepare, group_items))
+                        for indices, group_items in self._group(items)
+                    ]
+                    queue.put((batch, groups))
+                queue.put(_Done())
+            except BaseException as e:
+                queue.put(_Failed(e))
+
+        producer = threading.Thread(target=produce, name="prefetch-producer")
+        producer.start()
+        try:
+            while True:
+                entry = queue.get()
+                if isinstance(entry, _Done):
+                    return
+                if isinstance(entry, _Failed):
+                    raise entry.error
+                batch, groups = entry
+                # Free a slot as soon as we start on this batch, so the producer can
+                # prepare the next `depth` batches while this one is consumed
+                slots.release()
+                prepared: dict[int, U] = {}
+                for group in groups:
+                    prepared.update(
+                        zip(group.indices, group.future.result(), strict=True)
+                    )
+                yield batch, [prepared[idx] for idx in range(len(prepared))]
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            producer.join()
+
+    def _group(self, items: list[T]) -> list[tuple[list[int], list[T]]]:
+        if self.group_key is None:
+            return [([idx], [item]) for idx, item in enumerate(items)]
+        groups: dict[Hashable, tuple[list[int], list[T]]] = {}
+        for idx, item in enumerate(items):
+            indices, group_items = groups.setdefault(self.group_key(item), ([], []))
+            indices.append(idx)
+            group_items.append(item)
+        return list(groups.values())
@@ -26,6 +26,23 @@ class InferenceInput(BaseModel):
         return InputType.IMAGE
 
 
+class FailureReason(Enum):
+    PARSE_ERROR = "parse_error"
+    TRUNCATED = "truncated"
+    """Generation stopped at `max_tokens` before the output was complete."""
+    REQUEST_ERROR = "request_error"
+    """A remote model server couldn't be reached or returned an error."""
+
+
+class InferenceFailure(BaseModel):
+    """A document whose model output couldn't be parsed into a result."""
+
+    reason: FailureReason
+    output: str | None = None
+
+    input: InferenceInput | None = None
+
+
 class InferenceResult(BaseModel):
     answer: bool
     raw_passage: str | None
@@ -36,9 +53,21 @@ class InferenceResult(BaseModel):
 
 
 class OCRInput(BaseModel):
-    image: bytes
+    image: bytes | None = None
+    image_path: str | None = None
+    """Path to the image file, which is only read when the input is decoded."""
+    frame_idx: int | None = None
+    """Frame of a multi-page image to transcribe, or None for the first."""
+
+    @model_validator(mode="after")
+    def validate_input(self):
+        if self.image is None and self.image_path is None:
+            raise ValueError("Either image or image_path must be provided")
+        return self
 
 
 class OCRResult(BaseModel):
     text: str
+    word_geometry: bytes | None = None
+    """Packed word spans and boxes, see `rrc.ocr.geometry.WordGeometry`."""
     input: OCRInput